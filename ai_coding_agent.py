@@ -9,20 +9,4148 @@ This agent uses Google's Gemini Pro to:
 4. Process follow-up requests with context awareness
 """
 
+import io
 import os
 import sys
 import json
+import mmap
+import stat
+import math
+import time
+import zlib
+import heapq
+import shlex
+import re
+import ast
 import base64
+import difflib
+import hashlib
+import datetime
 import argparse
+import shutil
+import tempfile
+import threading
 import subprocess
-from typing import Dict, List, Tuple, Optional
+from array import array
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, List, Tuple, Optional, Iterator, Union
 
 # Import Gemini API
 from google import genai
-from google.genai import types
+from google.genai import errors, types
+
+# NumPy is optional; without it relevance search runs in pure Python
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Process umask, needed to give streamed files the same mode open() would
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+def _update_digest(digest, text: str, linesep: str = os.linesep) -> None:
+    """Feed text to a SHA-256 as a text-mode write with this newline would store it on disk"""
+    if linesep and linesep != '\n':
+        text = text.replace('\n', linesep)
+    digest.update(text.encode('utf-8'))
+
+def _file_digest(path: str) -> str:
+    """SHA-256 hex digest of a file's bytes"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _atomic_write(path: str, data: Union[str, bytes, bytearray]) -> None:
+    """Replace path with data through a temporary file in the same directory"""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+def _read_text(path: str, max_bytes: int) -> Tuple[Optional[str], Optional[os.stat_result]]:
+    """Read a file as open(path, 'r') would, with the stat of what was read
+    
+    The text is None for files over max_bytes and for binary files (a NUL
+    byte in the first 8 KB); the stat is None if the file could not be opened.
+    """
+    try:
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            if st.st_size > max_bytes:
+                return None, st
+            data = f.read(max_bytes + 1)
+    except OSError:
+        return None, None
+    if len(data) > max_bytes or b'\0' in data[:8192]:
+        return None, st
+    text = data.decode('utf-8', errors='ignore')
+    return text.replace('\r\n', '\n').replace('\r', '\n'), st
+
+# Directories that never hold project source: VCS data, installed
+# dependencies and tool caches. They are never walked, whatever the ignore
+# files say.
+PRUNED_DIRS = frozenset({
+    ".git", ".hg", ".svn", "node_modules", "__pycache__", ".venv",
+    ".tox", ".nox", ".mypy_cache", ".pytest_cache", ".ruff_cache",
+})
+
+# Directories that usually hold build output or dependencies but are
+# sometimes real source (a "build" package, an "env" module). They are
+# skipped like lines of a root .gitignore, so a "!build/" in the project's
+# own .gitignore or .agentignore brings them back.
+DEFAULT_IGNORE = """
+venv/
+env/
+bower_components/
+.eggs/
+*.egg-info/
+.gradle/
+.next/
+.nuxt/
+.parcel-cache/
+.cache/
+dist/
+build/
+target/
+coverage/
+htmlcov/
+"""
+
+def _is_pruned_dir(name: str) -> bool:
+    return name in PRUNED_DIRS
+
+def _glob_to_regex(pattern: str) -> str:
+    """Translate a gitignore glob into a regex over '/'-separated paths"""
+    out = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == '*':
+            if pattern.startswith('**', i) and (i == 0 or pattern[i - 1] == '/'):
+                # "**/" matches zero or more directories, a trailing "**" everything
+                if i + 2 == n:
+                    out.append('.*')
+                    i += 2
+                    continue
+                if pattern[i + 2] == '/':
+                    out.append('(?:.*/)?')
+                    i += 3
+                    continue
+            out.append('[^/]*')
+            while i < n and pattern[i] == '*':
+                i += 1
+            continue
+        if c == '?':
+            out.append('[^/]')
+        elif c == '[':
+            # A ']' right after the opening bracket (or its negation) is literal
+            start = i + 3 if pattern.startswith(('[!', '[^'), i) else i + 2
+            end = pattern.find(']', start)
+            if end == -1:
+                out.append(re.escape(c))
+            else:
+                body = pattern[i + 1:end]
+                if body[0] in '!^':
+                    body = '^' + body[1:]
+                out.append('[' + body.replace('\\', '\\\\') + ']')
+                i = end
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            out.append(re.escape(pattern[i]))
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return ''.join(out)
+
+def parse_ignore_patterns(text: str) -> List[Tuple[str, bool, bool, bool]]:
+    """Parse a .gitignore file into (glob, anchored, negated, directory-only) rules"""
+    rules = []
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        # Trailing spaces are dropped unless escaped with a backslash
+        stripped = line.rstrip(' ')
+        if stripped.endswith('\\') and len(stripped) < len(line):
+            stripped += ' '
+        line = stripped
+        negated = line.startswith('!')
+        if negated or line.startswith('\\!') or line.startswith('\\#'):
+            line = line[1:]
+        dir_only = line.endswith('/')
+        line = line.rstrip('/')
+        if not line:
+            continue
+        # A slash anywhere but the end anchors the pattern to the file's directory
+        anchored = '/' in line
+        rules.append((line.lstrip('/'), anchored, negated, dir_only))
+    return rules
+
+_GLOB_CHARS_RE = re.compile(r'[*?\[\\]')
+
+def _combine_globs(globs: List[Tuple[int, str]]) -> Optional["re.Pattern"]:
+    """One regex for many globs that reports the highest-numbered rule that matched"""
+    if not globs:
+        return None
+    # Alternatives are tried in order, so listing later rules first makes
+    # the first successful alternative the one that wins under gitignore rules
+    alternatives = [f"(?P<r{index}>{_glob_to_regex(glob)})\\Z" for index, glob in sorted(globs, reverse=True)]
+    return re.compile("|".join(alternatives))
+
+class _TrieNode:
+    __slots__ = ("children", "terminal", "globs", "regex")
+    
+    def __init__(self):
+        self.children = {}
+        self.terminal = -1  # rule matching exactly the path that ends here
+        self.globs = []  # (rule, glob) matched against the rest of the path
+        self.regex = None
+    
+    def compile(self) -> None:
+        self.regex = _combine_globs(self.globs)
+        for child in self.children.values():
+            child.compile()
+
+class _CompiledRules:
+    """The rules of one ignore scope compiled for fast lookup
+    
+    Unanchored patterns only ever match a path's last component, so literal
+    names and "*suffix" patterns become dict lookups and the rest share one
+    combined regex.
+    Anchored patterns are stored in a trie keyed by their literal leading
+    components; a lookup follows the path's components down the trie and
+    only tries the globs hanging off nodes it passes through.
+    """
+    
+    def __init__(self, rules: List[Tuple[int, str, bool]]):
+        self.names = {}
+        self.suffixes = {}
+        name_globs = []
+        self.trie = _TrieNode()
+        for index, glob, anchored in rules:
+            if not anchored:
+                if _GLOB_CHARS_RE.search(glob) is None:
+                    self.names[glob] = index
+                elif glob.startswith('*') and _GLOB_CHARS_RE.search(glob, 1) is None:
+                    self.suffixes[glob[1:]] = index
+                else:
+                    name_globs.append((index, glob))
+                continue
+            parts = glob.split('/')
+            node = self.trie
+            while len(parts) > 1 and _GLOB_CHARS_RE.search(parts[0]) is None:
+                node = node.children.setdefault(parts.pop(0), _TrieNode())
+            if len(parts) == 1 and _GLOB_CHARS_RE.search(parts[0]) is None:
+                node = node.children.setdefault(parts[0], _TrieNode())
+                node.terminal = max(node.terminal, index)
+            else:
+                node.globs.append((index, '/'.join(parts)))
+        self.name_regex = _combine_globs(name_globs)
+        self.suffix_lengths = sorted({len(suffix) for suffix in self.suffixes})
+        self.trie.compile()
+    
+    def match(self, parts: List[str]) -> int:
+        """Index of the last rule matching a path split into components, or -1"""
+        name = parts[-1]
+        best = self.names.get(name, -1)
+        for length in self.suffix_lengths:
+            if length > len(name):
+                break
+            best = max(best, self.suffixes.get(name[len(name) - length:], -1))
+        if self.name_regex is not None:
+            found = self.name_regex.match(name)
+            if found:
+                best = max(best, int(found.lastgroup[1:]))
+        
+        node = self.trie
+        depth = len(parts)
+        for i in range(depth):
+            if node.regex is not None:
+                found = node.regex.match('/'.join(parts[i:]))
+                if found:
+                    best = max(best, int(found.lastgroup[1:]))
+            node = node.children.get(parts[i])
+            if node is None:
+                return best
+        return max(best, node.terminal)
+
+class IgnoreRules:
+    """The ignore rules in effect in one directory, with its parents' rules
+    
+    Rules come from .gitignore and .agentignore files and follow gitignore
+    semantics: patterns are relative to the directory of the file they
+    come from, the last matching rule wins, deeper files override those
+    above them, "!" re-includes a path and a trailing "/" matches only
+    directories. Paths inside an ignored directory cannot be re-included,
+    because the walk never enters it.
+    
+    Each scope's rules are compiled once (see _CompiledRules), separately
+    for files and for directories, so a lookup costs a few dict probes and
+    at most a couple of regex matches however many patterns there are.
+    key identifies the combined contents of every ignore file involved, so
+    a directory listed under different rules can be recognized as stale.
+    """
+    
+    FILENAMES = (".gitignore", ".agentignore")
+    
+    def __init__(self, parent: Optional["IgnoreRules"] = None, base: str = os.curdir,
+                 rules: Optional[List[Tuple[str, bool, bool, bool]]] = None, key: str = ""):
+        self.parent = parent
+        self.base = base
+        self.key = key
+        self.negated = [negated for _, _, negated, _ in rules or []]
+        self._files = self._dirs = None
+        if rules:
+            self._files = _CompiledRules([(index, glob, anchored)
+                                          for index, (glob, anchored, _, dir_only) in enumerate(rules)
+                                          if not dir_only])
+            self._dirs = _CompiledRules([(index, glob, anchored)
+                                         for index, (glob, anchored, _, _) in enumerate(rules)])
+    
+    def ignored(self, rel_path: str, is_dir: bool) -> bool:
+        """Whether a project-relative path is excluded"""
+        if os.sep != '/':
+            rel_path = rel_path.replace(os.sep, '/')
+        rules = self
+        while rules is not None:
+            if rules._dirs is not None:
+                sub_path = rel_path if rules.base == os.curdir else rel_path[len(rules.base) + 1:]
+                index = (rules._dirs if is_dir else rules._files).match(sub_path.split('/'))
+                if index >= 0:
+                    return not rules.negated[index]
+            rules = rules.parent
+        return False
+
+class ProjectManifest:
+    """Persistent, incrementally refreshed index of a project's files
+    
+    files maps each project-relative path to [size, mtime_ns, inode, sha256,
+    token features], where the hash and the features (see TokenEstimator)
+    are filled in lazily the first time they are needed. dirs
+    maps each directory ("." for the root) to [mtime_ns, subdirectories,
+    file names, ignore files, ignore rules key]. refresh() stats every known
+    directory but only lists the ones whose mtime or ignore rules changed,
+    so a warm start on a big tree costs one stat per directory instead of a
+    full walk. Directories in PRUNED_DIRS, virtualenvs and anything excluded
+    by DEFAULT_IGNORE or .gitignore/.agentignore files are never entered or
+    recorded. Editing a file in place does not touch its directory's mtime,
+    which is why users of a single file call check() to compare it against
+    a fresh stat.
+    
+    on_change, if set, is called with the path of every file whose entry
+    changed or disappeared so callers can drop derived caches. generation
+    counts those changes, so anything derived from the whole file list can
+    be reused while it stays the same.
+    """
+    
+    VERSION = 4
+    # Directory mtimes this close to the scan time may still change within
+    # the same timestamp tick, so such directories are listed again next time
+    RACY_NS = 2 * 10 ** 9
+    
+    def __init__(self, root: str, store_path: Optional[str] = None, on_change=None):
+        self.root = root
+        self.store_path = store_path
+        self.on_change = on_change
+        self.files = {}
+        self.dirs = {}
+        self._rules = {}  # directory -> IgnoreRules, from the last refresh
+        self._ignore_files = {}  # ignore file -> (size, mtime_ns, digest, parsed rules)
+        self._rule_sets = {}  # IgnoreRules.key -> compiled IgnoreRules
+        self._default_rules = IgnoreRules(None, os.curdir, parse_ignore_patterns(DEFAULT_IGNORE),
+                                          hashlib.sha256(DEFAULT_IGNORE.encode('utf-8')).hexdigest()[:16])
+        self.generation = 0  # bumped whenever a file entry changes or goes away
+        self._sorted = (-1, [])  # (generation, sorted paths)
+        self._dirty = False
+        self._lock = threading.RLock()
+        self.load()
+    
+    def load(self) -> None:
+        """Load the saved manifest, starting empty if it is missing or stale"""
+        if not self.store_path or not os.path.exists(self.store_path):
+            return
+        try:
+            with open(self.store_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get("version") == self.VERSION and data.get("root") == self.root:
+                self.files = data["files"]
+                self.dirs = data["dirs"]
+        except (OSError, ValueError, KeyError):
+            self.files, self.dirs = {}, {}
+    
+    def save(self) -> None:
+        """Persist the manifest if anything changed since it was loaded"""
+        with self._lock:
+            if not self.store_path or not self._dirty:
+                return
+            data = {"version": self.VERSION, "root": self.root, "files": self.files, "dirs": self.dirs}
+            # dumps() uses the C encoder; dump() streams in pure Python
+            _atomic_write(self.store_path, json.dumps(data, separators=(',', ':')))
+            self._dirty = False
+    
+    def refresh(self) -> None:
+        """Bring the file list up to date, listing only directories that changed"""
+        with self._lock:
+            now_ns = time.time_ns()
+            rules_by_dir = {}
+            stack = [(os.curdir, self._default_rules)]
+            while stack:
+                rel_dir, parent_rules = stack.pop()
+                full_dir = self.root if rel_dir == os.curdir else os.path.join(self.root, rel_dir)
+                try:
+                    mtime_ns = os.stat(full_dir).st_mtime_ns
+                except OSError:
+                    continue
+                
+                known = self.dirs.get(rel_dir)
+                rules = None
+                if known is not None and known[0] == mtime_ns:
+                    # Same listing, but a parent's ignore file may have changed
+                    rules = self._rules_for(rel_dir, parent_rules, known[3])
+                    if rules.key != known[4]:
+                        known = None
+                if known is None or known[0] != mtime_ns:
+                    known, rules = self._scan_dir(rel_dir, full_dir, parent_rules, mtime_ns, now_ns)
+                rules_by_dir[rel_dir] = rules
+                for name in known[1]:
+                    stack.append((name if rel_dir == os.curdir else os.path.join(rel_dir, name), rules))
+            
+            for rel_dir in [d for d in self.dirs if d not in rules_by_dir]:
+                self._forget_dir(rel_dir)
+            self._rules = rules_by_dir
+            self.save()
+    
+    def _scan_dir(self, rel_dir: str, full_dir: str, parent_rules: IgnoreRules,
+                  mtime_ns: int, now_ns: int) -> Tuple[list, IgnoreRules]:
+        """List one directory and update the entries of the files directly in it"""
+        with os.scandir(full_dir) as it:
+            entries = list(it)
+        ignore_files = sorted(entry.name for entry in entries
+                              if entry.name in IgnoreRules.FILENAMES and entry.is_file())
+        rules = self._rules_for(rel_dir, parent_rules, ignore_files)
+        
+        subdirs, names = [], []
+        # A virtualenv can have any name; it is recognized by its pyvenv.cfg
+        if rel_dir == os.curdir or not any(entry.name == "pyvenv.cfg" for entry in entries):
+            for entry in entries:
+                rel_path = entry.name if rel_dir == os.curdir else os.path.join(rel_dir, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    if not _is_pruned_dir(entry.name) and not rules.ignored(rel_path, True):
+                        subdirs.append(entry.name)
+                    continue
+                if rules.ignored(rel_path, False):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue  # dangling symlink
+                if not stat.S_ISREG(st.st_mode):
+                    continue  # symlink to a directory, socket, fifo, device
+                if entry.is_symlink() and not self.contains(os.path.realpath(entry.path)):
+                    continue  # symlink to a file outside the project
+                names.append(entry.name)
+                self._update(rel_path, st)
+        
+        old = self.dirs.get(rel_dir)
+        if old is not None:
+            for name in set(old[2]) - set(names):
+                self._forget_file(name if rel_dir == os.curdir else os.path.join(rel_dir, name))
+        
+        if now_ns - mtime_ns < self.RACY_NS:
+            mtime_ns = -1
+        record = [mtime_ns, sorted(subdirs), sorted(names), ignore_files, rules.key]
+        self.dirs[rel_dir] = record
+        self._dirty = True
+        return record, rules
+    
+    def _rules_for(self, rel_dir: str, parent_rules: IgnoreRules, ignore_files: List[str]) -> IgnoreRules:
+        """Combine a directory's own ignore files with the rules inherited from above"""
+        if not ignore_files:
+            return parent_rules
+        patterns, digests = [], []
+        for name in ignore_files:
+            rel_path = name if rel_dir == os.curdir else os.path.join(rel_dir, name)
+            full_path = os.path.join(self.root, rel_path)
+            try:
+                st = os.stat(full_path)
+                cached = self._ignore_files.get(rel_path)
+                if cached is None or cached[:2] != (st.st_size, st.st_mtime_ns):
+                    with open(full_path, 'r', encoding='utf-8', errors='ignore') as f:
+                        text = f.read()
+                    cached = (st.st_size, st.st_mtime_ns,
+                              hashlib.sha256(text.encode('utf-8')).hexdigest(),
+                              parse_ignore_patterns(text))
+                    self._ignore_files[rel_path] = cached
+            except OSError:
+                continue
+            digests.append(cached[2])
+            patterns.extend(cached[3])
+        key = hashlib.sha256("\0".join([parent_rules.key, rel_dir] + digests).encode('utf-8')).hexdigest()[:16]
+        # The key covers the parents' files too, so a cached copy is equivalent
+        rules = self._rule_sets.get(key)
+        if rules is None:
+            rules = self._rule_sets[key] = IgnoreRules(parent_rules, rel_dir, patterns, key)
+        return rules
+    
+    def is_ignored(self, rel_path: str) -> bool:
+        """Whether a path lies where refresh() would not record it"""
+        rel_path = os.path.normpath(rel_path)
+        if os.path.isabs(rel_path) or rel_path == os.pardir or rel_path.startswith(os.pardir + os.sep):
+            return True  # outside the project
+        rel_dir = os.path.dirname(rel_path) or os.curdir
+        if any(_is_pruned_dir(part) for part in rel_dir.split(os.sep)):
+            return True
+        # Directories the last refresh did not reach are judged by the
+        # rules of their nearest known ancestor
+        ancestor = rel_dir
+        while ancestor not in self._rules and ancestor != os.curdir:
+            parent = os.path.dirname(ancestor) or os.curdir
+            if parent == ancestor:
+                break
+            ancestor = parent
+        rules = self._rules.get(ancestor)
+        if rules is None:
+            rules, ancestor = self._default_rules, os.curdir
+        while rel_dir != ancestor:
+            if rules.ignored(rel_dir, True):
+                return True
+            rel_dir = os.path.dirname(rel_dir) or os.curdir
+        return rules.ignored(rel_path, False)
+    
+    def _update(self, rel_path: str, st: os.stat_result) -> list:
+        """Store a fresh stat for a file, dropping its hash if the file changed"""
+        entry = self.files.get(rel_path)
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns and entry[2] == st.st_ino:
+            return entry
+        entry = [st.st_size, st.st_mtime_ns, st.st_ino, None, None]
+        self.files[rel_path] = entry
+        self._dirty = True
+        self.generation += 1
+        if self.on_change:
+            self.on_change(rel_path)
+        return entry
+    
+    def _forget_file(self, rel_path: str) -> None:
+        if self.files.pop(rel_path, None) is not None:
+            self._dirty = True
+            self.generation += 1
+            if self.on_change:
+                self.on_change(rel_path)
+    
+    def _forget_dir(self, rel_dir: str) -> None:
+        record = self.dirs.pop(rel_dir, None)
+        if record is not None:
+            self._dirty = True
+            for name in record[2]:
+                self._forget_file(name if rel_dir == os.curdir else os.path.join(rel_dir, name))
+    
+    def list(self, prefix: Optional[str] = None) -> List[str]:
+        """Sorted paths of all known files, optionally only those under prefix"""
+        with self._lock:
+            if not prefix or os.path.normpath(prefix) == os.curdir:
+                if self._sorted[0] != self.generation:
+                    self._sorted = (self.generation, sorted(self.files))
+                return list(self._sorted[1])
+            prefix = os.path.normpath(prefix) + os.sep
+            return sorted(path for path in self.files if path.startswith(prefix))
+    
+    def check(self, rel_path: str) -> Optional[list]:
+        """Re-stat one file and return its up-to-date entry, or None if it is gone or not a regular file"""
+        rel_path = os.path.normpath(rel_path)
+        with self._lock:
+            if rel_path not in self.files and self.is_ignored(rel_path):
+                return None
+            try:
+                st = os.stat(os.path.join(self.root, rel_path))
+            except OSError:
+                self._forget_file(rel_path)
+                return None
+            if not stat.S_ISREG(st.st_mode):
+                self._forget_file(rel_path)
+                return None
+            return self._update(rel_path, st)
+    
+    def observe(self, rel_path: str, st: os.stat_result) -> list:
+        """Record a stat of a known file taken elsewhere, such as an fstat while reading it"""
+        with self._lock:
+            return self._update(rel_path, st)
+    
+    def contains(self, full_path: str) -> bool:
+        """Whether a resolved absolute path lies inside the project"""
+        root = os.path.realpath(self.root)
+        return os.path.commonpath([root, full_path]) == root
+    
+    def size(self, rel_path: str) -> Optional[int]:
+        """Size of a file as last seen"""
+        entry = self.files.get(rel_path)
+        return entry[0] if entry else None
+    
+    def digest(self, rel_path: str) -> Optional[str]:
+        """SHA-256 of a file's current content, hashing it only if it changed"""
+        with self._lock:
+            entry = self.check(rel_path)
+            if entry is None:
+                return None
+            if entry[3] is None:
+                entry[3] = _file_digest(os.path.join(self.root, rel_path))
+                self._dirty = True
+            return entry[3]
+    
+    def token_features(self, rel_path: str, text: str) -> List[int]:
+        """TokenEstimator features of a file's current content, given as text, computed once per content"""
+        with self._lock:
+            entry = self.files.get(rel_path)
+            if entry is None:
+                return TokenEstimator.features(text)
+            if entry[4] is None:
+                entry[4] = TokenEstimator.features(text)
+                self._dirty = True
+            return entry[4]
+    
+    def record(self, rel_path: str, digest: Optional[str] = None) -> None:
+        """Update a file's entry after writing it, with its known hash"""
+        with self._lock:
+            entry = self.check(rel_path)
+            if entry is not None and digest is not None:
+                entry[3] = digest
+                self._dirty = True
+
+class StreamedFile:
+    """A file written piece by piece, so its content is never held in memory
+    
+    newline is passed to open(): None translates "\n" to os.linesep, and
+    "" writes the text exactly as given.
+    """
+    
+    def __init__(self, path: str, fsync: bool = False, newline: Optional[str] = None):
+        self.path = path
+        self.fsync = fsync
+        self.linesep = os.linesep if newline is None else newline
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._file = open(path, 'w', encoding='utf-8', newline=newline)
+        self._digest = hashlib.sha256()
+    
+    def write(self, text: str) -> None:
+        """Append text to the file"""
+        self._file.write(text)
+        _update_digest(self._digest, text, self.linesep)
+    
+    def hexdigest(self) -> str:
+        """SHA-256 of everything written so far, as stored on disk"""
+        return self._digest.hexdigest()
+    
+    def close(self) -> None:
+        """Close the file, forcing it to stable storage if fsync is set"""
+        if self._file.closed:
+            return
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._file.close()
+
+def _fsync_path(path: str) -> None:
+    """fsync a file or directory by path"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        # Directories cannot be opened on every platform (e.g. Windows)
+        if os.path.isdir(path):
+            return
+        raise
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class CommitError(Exception):
+    """Raised when ApplyTransaction.commit() fails; path is the file or directory at fault"""
+    
+    def __init__(self, path: str, error: Exception):
+        super().__init__(str(error))
+        self.path = path
+        self.error = error
+
+class ApplyTransaction:
+    """Stages the FILE/DIR actions of a response and commits them together
+    
+    Files are written into a hidden staging directory that sits next to the
+    project (so every commit rename stays on one filesystem). Nothing in the
+    project changes until commit(), which first checks every target and
+    creates every directory needed, so file-versus-directory conflicts fail
+    before anything is replaced. It then moves each staged file into place
+    with an atomic os.replace(), keeping a hard link (or copy) of each file
+    it replaces. If a replace still fails, the replaced files are restored,
+    new files and directories are removed, and CommitError names the path.
+    rollback() throws the staged work away and leaves the project untouched.
+    
+    durability controls fsync: "none" never syncs, "per-file" syncs each file
+    as it is closed, and "batch" syncs all staged files together just before
+    the renames, followed by one sync per touched directory.
+    
+    Staged files whose content hash matches the file already on disk are not
+    renamed, so unchanged files keep their mtime. Staging the same path twice
+    keeps only the last version. Hashes of files already on disk come from
+    the project manifest when one is given, so files seen before are not
+    hashed again, and written files are recorded back into it.
+    """
+    
+    DURABILITY_MODES = ("none", "batch", "per-file")
+    
+    def __init__(self, project_path: str, durability: str = "batch",
+                 manifest: Optional[ProjectManifest] = None):
+        if durability not in self.DURABILITY_MODES:
+            raise ValueError(f"Unknown durability setting: {durability}")
+        self.project_path = project_path
+        self.durability = durability
+        self.manifest = manifest
+        self.staging_path = None
+        self._files = {}  # normalized path -> path as given, in staging order
+        self._digests = {}  # normalized path -> digest of the staged content
+        self._dirs = {}
+        self.duplicates = 0  # FILE blocks collapsed into a later one for the same path
+    
+    @property
+    def empty(self) -> bool:
+        return not self._files and not self._dirs
+    
+    def _relative(self, path: str) -> str:
+        """Normalize a project-relative path, rejecting anything outside the project"""
+        key = os.path.normpath(path)
+        if os.path.isabs(key) or key == os.pardir or key.startswith(os.pardir + os.sep):
+            raise ValueError(f"Path is outside the project: {path}")
+        return key
+    
+    def stage_file(self, file_path: str, count_duplicate: bool = True) -> str:
+        """Register a file and return the staging path its content goes to"""
+        key = self._relative(file_path)
+        if self.staging_path is None:
+            parent = os.path.dirname(os.path.abspath(self.project_path))
+            name = os.path.basename(os.path.abspath(self.project_path))
+            self.staging_path = tempfile.mkdtemp(prefix=f".{name}.staging-", dir=parent)
+        if key in self._files:
+            self.duplicates += count_duplicate
+        else:
+            self._files[key] = file_path
+        return os.path.join(self.staging_path, key)
+    
+    def paths(self) -> List[str]:
+        """Project-relative paths of everything staged so far"""
+        return list(self._files) + list(self._dirs)
+    
+    def staged_path(self, file_path: str) -> Optional[str]:
+        """Staging path of a file already staged in this transaction, if any"""
+        key = self._relative(file_path)
+        if key in self._files:
+            return os.path.join(self.staging_path, key)
+        return None
+    
+    def record_digest(self, file_path: str, digest: str) -> None:
+        """Remember the content hash of a staged file once it is fully written"""
+        self._digests[os.path.normpath(file_path)] = digest
+    
+    def open_staged(self, staged_path: str, newline: Optional[str] = None) -> StreamedFile:
+        """Open a staged file for writing"""
+        return StreamedFile(staged_path, fsync=self.durability == "per-file", newline=newline)
+    
+    def stage_directory(self, dir_path: str) -> None:
+        """Register a directory to create on commit"""
+        self._dirs.setdefault(self._relative(dir_path), dir_path)
+    
+    def commit(self, pool: Optional["WriteBehindPool"] = None) -> Tuple[List[str], List[str], List[str]]:
+        """Move everything staged into the project
+        
+        Returns (written files, unchanged files, directories).
+        """
+        staged = []
+        unchanged = []
+        for key, file_path in self._files.items():
+            target = os.path.join(self.project_path, key)
+            digest = self._digests.get(key)
+            if digest and digest == self._disk_digest(key, target):
+                unchanged.append(file_path)
+            else:
+                staged.append((key, os.path.join(self.staging_path, key)))
+        
+        if self.durability == "batch" and staged:
+            if pool is not None:
+                for key, staged_path in staged:
+                    pool.submit(key, _fsync_path, staged_path)
+                failures = pool.drain()
+                if failures:
+                    raise CommitError(self._files[failures[0][0]], failures[0][1])
+            else:
+                for _, staged_path in staged:
+                    _fsync_path(staged_path)
+        
+        created_dirs = []
+        touched_dirs = set()
+        replaced = []  # (target, backup or None for a new file), in commit order
+        try:
+            self._prepare(staged, created_dirs, touched_dirs)
+            for key, staged_path in staged:
+                target = os.path.join(self.project_path, key)
+                try:
+                    try:
+                        mode = os.stat(target).st_mode & 0o7777
+                    except FileNotFoundError:
+                        mode = 0o666 & ~_UMASK
+                        backup = None
+                    else:
+                        backup = self._backup(key, target)
+                    os.chmod(staged_path, mode)
+                    os.replace(staged_path, target)
+                except OSError as e:
+                    raise CommitError(self._files[key], e)
+                replaced.append((target, backup))
+                touched_dirs.add(os.path.dirname(target))
+        except CommitError:
+            self._restore(replaced, created_dirs)
+            raise
+        
+        if self.manifest is not None:
+            for key, _ in staged:
+                self.manifest.record(key, self._digests.get(key))
+        
+        if self.durability != "none":
+            for directory in touched_dirs:
+                _fsync_path(directory)
+        
+        self._discard_staging()
+        written = [self._files[key] for key, _ in staged]
+        return written, unchanged, list(self._dirs.values())
+    
+    def _prepare(self, staged: List[Tuple[str, str]], created_dirs: List[str], touched_dirs: set) -> None:
+        """Check every target and create every directory the commit needs, replacing nothing"""
+        files = {key for key, _ in staged}
+        parents = set()
+        for key in list(files) + list(self._dirs):
+            parent = os.path.dirname(key)
+            while parent and parent not in parents:
+                parents.add(parent)
+                parent = os.path.dirname(parent)
+        for key in files:
+            if key in parents or key in self._dirs:
+                raise CommitError(self._files[key], IsADirectoryError(f"also used as a directory: {key}"))
+            if os.path.isdir(os.path.join(self.project_path, key)):
+                raise CommitError(self._files[key], IsADirectoryError(f"a directory is in the way: {key}"))
+        
+        # Directory -> the action that needs it, to name in errors
+        needed = {os.path.dirname(key): self._files[key] for key in files if os.path.dirname(key)}
+        needed.update(self._dirs)
+        for key in sorted(needed):
+            full_path = os.path.join(self.project_path, key)
+            # Create level by level so exactly the new directories are recorded
+            missing = []
+            path = full_path
+            while not os.path.isdir(path):
+                missing.append(path)
+                path = os.path.dirname(path)
+            for path in reversed(missing):
+                try:
+                    os.mkdir(path)
+                except OSError as e:
+                    raise CommitError(needed[key], e)
+                created_dirs.append(path)
+            if key in self._dirs:
+                touched_dirs.add(os.path.dirname(full_path))
+    
+    def _backup(self, key: str, target: str) -> str:
+        """Keep the current content of a file about to be replaced, next to the staging directory"""
+        backup = os.path.join(self.staging_path + ".backup", key)
+        os.makedirs(os.path.dirname(backup), exist_ok=True)
+        try:
+            os.link(target, backup)
+        except OSError:
+            shutil.copy2(target, backup)
+        return backup
+    
+    def _restore(self, replaced: List[Tuple[str, Optional[str]]], created_dirs: List[str]) -> None:
+        """Undo a partial commit: put replaced files back, remove new files and directories"""
+        for target, backup in reversed(replaced):
+            try:
+                if backup is None:
+                    os.unlink(target)
+                else:
+                    os.replace(backup, target)
+            except OSError:
+                pass
+        for path in reversed(created_dirs):
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass
+    
+    def _disk_digest(self, key: str, target: str) -> Optional[str]:
+        if self.manifest is not None:
+            return self.manifest.digest(key)
+        if not os.path.isfile(target):
+            return None  # missing, or a directory that _prepare() will report
+        return _file_digest(target)
+    
+    def rollback(self) -> int:
+        """Throw away everything staged; returns how many actions were dropped"""
+        dropped = len(self._files) + len(self._dirs)
+        self._discard_staging()
+        self._files = {}
+        self._digests = {}
+        self._dirs = {}
+        return dropped
+    
+    def _discard_staging(self) -> None:
+        if self.staging_path is not None:
+            shutil.rmtree(self.staging_path, ignore_errors=True)
+            shutil.rmtree(self.staging_path + ".backup", ignore_errors=True)
+            self.staging_path = None
+
+class WriteBehindPool:
+    """Thread pool that performs file writes concurrently, in order per path
+
+    Tasks submitted for the same key run one after another in submission
+    order; tasks for different keys run in parallel on up to max_workers
+    threads. Exceptions are collected and handed back by drain().
+    """
+    
+    def __init__(self, max_workers: int = 8):
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, max_workers), thread_name_prefix="write-behind"
+        )
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._queues = {}  # key -> deque of pending tasks; the head is running
+        self._pending = 0
+        self._failures = []
+    
+    def submit(self, key: str, fn, *args) -> None:
+        """Queue fn(*args) to run after every earlier task for the same key"""
+        with self._lock:
+            self._pending += 1
+            queue = self._queues.get(key)
+            if queue is not None:
+                queue.append((fn, args))
+                return
+            self._queues[key] = deque([(fn, args)])
+        self._executor.submit(self._run, key, fn, args)
+    
+    def _run(self, key: str, fn, args) -> None:
+        """Run one task, then hand the key's next task to the executor"""
+        try:
+            fn(*args)
+        except Exception as e:
+            with self._lock:
+                self._failures.append((key, e))
+        
+        with self._lock:
+            queue = self._queues[key]
+            queue.popleft()
+            if queue:
+                next_fn, next_args = queue[0]
+            else:
+                del self._queues[key]
+                next_fn = None
+            self._pending -= 1
+            if not self._pending:
+                self._idle.notify_all()
+        
+        if next_fn is not None:
+            self._executor.submit(self._run, key, next_fn, next_args)
+    
+    def drain(self) -> List[Tuple[str, Exception]]:
+        """Wait for all queued writes and return the failures since the last drain"""
+        with self._lock:
+            while self._pending:
+                self._idle.wait()
+            failures, self._failures = self._failures, []
+        return failures
+    
+    def shutdown(self) -> None:
+        """Finish queued writes and stop the worker threads"""
+        self.drain()
+        self._executor.shutdown(wait=True)
+
+def _paths_overlap(a: str, b: str) -> bool:
+    """Whether two normalized project-relative paths are equal or nested"""
+    if a == os.curdir or b == os.curdir or a == b:
+        return True
+    return a.startswith(b + os.sep) or b.startswith(a + os.sep)
+
+class _ScheduledCommand:
+    """One CMD action tracked by the CommandScheduler"""
+    
+    def __init__(self, number: int, command: str, cwd: str, deps: List[int]):
+        self.number = number  # 1-based position among the response's CMDs
+        self.command = command
+        self.cwd = cwd
+        self.deps = deps
+        self.state = "pending"  # pending, running, done or cancelled
+        self.started = None
+        self.finished = None
+    
+    @property
+    def duration(self) -> float:
+        if self.started is None or self.finished is None:
+            return 0.0
+        return self.finished - self.started
+
+class CommandScheduler:
+    """Runs the CMD actions of a response concurrently where that is safe
+    
+    Commands form a small DAG: each command depends on every earlier command
+    whose working directory is the same as, inside, or around its own (the
+    project root overlaps everything), plus any explicit after= hints. Ready
+    commands start on their own threads, at most max_concurrency at a time.
+    run(command, cwd) does the actual work and reports the outcome.
+    """
+    
+    def __init__(self, run, max_concurrency: int = 4):
+        self._run = run
+        self.max_concurrency = max(1, max_concurrency)
+        self._cond = threading.Condition()
+        self._commands = []
+        self._running = 0
+    
+    def submit(self, command: str, cwd: str = os.curdir, after: Optional[List[int]] = None) -> int:
+        """Schedule a command; after lists 1-based numbers of earlier commands"""
+        with self._cond:
+            number = len(self._commands) + 1
+            deps = [c.number for c in self._commands if _paths_overlap(c.cwd, cwd)]
+            for dep in after or []:
+                if 0 < dep < number and dep not in deps:
+                    deps.append(dep)
+            self._commands.append(_ScheduledCommand(number, command, cwd, sorted(deps)))
+            self._dispatch()
+            return number
+    
+    def _dispatch(self) -> None:
+        """Start every pending command whose dependencies are done (lock held)"""
+        for scheduled in self._commands:
+            if self._running >= self.max_concurrency:
+                return
+            if scheduled.state != "pending":
+                continue
+            if all(self._commands[dep - 1].state in ("done", "cancelled") for dep in scheduled.deps):
+                scheduled.state = "running"
+                self._running += 1
+                threading.Thread(
+                    target=self._execute, args=(scheduled,), name=f"cmd-{scheduled.number}", daemon=True
+                ).start()
+    
+    def _execute(self, scheduled: _ScheduledCommand) -> None:
+        scheduled.started = time.monotonic()
+        try:
+            self._run(scheduled.command, scheduled.cwd)
+        finally:
+            scheduled.finished = time.monotonic()
+            with self._cond:
+                scheduled.state = "done"
+                self._running -= 1
+                self._dispatch()
+                self._cond.notify_all()
+    
+    def _wait(self, predicate) -> None:
+        with self._cond:
+            while any(c.state in ("pending", "running") and predicate(c) for c in self._commands):
+                self._cond.wait()
+    
+    def wait_for_paths(self, paths: List[str]) -> None:
+        """Wait for every scheduled command whose working directory overlaps paths"""
+        keys = [os.path.normpath(path) for path in paths]
+        self._wait(lambda c: any(_paths_overlap(c.cwd, key) for key in keys))
+    
+    def wait_all(self) -> None:
+        """Wait for every scheduled command to finish"""
+        self._wait(lambda c: True)
+    
+    def cancel_pending(self) -> None:
+        """Drop commands that have not started yet"""
+        with self._cond:
+            for scheduled in self._commands:
+                if scheduled.state == "pending":
+                    scheduled.state = "cancelled"
+            self._cond.notify_all()
+    
+    def report(self, emit=print) -> None:
+        """Print per-command timings and the critical path through the DAG"""
+        ran = [c for c in self._commands if c.state == "done"]
+        if len(ran) < 2:
+            return
+        
+        emit("⏱️  Command timings:")
+        for scheduled in ran:
+            emit(f"  #{scheduled.number} {scheduled.duration:6.1f}s  {scheduled.command}")
+        
+        # Longest chain of dependent commands, by duration
+        path_time, previous = {}, {}
+        for scheduled in ran:
+            best_dep = max(
+                (dep for dep in scheduled.deps if dep in path_time),
+                key=lambda dep: path_time[dep], default=None
+            )
+            path_time[scheduled.number] = scheduled.duration + (path_time[best_dep] if best_dep else 0.0)
+            previous[scheduled.number] = best_dep
+        
+        number = max(path_time, key=path_time.get)
+        chain = []
+        while number:
+            chain.append(number)
+            number = previous[number]
+        chain.reverse()
+        total = path_time[chain[-1]]
+        emit(f"Critical path ({total:.1f}s): {' → '.join(f'#{n}' for n in chain)}")
+
+_CD_PREFIX_RE = re.compile(r"""^cd\s+(["']?)([^"'&;|]+?)\1\s*(?:&&|;)""")
+_CMD_HINTS_RE = re.compile(r"^\[((?:\s*(?:after|cwd)=[^\];]*;?)+)\]\s+")
+
+def parse_command(text: str) -> Tuple[str, str, List[int]]:
+    """Split a CMD marker into (command, working directory, after hints)
+    
+    Hints are an optional prefix such as "[cwd=frontend; after=1,2] npm test";
+    a cwd hint is turned into a leading "cd <dir> &&". The working directory
+    is otherwise read from a leading "cd <dir> &&" and is only used to work
+    out dependencies. It is project-relative, and "." for the project root or
+    anything outside the project.
+    """
+    cwd, after = None, []
+    match = _CMD_HINTS_RE.match(text)
+    if match:
+        text = text[match.end():]
+        for hint in match.group(1).split(';'):
+            key, _, value = hint.strip().partition('=')
+            if key == "cwd" and value.strip():
+                cwd = value.strip()
+                text = f"cd {shlex.quote(cwd)} && {text}"
+            elif key == "after":
+                after.extend(int(n) for n in re.findall(r"\d+", value))
+    
+    if cwd is None:
+        match = _CD_PREFIX_RE.match(text)
+        if match:
+            cwd = match.group(2).strip()
+    
+    cwd = os.path.normpath(cwd) if cwd else os.curdir
+    if os.path.isabs(cwd) or cwd == os.pardir or cwd.startswith(os.pardir + os.sep):
+        cwd = os.curdir
+    return text, cwd, after
+
+class _PendingFile:
+    """State of one FILE block shared between the engine and the write pool"""
+    
+    def __init__(self, path: str, transaction: ApplyTransaction):
+        self.path = path
+        self.transaction = transaction
+        self.staged_path = None
+        self.key = os.path.normpath(path)  # Write pool ordering key
+        self.stream = None
+        self.has_content = False
+        self.newline = None  # passed to open(); "" for patched content that keeps its own line endings
+
+class PatchError(Exception):
+    """Raised when a PATCH block cannot be parsed or applied"""
+
+_SEARCH_RE = re.compile(r"^<{5,9} ?SEARCH\s*$")
+_DIVIDER_RE = re.compile(r"^={5,9}\s*$")
+_REPLACE_RE = re.compile(r"^>{5,9} ?REPLACE\s*$")
+_HUNK_RE = re.compile(r"^@@ -(\d+)(?:,\d+)? \+\d+(?:,\d+)? @@")
+
+def parse_patch(body: str) -> List[Tuple[List[str], List[str], Optional[int]]]:
+    """Parse a PATCH body into (search lines, replace lines, line hint) hunks
+    
+    Accepts search/replace blocks (<<<<<<< SEARCH / ======= / >>>>>>> REPLACE)
+    and unified diff hunks (@@ -a,b +c,d @@). The line hint is the 0-based
+    start line from a unified diff header, or None.
+    """
+    hunks = []
+    lines = body.split('\n')
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        
+        if _SEARCH_RE.match(line):
+            search, replace = [], []
+            i += 1
+            while i < len(lines) and not _DIVIDER_RE.match(lines[i]):
+                search.append(lines[i])
+                i += 1
+            i += 1
+            while i < len(lines) and not _REPLACE_RE.match(lines[i]):
+                replace.append(lines[i])
+                i += 1
+            if i >= len(lines):
+                raise PatchError("unterminated SEARCH/REPLACE block")
+            hunks.append((search, replace, None))
+        
+        elif _HUNK_RE.match(line):
+            hint = max(int(_HUNK_RE.match(line).group(1)) - 1, 0)
+            search, replace = [], []
+            i += 1
+            while i < len(lines) and not _HUNK_RE.match(lines[i]) and not lines[i].startswith("--- "):
+                hunk_line = lines[i]
+                if hunk_line.startswith('-'):
+                    search.append(hunk_line[1:])
+                elif hunk_line.startswith('+'):
+                    replace.append(hunk_line[1:])
+                elif hunk_line.startswith('\\'):
+                    pass  # "\ No newline at end of file"
+                else:
+                    context = hunk_line[1:] if hunk_line.startswith(' ') else hunk_line
+                    search.append(context)
+                    replace.append(context)
+                i += 1
+            # Blank lines between hunks are not context
+            while search and replace and search[-1] == replace[-1] == '':
+                search.pop()
+                replace.pop()
+            hunks.append((search, replace, hint))
+            continue
+        
+        i += 1
+    
+    if not hunks:
+        raise PatchError("no SEARCH/REPLACE blocks or diff hunks found")
+    return hunks
+
+def _find_hunk(lines: List[str], search: List[str], hint: Optional[int],
+               fuzz_threshold: float = 0.85) -> Tuple[int, bool]:
+    """Locate search within lines, returning (start index, whether fuzzy)
+    
+    Tries an exact match, then ignoring trailing whitespace, then ignoring
+    indentation, and finally the most similar window by difflib ratio. When
+    several places match, the one closest to hint wins.
+    """
+    n = len(search)
+    
+    def closest(starts: List[int]) -> int:
+        if hint is None:
+            return starts[0]
+        return min(starts, key=lambda start: abs(start - hint))
+    
+    for normalize in (None, str.rstrip, str.strip):
+        if normalize is None:
+            wanted, haystack = search, lines
+        else:
+            wanted = [normalize(line) for line in search]
+            haystack = [normalize(line) for line in lines]
+        first = wanted[0]
+        starts = [
+            i for i in range(len(haystack) - n + 1)
+            if haystack[i] == first and haystack[i:i + n] == wanted
+        ]
+        if starts:
+            return closest(starts), normalize is str.strip
+    
+    # Fall back to the most similar window of the same length
+    target = '\n'.join(line.strip() for line in search)
+    stripped = [line.strip() for line in lines]
+    matcher = difflib.SequenceMatcher(autojunk=False)
+    matcher.set_seq2(target)
+    best_ratio, best_starts = 0.0, []
+    for i in range(len(lines) - n + 1):
+        matcher.set_seq1('\n'.join(stripped[i:i + n]))
+        if matcher.real_quick_ratio() < fuzz_threshold or matcher.quick_ratio() < fuzz_threshold:
+            continue
+        ratio = matcher.ratio()
+        if ratio > best_ratio:
+            best_ratio, best_starts = ratio, [i]
+        elif ratio == best_ratio:
+            best_starts.append(i)
+    if best_ratio >= fuzz_threshold:
+        return closest(best_starts), True
+    raise PatchError("context not found:\n" + '\n'.join(search[:3]))
+
+def _reindent(replace: List[str], search: List[str], matched: List[str]) -> List[str]:
+    """Re-indent replacement lines to match where a fuzzy match found the search lines
+    
+    Each indentation used in search maps to the one its matched line has.
+    A replacement line takes the mapping of the longest search indentation
+    its own starts with. Raises PatchError when the same search indentation
+    was matched with different ones, since no single shift then fits.
+    """
+    shifts = {}
+    for wanted, found in zip(search, matched):
+        if wanted.strip() and found.strip():
+            old_indent = wanted[:len(wanted) - len(wanted.lstrip())]
+            new_indent = found[:len(found) - len(found.lstrip())]
+            if shifts.setdefault(old_indent, new_indent) != new_indent:
+                raise PatchError("matched lines are indented inconsistently:\n" + '\n'.join(search[:3]))
+    if all(old == new for old, new in shifts.items()):
+        return replace
+    by_length = sorted(shifts, key=len, reverse=True)
+    result = []
+    for line in replace:
+        if line.strip():
+            for old_indent in by_length:
+                if line.startswith(old_indent):
+                    line = shifts[old_indent] + line[len(old_indent):]
+                    break
+        result.append(line)
+    return result
+
+def apply_patch(content: str, hunks: List[Tuple[List[str], List[str], Optional[int]]]) -> Tuple[str, int]:
+    """Apply parsed hunks to content in order; returns (new content, fuzzy hunk count)
+    
+    Lines are split and joined with the line ending of content's first line,
+    so a CRLF file stays CRLF. Raises PatchError if any hunk cannot be
+    located, leaving nothing applied.
+    """
+    first_newline = content.find('\n')
+    newline = '\r\n' if first_newline > 0 and content[first_newline - 1] == '\r' else '\n'
+    lines = content.split(newline)
+    fuzzy_hunks = 0
+    for search, replace, hint in hunks:
+        if not search:
+            # Pure insertion: at the diff position, or appended to the end
+            at = len(lines) if hint is None else min(hint, len(lines))
+            if lines == ['']:
+                lines = list(replace)
+            else:
+                lines[at:at] = replace
+            continue
+        
+        start, fuzzy = _find_hunk(lines, search, hint)
+        end = start + len(search)
+        if fuzzy:
+            fuzzy_hunks += 1
+            replace = _reindent(replace, search, lines[start:end])
+        lines[start:end] = replace
+    
+    return newline.join(lines), fuzzy_hunks
+
+class TerminalRenderer:
+    """Coalesces streamed output into a few large, rate-limited writes
+    
+    On a terminal, text is written at most fps times a second, or as soon
+    as flush_bytes characters are waiting, and a timer makes sure nothing
+    sits in the buffer for longer than one frame. When output is not a
+    terminal (piped to a file or another program) it is fully buffered and
+    only written every buffered_bytes characters or on flush(). Safe to
+    call from several threads.
+    """
+    
+    def __init__(self, stream=None, fps: float = 30, flush_bytes: int = 4096,
+                 buffered_bytes: int = 64 * 1024):
+        self.stream = stream if stream is not None else sys.stdout
+        try:
+            self.interactive = self.stream.isatty()
+        except (AttributeError, ValueError):
+            self.interactive = False
+        self.interval = 1.0 / fps if fps and fps > 0 else 0.0
+        self.flush_bytes = flush_bytes if self.interactive else buffered_bytes
+        self._parts = []
+        self._size = 0
+        self._last_flush = time.monotonic()
+        self._timer = None
+        self._lock = threading.Lock()
+    
+    def write(self, text: str) -> None:
+        """Queue text for output"""
+        if not text:
+            return
+        with self._lock:
+            self._parts.append(text)
+            self._size += len(text)
+            if self._size >= self.flush_bytes:
+                self._flush_locked()
+            elif self.interactive:
+                wait = self._last_flush + self.interval - time.monotonic()
+                if wait <= 0:
+                    self._flush_locked()
+                elif self._timer is None:
+                    self._timer = threading.Timer(wait, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+    
+    def line(self, text: str = "") -> None:
+        """Queue a line of output"""
+        self.write(text + "\n")
+    
+    def flush(self) -> None:
+        """Write out everything queued so far"""
+        with self._lock:
+            self._flush_locked()
+            if not self.interactive:
+                self.stream.flush()
+    
+    def _flush_locked(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._parts:
+            self.stream.write("".join(self._parts))
+            self._parts = []
+            self._size = 0
+            if self.interactive:
+                self.stream.flush()
+        self._last_flush = time.monotonic()
+
+class ResponseBuffer:
+    """Accumulates a streamed response, spilling to a temp file past a memory cap
+
+    Chunks are kept in memory until their UTF-8 size exceeds
+    max_memory_bytes; after that everything lives in an anonymous temp file,
+    so a huge answer costs a bounded amount of RSS. size counts characters.
+    lines() splits exactly like str.split('\\n').
+    """
+    
+    READ_SIZE = 64 * 1024
+    
+    def __init__(self, max_memory_bytes: int = 1024 * 1024):
+        self.max_memory_bytes = max_memory_bytes
+        self._chunks = []
+        self._memory_size = 0  # UTF-8 bytes held in _chunks
+        self._spill = None
+        self.size = 0
+    
+    @property
+    def spilled(self) -> bool:
+        return self._spill is not None
+    
+    def append(self, text: str) -> None:
+        """Add a chunk of the response"""
+        if not text:
+            return
+        self.size += len(text)
+        
+        if self._spill is not None:
+            self._spill.seek(0, os.SEEK_END)
+            self._spill.write(text)
+            return
+        
+        self._chunks.append(text)
+        self._memory_size += len(text) if text.isascii() else len(text.encode('utf-8'))
+        if self._memory_size > self.max_memory_bytes:
+            # Move everything collected so far to disk
+            self._spill = tempfile.TemporaryFile(mode='w+', encoding='utf-8', newline='\n')
+            self._spill.writelines(self._chunks)
+            self._chunks = []
+            self._memory_size = 0
+    
+    def chunks(self) -> Iterator[str]:
+        """Iterate over the response in bounded-size pieces"""
+        if self._spill is None:
+            yield from self._chunks
+            return
+        
+        self._spill.flush()
+        self._spill.seek(0)
+        while True:
+            block = self._spill.read(self.READ_SIZE)
+            if not block:
+                break
+            yield block
+    
+    def lines(self) -> Iterator[str]:
+        """Iterate over the response line by line without the newlines"""
+        partial = ""
+        for block in self.chunks():
+            pieces = (partial + block).split('\n')
+            partial = pieces.pop()
+            yield from pieces
+        yield partial
+    
+    def getvalue(self) -> str:
+        """Return the whole response as one string"""
+        return "".join(self.chunks())
+    
+    def close(self) -> None:
+        """Release the memory or temp file holding the response"""
+        self._chunks = []
+        self._memory_size = 0
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+class ResponseParser:
+    """Incremental parser for the FILE/PATCH/DIR/CMD response format
+    
+    Feed it text in chunks of any size; it reports what it finds to a
+    handler object with these methods:
+    
+        on_text(line)           an explanation line outside any block
+        on_file_start(path)     a FILE block opens
+        on_file_data(text)      more content of the open FILE block
+        on_file_end()           the open FILE block is complete
+        on_patch(path, body)    a complete PATCH block
+        on_dir(path)            a DIR marker
+        on_cmd(command)         a CMD marker
+    
+    The on_file_data pieces concatenate to the block's lines joined with
+    newlines. A block runs until the next marker line. If the first
+    non-blank line of a block is a markdown code fence, that fence is
+    dropped and the matching closing fence ends the block, so the fences
+    never reach the file (whose last line then ends with a newline). Lines
+    after the closing fence are explanation.
+    Fence lines with an info string inside the block (```bash) are taken
+    to open nested fences, which a bare fence then closes.
+    
+    Inside a FILE block, everything up to the next interesting line is
+    reported as a single piece. For unfenced blocks only markers matter and
+    they are located with str.find; fenced blocks also need fence lines and
+    use one regex search. Either way a large file costs a few C-level scans
+    instead of per-line Python work. A line still arriving is kept as a list
+    of chunks; inside a FILE block it is passed on as soon as its first
+    characters rule out a marker or fence, so one huge line (minified code,
+    data) streams through instead of being held back.
+    """
+    
+    MARKERS = ("FILE: ", "PATCH: ", "DIR: ", "CMD: ")
+    _LINE_MARKERS = tuple("\n" + marker for marker in MARKERS)
+    _INTERESTING = r"(?:FILE: |PATCH: |DIR: |CMD: |[ \t]*(?:`{3,}|~{3,}))"
+    _INTERESTING_LINE_RE = re.compile(_INTERESTING)
+    _NEXT_INTERESTING_RE = re.compile("\n" + _INTERESTING)
+    _FENCE_RE = re.compile(r"^[ \t]*(`{3,}|~{3,})[ \t]*(.*?)[ \t]*$")
+    _FENCE_START_RE = re.compile(r"[ \t]*(`+|~+)?")
+    HEAD_CHARS = 64  # a partial line still undecided after this many characters is held whole
+    
+    def __init__(self, handler):
+        self.handler = handler
+        self._partial = []  # Chunks of a line that is still arriving
+        self._head = ""  # Its first HEAD_CHARS characters, to decide whether it can stream
+        self._hold = False  # The arriving line may be a marker or fence; wait for all of it
+        self._streaming = False  # The arriving line is FILE content already being passed on
+        self._mode = None  # None, "FILE" or "PATCH"
+        self._path = None
+        self._has_data = False
+        self._patch_lines = []
+        self._awaiting_fence = False  # No non-blank line seen in the block yet
+        self._leading_blanks = 0
+        self._fence = None  # Opening fence of the open block, e.g. "```"
+        self._fence_depth = 0
+        self._closed = False
+    
+    def feed(self, text: str) -> None:
+        """Consume a chunk of text, handling every line it completes"""
+        if not text:
+            return
+        
+        if self._streaming:
+            newline = text.find("\n")
+            if newline < 0:
+                self.handler.on_file_data(text)
+                return
+            # The line's newline goes out with the next piece, as for any line
+            self.handler.on_file_data(text[:newline])
+            self._streaming = False
+            text = text[newline + 1:]
+        
+        newline = text.rfind("\n")
+        if newline < 0:
+            self._add_partial(text)
+            return
+        
+        if self._partial:
+            self._partial.append(text)
+            buf = "".join(self._partial)
+            newline += len(buf) - len(text)
+        else:
+            buf = text
+        self._partial = []
+        self._head = ""
+        self._hold = False
+        self._scan(buf, newline)
+        self._add_partial(buf[newline + 1:])
+    
+    def close(self) -> None:
+        """Handle the final line and end any open block"""
+        if self._closed:
+            return
+        self._closed = True
+        
+        if self._streaming:
+            self._streaming = False
+        else:
+            # Mirror str.split: the text after the last newline is always a line
+            self._line("".join(self._partial))
+        self._partial = []
+        self._end_block()
+    
+    def _add_partial(self, text: str) -> None:
+        """Keep text of a line that has not ended, streaming it once it is known to be FILE content"""
+        if not text:
+            return
+        self._partial.append(text)
+        if self._hold or self._mode != "FILE":
+            return
+        if len(self._head) < self.HEAD_CHARS:
+            self._head += text[:self.HEAD_CHARS - len(self._head)]
+        head = self._head
+        undecided = any(marker.startswith(head) for marker in self.MARKERS)
+        if not undecided and (self._awaiting_fence or self._fence is not None):
+            # The first line of a block can open a fence, and inside one a fence line can close it
+            fence = self._FENCE_START_RE.match(head)
+            if len(fence.group(1) or "") >= 3:
+                self._hold = True
+                return
+            undecided = fence.end() == len(head)
+        if undecided:
+            if len(head) >= self.HEAD_CHARS:
+                self._hold = True
+            return
+        if head.startswith(self.MARKERS):
+            self._hold = True
+            return
+        if self._awaiting_fence:
+            self._awaiting_fence = False
+            self._flush_leading_blanks()
+        self._file_data("".join(self._partial))
+        self._partial = []
+        self._head = ""
+        self._streaming = True
+    
+    def _scan(self, buf: str, end: int) -> None:
+        """Handle the complete lines in buf[:end + 1]; buf[end] is a newline"""
+        pos = 0
+        next_markers = [-1] * len(self._LINE_MARKERS)  # Last find() result per marker
+        while pos <= end:
+            if (self._mode == "FILE" and not self._awaiting_fence
+                    and not self._INTERESTING_LINE_RE.match(buf, pos)):
+                # Bulk path: plain content up to the next interesting line
+                if self._fence is None:
+                    stop = self._next_marker(buf, pos, end, next_markers)
+                else:
+                    match = self._NEXT_INTERESTING_RE.search(buf, pos, end)
+                    stop = match.start() if match else end
+                self._file_data(buf[pos:stop])
+                pos = stop + 1
+                continue
+            
+            line_end = buf.index("\n", pos)
+            self._line(buf[pos:line_end])
+            pos = line_end + 1
+    
+    def _next_marker(self, buf: str, pos: int, end: int, next_markers: List[int]) -> int:
+        """Index of the newline before the next marker line in buf[pos:end], else end
+        
+        next_markers caches earlier find() results so that scanning a buffer
+        with many blocks stays linear.
+        """
+        stop = end
+        for i, marker in enumerate(self._LINE_MARKERS):
+            found = next_markers[i]
+            if found < pos:
+                found = buf.find(marker, pos, end)
+                if found < 0:
+                    found = end
+                next_markers[i] = found
+            if found < stop:
+                stop = found
+        return stop
+    
+    def _line(self, line: str) -> None:
+        """Handle a single complete line"""
+        if line.startswith(self.MARKERS):
+            self._marker(line)
+            return
+        
+        if self._mode is None:
+            self.handler.on_text(line)
+            return
+        
+        if self._awaiting_fence:
+            if not line.strip():
+                self._leading_blanks += 1
+                return
+            self._awaiting_fence = False
+            fence = self._FENCE_RE.match(line)
+            if fence:
+                self._fence = fence.group(1)
+                self._leading_blanks = 0
+                return
+            self._flush_leading_blanks()
+        
+        elif self._fence is not None:
+            fence = self._FENCE_RE.match(line)
+            if fence and fence.group(1)[0] == self._fence[0]:
+                if fence.group(2):
+                    self._fence_depth += 1
+                elif self._fence_depth:
+                    self._fence_depth -= 1
+                elif len(fence.group(1)) >= len(self._fence):
+                    # The closing fence terminates the last content line
+                    if self._mode == "FILE" and self._has_data:
+                        self.handler.on_file_data("\n")
+                    self._end_block()
+                    return
+        
+        if self._mode == "FILE":
+            self._file_data(line)
+        else:
+            self._patch_lines.append(line)
+    
+    def _marker(self, line: str) -> None:
+        self._end_block()
+        if line.startswith("FILE: "):
+            self._open_block("FILE", line[6:].strip())
+            self.handler.on_file_start(self._path)
+        elif line.startswith("PATCH: "):
+            self._open_block("PATCH", line[7:].strip())
+        elif line.startswith("DIR: "):
+            self.handler.on_dir(line[5:].strip())
+        else:
+            self.handler.on_cmd(line[5:].strip())
+    
+    def _open_block(self, mode: str, path: str) -> None:
+        self._mode = mode
+        self._path = path
+        self._awaiting_fence = True
+    
+    def _file_data(self, text: str) -> None:
+        """Report whole lines of FILE content, newline-separated from earlier ones"""
+        if self._has_data:
+            text = "\n" + text
+        self._has_data = True
+        self.handler.on_file_data(text)
+    
+    def _flush_leading_blanks(self) -> None:
+        """Blank lines held back while looking for an opening fence are content"""
+        blanks, self._leading_blanks = self._leading_blanks, 0
+        for _ in range(blanks):
+            if self._mode == "FILE":
+                self._file_data("")
+            else:
+                self._patch_lines.append("")
+    
+    def _end_block(self) -> None:
+        """Finish the open FILE or PATCH block, if any"""
+        if self._mode is None:
+            return
+        if self._awaiting_fence:
+            self._flush_leading_blanks()
+        
+        if self._mode == "FILE":
+            self.handler.on_file_end()
+        else:
+            self.handler.on_patch(self._path, "\n".join(self._patch_lines))
+        
+        self._mode = None
+        self._path = None
+        self._has_data = False
+        self._patch_lines = []
+        self._awaiting_fence = False
+        self._fence = None
+        self._fence_depth = 0
+
+class StreamingActionEngine:
+    """Applies FILE/PATCH/DIR/CMD blocks while a response streams in
+
+    Text is fed chunk by chunk to a ResponseParser, and the engine acts on
+    what it reports: explanation lines are printed once, CMD markers are
+    acted on as soon as they arrive, and FILE content is streamed to disk
+    while it is generated. PATCH blocks are applied to the current file
+    content when they close; the paths of patches that could not be applied
+    end up in failed_patches.
+    
+    CMD actions go to a CommandScheduler, which runs independent commands in
+    parallel and reports their timings once the response is done.
+    
+    FILE and DIR actions are staged in an ApplyTransaction and committed as a
+    unit when a CMD needs them or the response ends, so a failure partway
+    through never leaves the project half-written. If staging fails, the
+    staged actions are rolled back and the rest of the response is not
+    applied. File I/O is handed to the agent's WriteBehindPool in batches of
+    up to WRITE_BATCH_CHARS, so parsing never waits on the disk.
+    """
+    
+    WRITE_BATCH_CHARS = 64 * 1024
+    
+    def __init__(self, agent: "AICodingAgent"):
+        self.agent = agent
+        self.out = agent.renderer
+        self.pool = agent.get_write_pool()
+        self.parser = ResponseParser(self)
+        self._file = None  # _PendingFile for the open FILE block
+        self.failed_patches = []
+        self._batch = []
+        self._batch_chars = 0
+        self._transaction = None  # ApplyTransaction for actions since the last CMD
+        self._write_failures = []
+        self.scheduler = CommandScheduler(self._run_command, agent.config["command_concurrency"])
+        self._failed = False
+        self._closed = False
+    
+    def feed(self, text: str) -> None:
+        """Consume a chunk of streamed text, acting on every completed line"""
+        self.parser.feed(text)
+    
+    def close(self) -> None:
+        """Finish parsing and commit everything still staged"""
+        if self._closed:
+            return
+        self._closed = True
+        
+        self.parser.close()
+        self._commit()
+        self.scheduler.wait_all()
+        self.scheduler.report(self.out.line)
+        self.out.flush()
+    
+    def abort(self) -> None:
+        """Roll back staged actions, e.g. when the stream fails"""
+        self._closed = True
+        self.scheduler.cancel_pending()
+        if self._file and self._file.has_content:
+            self.pool.submit(self._file.key, self._close_file, self._file)
+        self._reset_file()
+        self._drain()
+        self._report_failures(self._write_failures)
+        self._write_failures = []
+        
+        if self._transaction is not None:
+            dropped = self._transaction.rollback()
+            self._transaction = None
+            if dropped:
+                self.out.line(f"↩️  Discarded {dropped} unapplied change(s) from the interrupted response")
+        self.scheduler.wait_all()
+        self.out.flush()
+    
+    # ResponseParser handler methods
+    
+    def on_text(self, line: str) -> None:
+        # Just print other lines as the AI's explanation
+        self.out.line(line)
+    
+    def on_file_start(self, path: str) -> None:
+        """Open a new FILE block, unless a failure stopped applying actions"""
+        if self._failed or not path:
+            return
+        self._file = _PendingFile(path, self._get_transaction())
+    
+    def on_file_data(self, text: str) -> None:
+        """Queue content of the open FILE block for writing"""
+        pending = self._file
+        if pending is None:
+            return
+        
+        if not pending.has_content:
+            # Only FILE blocks with content are staged
+            try:
+                pending.staged_path = pending.transaction.stage_file(pending.path)
+            except Exception as e:
+                self.out.line(f"❌ Error writing file {pending.path}: {e}")
+                self._file = None
+                return
+            pending.has_content = True
+            self.pool.submit(pending.key, self._open_file, pending)
+        
+        self._batch.append(text)
+        self._batch_chars += len(text)
+        if self._batch_chars >= self.WRITE_BATCH_CHARS:
+            self._flush_batch()
+    
+    def on_file_end(self) -> None:
+        """Queue the open FILE block to be closed"""
+        if self._file and self._file.has_content:
+            self._flush_batch()
+            self.pool.submit(self._file.key, self._close_file, self._file)
+        self._reset_file()
+    
+    def on_patch(self, path: str, body: str) -> None:
+        if path and not self._failed:
+            self._apply_patch(path, body)
+    
+    def on_dir(self, dir_path: str) -> None:
+        if not self._failed:
+            self._stage_directory(dir_path)
+    
+    def on_cmd(self, command: str) -> None:
+        # Commands may depend on the files written before them
+        self._commit()
+        if not self._failed:
+            command, cwd, after = parse_command(command)
+            self.scheduler.submit(command, cwd, after)
+    
+    def _get_transaction(self) -> ApplyTransaction:
+        if self._transaction is None:
+            self._transaction = self.agent.begin_apply()
+        return self._transaction
+    
+    def _stage_directory(self, dir_path: str) -> None:
+        try:
+            self._get_transaction().stage_directory(dir_path)
+        except Exception as e:
+            self.out.line(f"❌ Error creating directory {dir_path}: {e}")
+    
+    def _flush_batch(self) -> None:
+        """Hand the buffered lines of the open FILE block to the write pool"""
+        if self._batch:
+            self.pool.submit(self._file.key, self._write_file, self._file, ''.join(self._batch))
+            self._batch = []
+            self._batch_chars = 0
+    
+    def _reset_file(self) -> None:
+        """Forget the current FILE block"""
+        self._file = None
+        self._batch = []
+        self._batch_chars = 0
+    
+    def _apply_patch(self, path: str, body: str) -> None:
+        """Apply a PATCH block to the file's latest content and stage the result"""
+        transaction = self._get_transaction()
+        try:
+            hunks = parse_patch(body)
+            
+            # Patch the version staged earlier in this response, if there is one
+            source = transaction.staged_path(path)
+            if source is not None:
+                self._drain()
+            else:
+                self.scheduler.wait_for_paths([path])
+                source = os.path.join(self.agent.project_path, os.path.normpath(path))
+            with open(source, 'r', encoding='utf-8', newline='') as f:
+                content = f.read()
+            
+            content, fuzzy_hunks = apply_patch(content, hunks)
+            staged_path = transaction.stage_file(path, count_duplicate=False)
+        except (PatchError, OSError, ValueError) as e:
+            self.out.line(f"❌ Could not apply PATCH to {path}: {e}")
+            self.failed_patches.append(path)
+            return
+        
+        if fuzzy_hunks:
+            self.out.line(f"⚠️  Applied {fuzzy_hunks} hunk(s) to {path} by fuzzy matching")
+        
+        pending = _PendingFile(path, transaction)
+        pending.staged_path = staged_path
+        pending.has_content = True
+        pending.newline = ''
+        self.pool.submit(pending.key, self._open_file, pending)
+        self.pool.submit(pending.key, self._write_file, pending, content)
+        self.pool.submit(pending.key, self._close_file, pending)
+    
+    def _drain(self) -> None:
+        """Wait for queued writes, keeping their failures for the next commit"""
+        self._write_failures.extend(self.pool.drain())
+    
+    def _commit(self) -> None:
+        """Wait for staged writes, then apply the transaction or roll it back"""
+        self._drain()
+        failures, self._write_failures = self._write_failures, []
+        transaction, self._transaction = self._transaction, None
+        if transaction is None:
+            self._report_failures(failures)
+            return
+        
+        if not failures:
+            # Earlier commands working where these files land must finish first
+            self.scheduler.wait_for_paths(transaction.paths())
+            try:
+                files, unchanged, dirs = transaction.commit(self.pool)
+            except CommitError as e:
+                failures = [(e.path, e.error)]
+            except Exception as e:
+                failures = [(self.agent.project_path, e)]
+            else:
+                for dir_path in dirs:
+                    self.out.line(f"✅ Created directory: {dir_path}")
+                for file_path in files:
+                    self.out.line(f"✅ Created/Updated file: {file_path}")
+                self.agent.invalidate_cache(files)
+                self.agent.skipped_writes += len(unchanged) + transaction.duplicates
+                if unchanged:
+                    self.out.line(f"⏭️  Skipped {len(unchanged)} unchanged file(s)")
+                if transaction.duplicates:
+                    self.out.line(f"⏭️  Collapsed {transaction.duplicates} repeated FILE block(s)")
+                return
+        
+        self._report_failures(failures)
+        dropped = transaction.rollback()
+        self._failed = True
+        self.out.line(f"↩️  Rolled back {dropped} staged change(s); the rest of this response was not applied")
+    
+    def _report_failures(self, failures: List[Tuple[str, Exception]]) -> None:
+        for path, error in failures:
+            self.out.line(f"❌ Error writing file {path}: {error}")
+    
+    # The methods below run on write pool threads
+    
+    def _open_file(self, pending: _PendingFile) -> None:
+        pending.stream = pending.transaction.open_staged(pending.staged_path, pending.newline)
+    
+    def _write_file(self, pending: _PendingFile, text: str) -> None:
+        if pending.stream:
+            pending.stream.write(text)
+    
+    def _close_file(self, pending: _PendingFile) -> None:
+        if pending.stream:
+            pending.stream.close()
+            pending.transaction.record_digest(pending.path, pending.stream.hexdigest())
+            pending.stream = None
+    
+    def _run_command(self, command: str, cwd: str = os.curdir) -> None:
+        """Execute a CMD marker and report its outcome (runs on a scheduler thread)"""
+        stdout, stderr, return_code = self.agent.execute_command(command)
+        
+        # Build the report first so concurrent commands do not interleave lines
+        if return_code == 0:
+            report = [f"✅ Executed command: {command}"]
+            if stdout:
+                report.append(f"Output: {stdout[:200]}{'...' if len(stdout) > 200 else ''}")
+        else:
+            report = [f"❌ Command failed: {command}"]
+            if stderr:
+                report.append(f"Error: {stderr[:200]}{'...' if len(stderr) > 200 else ''}")
+        self.out.line('\n'.join(report))
+
+_IDENTIFIER_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+_SUBWORD_RE = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+")
+
+@lru_cache(maxsize=1 << 16)
+def _identifier_words(identifier: str) -> Tuple[str, ...]:
+    """An identifier lowercased, plus its camelCase and snake_case parts"""
+    words = [identifier.lower()]
+    if not (identifier.isalpha() and identifier.islower()):
+        parts = _SUBWORD_RE.findall(identifier)
+        if len(parts) > 1:
+            words.extend(part.lower() for part in parts)
+    return tuple(word for word in words if len(word) > 1)
+
+def index_terms(text: str) -> Dict[str, int]:
+    """Term counts of the identifiers and words in text"""
+    counts = {}
+    for identifier, count in Counter(_IDENTIFIER_RE.findall(text)).items():
+        for word in _identifier_words(identifier):
+            counts[word] = counts.get(word, 0) + count
+    return counts
+
+class RelevanceIndex:
+    """On-disk BM25 index over the words and identifiers in project files
+    
+    Documents get integer ids, and each term maps to two parallel arrays
+    of document ids and term frequencies. A changed file is indexed again
+    under a new id and its old id is marked dead (length 0), so updating
+    never has to search the postings; dead ids are squeezed out once they
+    make up half of all ids.
+    
+    On disk the index is a JSON header (paths, lengths and the offset of
+    each term's postings) plus one binary blob of all postings, loaded
+    lazily term by term, and an append-only log of the changes since the
+    blob was written. The log is folded into a new blob once it grows past
+    a fifth of the index, or at once if the saved index could not be used
+    (another version or vector setting, a short blob, a torn log). With
+    NumPy, scoring is vectorized and can be mixed with the cosine similarity
+    of hashed term vectors; without it, plain BM25 runs in pure Python.
+    """
+    
+    VERSION = 1
+    K1 = 1.2
+    B = 0.75
+    MAX_BYTES = 256 * 1024  # only the start of bigger files is indexed
+    VECTOR_DIMS = 256
+    
+    def __init__(self, root: str, store_path: str, vector_weight: float = 0.0):
+        self.root = root
+        self.store_path = store_path  # path without extension
+        self.vector_weight = vector_weight if np is not None else 0.0
+        self.paths = []  # doc id -> path, None once the document is dead
+        self.sigs = []  # doc id -> [size, mtime_ns] of the indexed content
+        self.lengths = array('i')  # doc id -> number of terms, 0 once dead
+        self.ids = {}  # path -> live doc id
+        self.postings = {}  # term -> (doc id array, term frequency array)
+        self.total_length = 0
+        self.dead = 0
+        self._raw = {}  # term -> (offset, count) of postings not yet read from _blob
+        self._blob = b""
+        self._vectors = None  # NumPy matrix with one row per doc id...
+        self._new_vectors = []  # ...and rows not yet stacked onto it
+        self._pending = []  # log records not yet saved
+        self._log_entries = 0
+        self._loaded = False
+        self._stale = False  # the saved index could not be used in full; rewrite it on save
+        self._lock = threading.RLock()
+    
+    def load(self) -> None:
+        """Read the saved index and replay its log, once"""
+        if self._loaded:
+            return
+        self._loaded = True
+        # Until the header and blob are accepted, whatever is on disk is of no use
+        self._stale = True
+        try:
+            with open(self.store_path + ".json", 'r', encoding='utf-8') as f:
+                header = json.load(f)
+            if (header.get("version") != self.VERSION or header.get("root") != self.root
+                    or header.get("vectors") != bool(self.vector_weight)):
+                return
+            with open(self.store_path + ".bin", 'rb') as f:
+                blob = f.read()
+            if len(blob) != header["blob_size"]:
+                return
+            vectors = None
+            if self.vector_weight:
+                vectors = np.load(self.store_path + ".npy")
+                if len(vectors) != len(header["paths"]):
+                    return
+        except (OSError, ValueError, KeyError):
+            return
+        
+        self.paths = header["paths"]
+        self.sigs = header["sigs"]
+        self.lengths = array('i', header["lengths"])
+        self._raw = header["terms"]
+        self._blob = memoryview(blob)
+        self._vectors = vectors
+        self.ids = {path: doc for doc, path in enumerate(self.paths) if path is not None}
+        self.total_length = sum(self.lengths)
+        self.dead = len(self.paths) - len(self.ids)
+        self._stale = False
+        
+        try:
+            with open(self.store_path + ".log", 'r', encoding='utf-8') as f:
+                for line in f:
+                    # A torn last line from an interrupted save ends the replay
+                    record = json.loads(line)
+                    self._remove(record["path"], log=False)
+                    if "terms" in record:
+                        self._add(record["path"], record["sig"], record["terms"], log=False)
+                    self._log_entries += 1
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError):
+            self._stale = True  # records appended after a torn line would never be replayed
+    
+    def update(self, files: List[str], manifest: ProjectManifest) -> int:
+        """Index new and changed files among files and drop all others, returning how many were read"""
+        with self._lock:
+            self.load()
+            wanted = set(files)
+            for path in [path for path in self.ids if path not in wanted]:
+                self._remove(path)
+            
+            changed = []
+            for path in files:
+                entry = manifest.files.get(path)
+                if entry is None:
+                    continue
+                doc = self.ids.get(path)
+                if doc is None or self.sigs[doc] != entry[:2]:
+                    changed.append((path, entry[:2]))
+            if len(changed) > 500:
+                print(f"🔎 Indexing {len(changed)} files for relevance search...")
+            for path, sig in changed:
+                try:
+                    with open(os.path.join(self.root, path), 'rb') as f:
+                        text = f.read(self.MAX_BYTES).decode('utf-8', errors='ignore')
+                except OSError:
+                    self._remove(path)
+                    continue
+                self._remove(path)
+                self._add(path, sig, index_terms(text))
+            return len(changed)
+    
+    def _add(self, path: str, sig: list, terms: Dict[str, int], log: bool = True) -> None:
+        doc = len(self.paths)
+        self.paths.append(path)
+        self.sigs.append(sig)
+        length = sum(terms.values())
+        self.lengths.append(length)
+        self.total_length += length
+        self.ids[path] = doc
+        postings = self.postings
+        for term, count in terms.items():
+            entry = postings.get(term) or self._postings(term, create=True)
+            entry[0].append(doc)
+            entry[1].append(count)
+        if self.vector_weight:
+            self._new_vectors.append(self._hash_vector(terms))
+        if log:
+            self._pending.append({"path": path, "sig": sig, "terms": terms})
+    
+    def _remove(self, path: str, log: bool = True) -> None:
+        doc = self.ids.pop(path, None)
+        if doc is None:
+            return
+        self.total_length -= self.lengths[doc]
+        self.lengths[doc] = 0
+        self.paths[doc] = None
+        self.dead += 1
+        if log:
+            self._pending.append({"path": path})
+    
+    def _postings(self, term: str, create: bool = False) -> Optional[Tuple[array, array]]:
+        """The postings of a term, reading them from the blob on first use"""
+        postings = self.postings.get(term)
+        if postings is None:
+            raw = self._raw.pop(term, None)
+            if raw is None and not create:
+                return None
+            postings = (array('i'), array('i'))
+            if raw is not None:
+                offset, count = raw
+                postings[0].frombytes(self._blob[offset:offset + 4 * count])
+                postings[1].frombytes(self._blob[offset + 4 * count:offset + 8 * count])
+            self.postings[term] = postings
+        return postings
+    
+    def _hash_vector(self, terms: Dict[str, int]) -> "np.ndarray":
+        """Unit vector of log-scaled term counts hashed into VECTOR_DIMS signed buckets"""
+        row = np.zeros(self.VECTOR_DIMS, dtype=np.float32)
+        for term, count in terms.items():
+            # crc32 rather than hash(), which changes from one run to the next
+            bucket = zlib.crc32(term.encode('utf-8'))
+            row[bucket % self.VECTOR_DIMS] += (1.0 + math.log(count)) * (1 if bucket & 0x80000000 else -1)
+        norm = np.linalg.norm(row)
+        return row / norm if norm else row
+    
+    def _stack_vectors(self) -> None:
+        if self._new_vectors:
+            stacked = np.vstack(self._new_vectors)
+            self._vectors = stacked if self._vectors is None else np.vstack([self._vectors, stacked])
+            self._new_vectors = []
+    
+    def search(self, query: str, limit: int = 50) -> List[Tuple[str, float]]:
+        """The files best matching query, best first, as (path, score) with scores scaled to at most 1.0"""
+        with self._lock:
+            self.load()
+            terms = index_terms(query)
+            live = len(self.ids)
+            if not terms or not live:
+                return []
+            average_length = self.total_length / live
+            
+            if np is None:
+                return self._search_python(terms, live, average_length, limit)
+            
+            lengths = np.frombuffer(self.lengths, dtype=np.int32) if self.lengths else np.zeros(0, np.int32)
+            scores = np.zeros(len(lengths), dtype=np.float32)
+            for term in terms:
+                postings = self._postings(term)
+                if postings is None:
+                    continue
+                ids = np.frombuffer(postings[0], dtype=np.int32)
+                counts = np.frombuffer(postings[1], dtype=np.int32)
+                # Dead documents have length 0 and are left out
+                alive = lengths[ids] > 0
+                ids, counts = ids[alive], counts[alive].astype(np.float32)
+                if not len(ids):
+                    continue
+                idf = math.log(1 + (live - len(ids) + 0.5) / (len(ids) + 0.5))
+                norm = self.K1 * (1 - self.B + self.B * lengths[ids] / average_length)
+                # Each document appears once per term, so fancy-index += is safe
+                scores[ids] += idf * counts * (self.K1 + 1) / (counts + norm)
+            
+            top = scores.max() if len(scores) else 0
+            if top <= 0:
+                return []
+            scores /= top
+            if self.vector_weight:
+                self._stack_vectors()
+                similarity = self._vectors @ self._hash_vector(terms)
+                similarity[lengths == 0] = 0
+                scores = (1 - self.vector_weight) * scores + self.vector_weight * np.maximum(similarity, 0)
+            
+            best = np.argpartition(-scores, limit)[:limit] if len(scores) > limit else range(len(scores))
+            best = sorted(best, key=lambda doc: -scores[doc])
+            return [(self.paths[doc], float(scores[doc])) for doc in best if scores[doc] > 0]
+    
+    def _search_python(self, terms: Dict[str, int], live: int, average_length: float,
+                       limit: int) -> List[Tuple[str, float]]:
+        scores = {}
+        lengths = self.lengths
+        for term in terms:
+            postings = self._postings(term)
+            if postings is None:
+                continue
+            # Terms in most files barely move the ranking but cost the most here
+            if len(postings[0]) > live // 2 and live > 100:
+                continue
+            matches = [(doc, count) for doc, count in zip(*postings) if lengths[doc]]
+            idf = math.log(1 + (live - len(matches) + 0.5) / (len(matches) + 0.5))
+            for doc, count in matches:
+                norm = self.K1 * (1 - self.B + self.B * lengths[doc] / average_length)
+                scores[doc] = scores.get(doc, 0.0) + idf * count * (self.K1 + 1) / (count + norm)
+        best = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+        if not best:
+            return []
+        top = best[0][1]
+        return [(self.paths[doc], score / top) for doc, score in best]
+    
+    def save(self) -> None:
+        """Append pending changes to the log, or rewrite the index once the log is long"""
+        with self._lock:
+            if not self._pending and not self._stale:
+                return
+            directory = os.path.dirname(self.store_path)
+            os.makedirs(directory, exist_ok=True)
+            if (self._stale or not os.path.exists(self.store_path + ".json")
+                    or self._log_entries + len(self._pending) > max(1000, len(self.ids) // 5)):
+                self._write_base()
+            else:
+                with open(self.store_path + ".log", 'a', encoding='utf-8') as f:
+                    f.write("".join(json.dumps(record, separators=(',', ':')) + "\n"
+                                    for record in self._pending))
+                self._log_entries += len(self._pending)
+            self._pending = []
+    
+    def _write_base(self) -> None:
+        """Write the whole index as a new header and blob, and clear the log"""
+        self._stack_vectors()
+        if self.dead > len(self.paths) // 2:
+            self._compact()
+        
+        terms = {}
+        offset = 0
+        blob = bytearray()
+        for term, (start, count) in self._raw.items():
+            blob += self._blob[start:start + 8 * count]
+            terms[term] = (offset, count)
+            offset += 8 * count
+        for term, (ids, counts) in self.postings.items():
+            if ids:
+                blob += ids.tobytes()
+                blob += counts.tobytes()
+                terms[term] = (offset, len(ids))
+                offset += 8 * len(ids)
+        header = {"version": self.VERSION, "root": self.root, "vectors": bool(self.vector_weight),
+                  "blob_size": offset, "paths": self.paths, "sigs": self.sigs,
+                  "lengths": self.lengths.tolist(), "terms": terms}
+        
+        _atomic_write(self.store_path + ".bin", blob)
+        del blob
+        if self.vector_weight:
+            buffer = io.BytesIO()
+            np.save(buffer, self._vectors)
+            _atomic_write(self.store_path + ".npy", buffer.getvalue())
+        _atomic_write(self.store_path + ".json", json.dumps(header, separators=(',', ':')))
+        if os.path.exists(self.store_path + ".log"):
+            os.unlink(self.store_path + ".log")
+        self._log_entries = 0
+        self._stale = False
+        # Later reads come from the new blob
+        with open(self.store_path + ".bin", 'rb') as f:
+            self._blob = memoryview(f.read())
+        self._raw = terms
+        self.postings = {}
+    
+    def _compact(self) -> None:
+        """Renumber the live documents, dropping dead ids from every posting list"""
+        renumber = {}
+        for doc, path in enumerate(self.paths):
+            if path is not None:
+                renumber[doc] = len(renumber)
+        for term in list(self._raw):
+            self._postings(term)
+        for term, (ids, counts) in list(self.postings.items()):
+            kept = [(renumber[doc], count) for doc, count in zip(ids, counts) if doc in renumber]
+            if kept:
+                self.postings[term] = (array('i', [doc for doc, _ in kept]), array('i', [count for _, count in kept]))
+            else:
+                del self.postings[term]
+        live = list(renumber)
+        if self._vectors is not None:
+            self._vectors = self._vectors[live]
+        self.paths = [self.paths[doc] for doc in live]
+        self.sigs = [self.sigs[doc] for doc in live]
+        self.lengths = array('i', [self.lengths[doc] for doc in live])
+        self.ids = {path: doc for doc, path in enumerate(self.paths)}
+        self.dead = 0
+
+def _common_prefix_length(a: bytes, b: bytes) -> int:
+    """Length of the longest common prefix of a and b"""
+    # Binary search over slice comparisons, which run in C
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[low:middle] == b[low:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count of text, at about four characters per token"""
+    return (len(text) + 3) // 4
+
+_WORD_RE = re.compile(r"[A-Za-z]+")
+_SYMBOL_RE = re.compile(r"[^\w\s]")
+
+class TokenEstimator:
+    """Local token counts from a linear model of a few text features
+    
+    features() counts characters, ASCII words, digits, symbols, newlines and
+    non-ASCII characters; a count is their dot product with coefficients.
+    The coefficients start at four characters per token and are refitted
+    by fit() from samples of real prompts: the features of everything sent
+    and the prompt token count from the response's usage metadata, which
+    is what count_tokens would return for the same prompt. Features add up,
+    so a file's can be computed once per content (ProjectManifest keeps
+    them) and combined with those of the text around it.
+    """
+    
+    VERSION = 1
+    FEATURES = ("chars", "words", "digits", "symbols", "newlines", "non-ASCII")
+    DEFAULT = (0.25, 0.0, 0.0, 0.0, 0.0, 0.0)
+    MAX_SAMPLES = 1000  # oldest dropped first
+    MIN_SAMPLES = 3  # fewer than this are not enough to fit
+    RIDGE = 0.01  # pull toward the current coefficients, so a few samples cannot swing them far
+    
+    def __init__(self, store_path: Optional[str] = None):
+        self.store_path = store_path
+        self.coefficients = list(self.DEFAULT)
+        self.samples = []  # [features..., tokens]
+        self._lock = threading.Lock()
+        self._dirty = False
+        self.load()
+    
+    @staticmethod
+    def features(text: str) -> List[int]:
+        non_ascii = 0 if text.isascii() else len(text) - len(text.encode('ascii', 'ignore'))
+        return [
+            len(text),
+            len(_WORD_RE.findall(text)),
+            sum(text.count(digit) for digit in "0123456789"),
+            len(_SYMBOL_RE.findall(text)),
+            text.count('\n'),
+            non_ascii,
+        ]
+    
+    @staticmethod
+    def combine(*feature_lists: List[int]) -> List[int]:
+        return [sum(values) for values in zip(*feature_lists)]
+    
+    def count_features(self, features: List[int]) -> int:
+        return max(0, round(sum(c * f for c, f in zip(self.coefficients, features))))
+    
+    def count(self, text: str) -> int:
+        """Estimated token count of text"""
+        return self.count_features(self.features(text))
+    
+    def record(self, features: List[int], tokens: int) -> None:
+        """Keep a sample of a prompt's features and its actual token count for fit()"""
+        if tokens <= 0:
+            return
+        with self._lock:
+            self.samples.append(list(features) + [tokens])
+            del self.samples[:-self.MAX_SAMPLES]
+            self._dirty = True
+    
+    def error(self, coefficients: Optional[List[float]] = None) -> float:
+        """Mean relative error of the estimates over the samples"""
+        coefficients = coefficients or self.coefficients
+        if not self.samples:
+            return 0.0
+        return sum(abs(sum(c * f for c, f in zip(coefficients, sample)) - sample[-1]) / sample[-1]
+                   for sample in self.samples) / len(self.samples)
+    
+    def fit(self) -> Optional[Tuple[float, float]]:
+        """Refit the coefficients to the samples; returns the mean relative error before and after"""
+        if len(self.samples) < self.MIN_SAMPLES:
+            return None
+        before = self.error()
+        # Least squares of the relative error, ridge-regularized toward the
+        # current coefficients. Features no sample has keep their coefficient;
+        # ones that come out negative are dropped and the rest refitted.
+        count = len(self.samples)
+        scales = [sum(sample[i] / sample[-1] for sample in self.samples) / count
+                  for i in range(len(self.FEATURES))]
+        fitted = list(self.coefficients)
+        active = [i for i, scale in enumerate(scales) if scale > 0]
+        while active:
+            size = len(active)
+            matrix = [[0.0] * size for _ in range(size)]
+            vector = [0.0] * size
+            for sample in self.samples:
+                row = [sample[i] / sample[-1] for i in active]
+                for a in range(size):
+                    vector[a] += row[a]
+                    for b in range(size):
+                        matrix[a][b] += row[a] * row[b]
+            for a, i in enumerate(active):
+                penalty = self.RIDGE * count * scales[i] * scales[i]
+                matrix[a][a] += penalty
+                vector[a] += penalty * self.coefficients[i]
+            solution = _solve_linear(matrix, vector)
+            if solution is None:
+                return None
+            negative = {i for i, value in zip(active, solution) if value < 0}
+            for i, value in zip(active, solution):
+                fitted[i] = 0.0 if i in negative else value
+            if not negative:
+                break
+            active = [i for i in active if i not in negative]
+        after = self.error(fitted)
+        if after > before:
+            return before, before
+        with self._lock:
+            self.coefficients = fitted
+            self._dirty = True
+        return before, after
+    
+    def load(self) -> None:
+        if not self.store_path or not os.path.exists(self.store_path):
+            return
+        try:
+            with open(self.store_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get("version") == self.VERSION:
+                coefficients = [float(c) for c in data["coefficients"]]
+                if len(coefficients) == len(self.FEATURES):
+                    self.coefficients = coefficients
+                self.samples = [sample for sample in data["samples"] if len(sample) == len(self.FEATURES) + 1]
+        except (OSError, ValueError, KeyError, TypeError):
+            self.coefficients, self.samples = list(self.DEFAULT), []
+    
+    def save(self) -> None:
+        """Persist the coefficients and samples if either changed"""
+        with self._lock:
+            if not self.store_path or not self._dirty:
+                return
+            data = {"version": self.VERSION, "coefficients": self.coefficients, "samples": self.samples}
+            _atomic_write(self.store_path, json.dumps(data, separators=(',', ':')))
+            self._dirty = False
+
+def _solve_linear(matrix: List[List[float]], vector: List[float]) -> Optional[List[float]]:
+    """Solve matrix x = vector by Gaussian elimination with partial pivoting, None if singular"""
+    size = len(vector)
+    rows = [matrix[i][:] + [vector[i]] for i in range(size)]
+    for column in range(size):
+        pivot = max(range(column, size), key=lambda r: abs(rows[r][column]))
+        if abs(rows[pivot][column]) < 1e-12:
+            return None
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+        for r in range(column + 1, size):
+            factor = rows[r][column] / rows[column][column]
+            for c in range(column, size + 1):
+                rows[r][c] -= factor * rows[column][c]
+    solution = [0.0] * size
+    for r in range(size - 1, -1, -1):
+        solution[r] = (rows[r][size] - sum(rows[r][c] * solution[c] for c in range(r + 1, size))) / rows[r][r]
+    return solution
+
+# Words too common in requests to say anything about which files matter
+_STOPWORDS = frozenset("""
+    the and for with from into that this these those then than when what which where while
+    add make create update change fix use using should would could please also need want
+    file files code project new all any some can not but are was were has have will just
+    like more less each other them they you your our its get set let one two way work
+""".split())
+_TERM_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]{2,}")
+_PATHLIKE_RE = re.compile(r"[\w.\-/\\]*\.\w+")  # app.py, src/app.js, .env, .github/ci.yml
+_OUTLINE_RE = re.compile(
+    r"^\s*(?:export\s+)?(?:default\s+)?(?:async\s+)?"
+    r"(?:def|class|function|interface|struct|enum|fn|func|type)\b|^#{1,6} "
+)
+
+def _relative_reference(path: str) -> str:
+    """A path mentioned in a request, with forward slashes and no leading ./ prefix"""
+    path = path.replace('\\', '/')
+    while path.startswith('./'):
+        path = path[2:]
+    return path
+
+def outline_lines(lines: List[str]) -> str:
+    """Numbered definition lines of a file, one per line"""
+    return "\n".join(f"{number}: {line.rstrip()}" for number, line in enumerate(lines, 1)
+                     if _OUTLINE_RE.match(line))
+
+_SCRIPT_EXTENSIONS = frozenset({'.js', '.jsx', '.ts', '.tsx', '.mjs', '.cjs'})
+OUTLINE_LINE_CHARS = 160  # longer signature lines are cut
+
+def outline_kind(path: str) -> str:
+    """Which outliner extract_outline() uses for a path: python, script or lines"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.py', '.pyi'):
+        return "python"
+    if extension in _SCRIPT_EXTENSIONS:
+        return "script"
+    return "lines"
+
+def extract_outline(path: str, text: str) -> str:
+    """Imports, signatures and docstring summaries of a source file, as numbered lines"""
+    kind = outline_kind(path)
+    if kind == "python":
+        try:
+            return _python_outline(text)
+        except (SyntaxError, ValueError, RecursionError):
+            pass  # not valid Python after all; the patterns below still work
+    elif kind == "script":
+        return _script_outline(text)
+    return outline_lines(text.splitlines())
+
+def _python_outline(text: str) -> str:
+    """Outline of Python source from its syntax tree"""
+    tree = ast.parse(text)
+    lines = text.splitlines()
+    out = []
+    
+    def add(number: int, indent: str, line: str) -> None:
+        if len(line) > OUTLINE_LINE_CHARS:
+            line = line[:OUTLINE_LINE_CHARS - 3] + "..."
+        out.append(f"{number}: {indent}{line}")
+    
+    def header(node) -> str:
+        # Signature lines up to the one ending with ":" or holding the body, joined into one
+        parts = []
+        for number in range(node.lineno - 1, min(node.lineno + 9, max(node.body[0].lineno, node.lineno))):
+            code = lines[number].split('#', 1)[0].strip()
+            parts.append(code)
+            if code.endswith(':'):
+                break
+        return " ".join(part for part in parts if part)
+    
+    def docstring(node, indent: str) -> None:
+        doc = ast.get_docstring(node)
+        if doc and doc.strip():
+            add(node.body[0].lineno, indent, '"""' + doc.strip().splitlines()[0] + '"""')
+    
+    def visit(body: list, indent: str) -> None:
+        for node in body:
+            if isinstance(node, (ast.Import, ast.ImportFrom)):
+                add(node.lineno, indent, " ".join(" ".join(lines[number].split())
+                                                  for number in range(node.lineno - 1, node.end_lineno)))
+            elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                for decorator in node.decorator_list:
+                    add(decorator.lineno, indent, lines[decorator.lineno - 1].strip())
+                add(node.lineno, indent, header(node))
+                docstring(node, indent + "    ")
+                if isinstance(node, ast.ClassDef):
+                    visit(node.body, indent + "    ")
+            elif isinstance(node, (ast.Assign, ast.AnnAssign)) and not indent:
+                # Module constants, which other files tend to import
+                targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+                if any(isinstance(target, ast.Name) and target.id.isupper() for target in targets):
+                    add(node.lineno, indent, lines[node.lineno - 1].strip())
+            elif isinstance(node, (ast.If, ast.Try)) and not indent:
+                # Conditional imports and definitions at module level
+                visit(node.body, indent)
+                for handler in getattr(node, "handlers", []):
+                    visit(handler.body, indent)
+                visit(node.orelse, indent)
+    
+    if tree.body:
+        docstring(tree, "")
+    visit(tree.body, "")
+    return "\n".join(out)
+
+# Words that can start a declaration worth outlining in JS/TS
+_SCRIPT_DECLARATIONS = frozenset({
+    "import", "export", "function", "async", "class", "interface", "type", "enum",
+    "declare", "abstract", "namespace", "module",
+})
+_SCRIPT_VARIABLES = frozenset({"const", "let", "var"})
+# Tokens after which "/" starts a regular expression rather than a division
+_REGEX_PRECEDERS = frozenset("(,=:[!&|?{};+-*%<>~^") | {"", "return", "typeof", "case", "do", "else", "in", "of"}
+_SCRIPT_WORD_RE = re.compile(r"[A-Za-z_$][\w$]*")
+
+def _script_tokens(text: str) -> Iterator[Tuple[int, str]]:
+    """(line number, token) of JS/TS source, skipping strings, comments and regexes
+    
+    Only words and single punctuation characters are produced. A "/**" doc
+    comment is produced as a token of its own, starting with "/**", so the
+    outline can pick up its first line.
+    """
+    length = len(text)
+    line = 1
+    i = 0
+    previous = ""
+    templates = []  # brace depth inside each open template literal ${...}
+    while i < length:
+        char = text[i]
+        if char == '\n':
+            line += 1
+            i += 1
+        elif char in ' \t\r':
+            i += 1
+        elif char == '/' and text.startswith('//', i):
+            end = text.find('\n', i)
+            i = length if end < 0 else end
+        elif char == '/' and text.startswith('/*', i):
+            end = text.find('*/', i + 2)
+            end = length if end < 0 else end + 2
+            if text.startswith('/**', i):
+                yield line, text[i:end]
+            line += text.count('\n', i, end)
+            i = end
+        elif char in '\'"' or (char == '/' and previous in _REGEX_PRECEDERS):
+            # Strings and regexes end on their line, which limits the damage
+            # of a quote in JSX text or a misread division
+            i += 1
+            in_class = False
+            while i < length and text[i] != '\n':
+                if text[i] == '\\':
+                    i += 2
+                    continue
+                if char == '/' and text[i] in '[]':
+                    in_class = text[i] == '['
+                elif text[i] == char and not in_class:
+                    i += 1
+                    break
+                i += 1
+            previous = "literal"
+        elif char == '`' or (char == '}' and templates and templates[-1] == 0):
+            # Template literal text, up to its end or the next ${
+            if char == '}':
+                templates.pop()
+            i += 1
+            while i < length:
+                if text[i] == '\\':
+                    i += 2
+                    continue
+                if text[i] == '`':
+                    i += 1
+                    break
+                if text.startswith('${', i):
+                    templates.append(0)
+                    i += 2
+                    break
+                if text[i] == '\n':
+                    line += 1
+                i += 1
+            previous = "literal"
+        else:
+            match = _SCRIPT_WORD_RE.match(text, i)
+            if match:
+                previous = match.group()
+                i = match.end()
+            else:
+                previous = char
+                i += 1
+                if templates:
+                    if char == '{':
+                        templates[-1] += 1
+                    elif char == '}':
+                        templates[-1] -= 1
+            yield line, previous
+
+def _script_outline(text: str) -> str:
+    """Outline of JavaScript or TypeScript source from a token scan
+    
+    Lists the lines that start top-level declarations (imports, exports,
+    functions, classes, types, and variables holding functions or requires)
+    and the members of class bodies, each preceded by the first line of its
+    doc comment.
+    """
+    lines = text.splitlines()
+    out = []
+    recorded = set()
+    stack = []  # "class" for class and interface bodies, "block" for other braces, "group" for ( and [
+    pending_class = False
+    doc = None  # (line, first line) of the doc comment just before the current token
+    last, last_line = ";", 0
+    variable_line = None  # line of a top-level const/let/var, listed if it holds a function
+    
+    def add(number: int, doc: Optional[Tuple[int, str]]) -> None:
+        if number in recorded or number > len(lines):
+            return
+        recorded.add(number)
+        source = lines[number - 1].rstrip().rstrip('{').rstrip()
+        if len(source) > OUTLINE_LINE_CHARS:
+            source = source[:OUTLINE_LINE_CHARS - 3] + "..."
+        if doc:
+            indent = source[:len(source) - len(source.lstrip())]
+            out.append(f"{doc[0]}: {indent}/** {doc[1]} */")
+        out.append(f"{number}: {source}")
+    
+    for number, token in _script_tokens(text):
+        if token.startswith('/**'):
+            parts = [part.strip(' *') for part in token[3:-2].splitlines()]
+            summary = next((part for part in parts if part), None)
+            doc = (number, summary) if summary else None
+            continue
+        
+        # A statement starts after ; { } or, without semicolons, on a new line
+        starts = last in (';', '{', '}') or number != last_line
+        context = stack[-1] if stack else None
+        if starts and context is None:
+            variable_line = None
+            if token in _SCRIPT_DECLARATIONS:
+                add(number, doc)
+            elif token in _SCRIPT_VARIABLES:
+                variable_line = number
+        elif starts and context == "class" and (_SCRIPT_WORD_RE.match(token) or token in ('#', '[', '@', '*')):
+            add(number, doc)
+        if variable_line is not None and ((last, token) == ('=', '>') or token in ("function", "require", "class")):
+            add(variable_line, None)
+            variable_line = None
+        if token in ("class", "interface", "namespace", "module") and context in (None, "class"):
+            pending_class = True
+        
+        if token == '{':
+            stack.append("class" if pending_class else "block")
+            pending_class = False
+        elif token in ('(', '['):
+            stack.append("group")
+        elif token in ('}', ')', ']') and stack:
+            stack.pop()
+        doc = None
+        last, last_line = token, number
+    # Code wrapped in one function expression (UMD, IIFE) has no top level to speak of
+    return "\n".join(out) or outline_lines(lines)
+
+# References to a line of a file in stack traces and compiler messages
+_LINE_REF_RES = (
+    re.compile(r'File "([^"]+)", line (\d+)'),  # Python tracebacks
+    re.compile(r'([\w.\-/\\]+\.\w+):(\d+)'),  # path:line[:column], as node, go, rustc, gcc print them
+)
+
+def find_line_references(text: str) -> List[Tuple[str, int]]:
+    """(path, line number) of every stack-trace or compiler-style reference in text"""
+    references = []
+    for regex in _LINE_REF_RES:
+        for match in regex.finditer(text):
+            path = match.group(1).replace('\\', '/')
+            references.append((path, int(match.group(2))))
+    return references
+
+class ExcerptFinder:
+    """Picks the regions of a file that matter to a request, with line numbers
+    
+    Regions grow from hits: lines mentioning the request's words, and lines
+    that a stack trace or compiler message in the request points at. Each
+    hit is widened to its enclosing function or class when that is short
+    enough to show whole (found by indentation, so most languages work),
+    and otherwise to a few lines of context plus the enclosing definition
+    line. Hits on referenced lines come first, then definitions of the
+    words, then lines matching the most words, until MAX_LINES are used.
+    The file is read as bytes, memory-mapped from MMAP_BYTES on, and only
+    the lines around hits are ever decoded.
+    """
+    
+    MMAP_BYTES = 256 * 1024
+    MAX_BYTES = 64 * 1024 * 1024
+    MAX_HITS = 2000  # hits looked at, in file order
+    MAX_BLOCK_LINES = 80  # longer functions are not shown whole
+    MAX_LINES = 300
+    CONTEXT = 3  # lines kept around a hit outside a short block
+    CHUNK_BYTES = 1024 * 1024
+    
+    def find(self, path: str, terms: set, referenced: set) -> Tuple[int, str]:
+        """(line count, numbered excerpt) of the file at path; the excerpt is empty without hits"""
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return 0, ""
+            if size < self.MMAP_BYTES:
+                return self._find(f.read(), terms, referenced)
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                return self._find(buffer, terms, referenced)
+    
+    def _find(self, buffer, terms: set, referenced: set) -> Tuple[int, str]:
+        line_count = sum(buffer[start:start + self.CHUNK_BYTES].count(b'\n')
+                         for start in range(0, len(buffer), self.CHUNK_BYTES))
+        if buffer[-1:] != b'\n':
+            line_count += 1
+        
+        hits = []  # (priority, line start, line end)
+        for number in sorted(referenced):
+            start = self._line_offset(buffer, number)
+            if start is not None:
+                hits.append(((0, 0, start), start, self._line_end(buffer, start)))
+        if terms:
+            words = [term.encode('utf-8') for term in sorted(terms)]
+            pattern = re.compile(b"|".join(re.escape(word) for word in words), re.IGNORECASE)
+            position = 0
+            while len(hits) < self.MAX_HITS:
+                match = pattern.search(buffer, position)
+                if match is None:
+                    break
+                start = buffer.rfind(b'\n', 0, match.start()) + 1
+                end = self._line_end(buffer, match.start())
+                line = buffer[start:end].decode('utf-8', 'replace')
+                lowered = line.lower()
+                matched = sum(1 for term in terms if term in lowered)
+                defines = 1 if self._is_header(line) else 2
+                hits.append(((defines, -matched, start), start, end))
+                position = end + 1
+        if not hits:
+            return line_count, ""
+        
+        windows = []  # (start offset, end offset)
+        used = 0
+        for _, start, end in sorted(hits):
+            if used >= self.MAX_LINES:
+                break
+            if any(low <= start < high for low, high in windows):
+                continue
+            for window in self._windows(buffer, start, end):
+                windows.append(window)
+                used += buffer[window[0]:window[1]].count(b'\n') + 1
+        return line_count, self._render(buffer, windows)
+    
+    def _windows(self, buffer, start: int, end: int) -> List[Tuple[int, int]]:
+        """The enclosing short block of a hit line, or the hit with context and its definition line"""
+        header = self._enclosing_header(buffer, start)
+        if header is not None:
+            block_end = self._block_end(buffer, header)
+            if block_end is not None:
+                return [(header, block_end)]
+        low, high = start, end
+        for _ in range(self.CONTEXT):
+            if low > 0:
+                low = buffer.rfind(b'\n', 0, low - 1) + 1
+            if high < len(buffer):
+                high = self._line_end(buffer, high + 1)
+        windows = [(low, high)]
+        if header is not None and header < low:
+            windows.append((header, self._line_end(buffer, header)))
+        return windows
+    
+    def _enclosing_header(self, buffer, start: int) -> Optional[int]:
+        """Start of the definition line enclosing the line at start (or that line itself)"""
+        line = buffer[start:self._line_end(buffer, start)].decode('utf-8', 'replace')
+        if self._is_header(line):
+            return start
+        indent = self._indent(line)
+        for _ in range(self.MAX_BLOCK_LINES):
+            if start == 0 or indent == 0:
+                return None
+            start = buffer.rfind(b'\n', 0, start - 1) + 1
+            line = buffer[start:self._line_end(buffer, start)].decode('utf-8', 'replace')
+            if not line.strip():
+                continue
+            if self._indent(line) < indent:
+                if self._is_header(line):
+                    return start
+                indent = self._indent(line)
+        return None
+    
+    def _block_end(self, buffer, header: int) -> Optional[int]:
+        """End offset of the block opened at header, or None if it is too long"""
+        end = self._line_end(buffer, header)
+        indent = self._indent(buffer[header:end].decode('utf-8', 'replace'))
+        last = end
+        for _ in range(self.MAX_BLOCK_LINES):
+            if end >= len(buffer):
+                return last
+            start = end + 1
+            end = self._line_end(buffer, start)
+            line = buffer[start:end].decode('utf-8', 'replace')
+            if not line.strip():
+                continue
+            if self._indent(line) <= indent:
+                # A closing bracket at the header's indentation still belongs to it
+                return end if line.lstrip()[:1] in ('}', ')', ']') else last
+            last = end
+        return None
+    
+    def _render(self, buffer, windows: List[Tuple[int, int]]) -> str:
+        """Windows merged and numbered, with "..." where lines are left out"""
+        merged = []
+        for start, end in sorted(windows):
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        
+        parts = []
+        number = 1
+        position = 0
+        for start, end in merged:
+            number += buffer[position:start].count(b'\n')
+            position = start
+            if start > 0:
+                parts.append("...")
+            lines = buffer[start:end].decode('utf-8', 'replace').split('\n')
+            parts.extend(f"{number + index}: {line}".rstrip() for index, line in enumerate(lines))
+        content_end = len(buffer) - 1 if buffer[-1:] == b'\n' else len(buffer)
+        if merged[-1][1] < content_end:
+            parts.append("...")
+        return "\n".join(parts)
+    
+    def _line_offset(self, buffer, number: int) -> Optional[int]:
+        """Start offset of a 1-based line number, counting newlines a chunk at a time"""
+        position = 0
+        remaining = number - 1
+        while remaining > 0:
+            chunk = buffer[position:position + self.CHUNK_BYTES]
+            if not chunk:
+                return None
+            count = chunk.count(b'\n')
+            if count < remaining:
+                remaining -= count
+                position += len(chunk)
+                continue
+            for _ in range(remaining):
+                position = buffer.find(b'\n', position) + 1
+            remaining = 0
+        return position if position < len(buffer) else None
+    
+    @staticmethod
+    def _line_end(buffer, offset: int) -> int:
+        end = buffer.find(b'\n', offset)
+        return len(buffer) if end < 0 else end
+    
+    @staticmethod
+    def _indent(line: str) -> int:
+        expanded = line.expandtabs(4)
+        return len(expanded) - len(expanded.lstrip())
+    
+    @staticmethod
+    def _is_header(line: str) -> bool:
+        """Whether a line starts a function or class, by keyword or by shape (name(...) {)"""
+        if _OUTLINE_RE.match(line) and not line.lstrip().startswith('#'):
+            return True
+        stripped = line.strip()
+        return stripped.endswith('{') and ('(' in stripped or '=>' in stripped) and not stripped.startswith(
+            ('if', 'for', 'while', 'switch', 'catch', 'else', '}', 'return', 'try', 'do'))
+
+class DigestStore:
+    """Values derived from file contents, by SHA-256, kept across sessions
+    
+    What is derived only from a file's content is computed once per content
+    and shared between projects. Entries live in one JSON file, least
+    recently used first, and the oldest are dropped past MAX_ENTRIES.
+    Subclasses bump VERSION when the derived values change meaning.
+    """
+    
+    VERSION = 1
+    MAX_ENTRIES = 20000
+    
+    def __init__(self, store_path: str):
+        self.store_path = store_path
+        self.entries = None  # digest -> value, loaded on first use
+        self._dirty = False
+        self._lock = threading.Lock()
+    
+    def _load(self) -> None:
+        self.entries = {}
+        try:
+            with open(self.store_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get("version") == self.VERSION:
+                self.entries = data["entries"]
+        except (OSError, ValueError, KeyError):
+            pass  # missing or damaged: start over
+    
+    def lookup(self, digest: str):
+        """The value stored for digest, or None"""
+        with self._lock:
+            if self.entries is None:
+                self._load()
+            value = self.entries.pop(digest, None)
+            if value is not None:
+                self.entries[digest] = value  # most recently used last
+            return value
+    
+    def put(self, digest: str, value) -> None:
+        with self._lock:
+            if self.entries is None:
+                self._load()
+            self.entries.pop(digest, None)
+            while len(self.entries) >= self.MAX_ENTRIES:
+                del self.entries[next(iter(self.entries))]
+            self.entries[digest] = value
+            self._dirty = True
+    
+    def save(self) -> None:
+        """Persist the entries if any were added"""
+        with self._lock:
+            if not self._dirty:
+                return
+            _atomic_write(self.store_path,
+                          json.dumps({"version": self.VERSION, "entries": self.entries}, separators=(',', ':')))
+            self._dirty = False
+
+class OutlineCache(DigestStore):
+    """Outlines of file contents, by outline kind and SHA-256
+    
+    The same bytes outline differently as Python and as JavaScript, so
+    the key includes outline_kind() of the path. Bump VERSION when
+    extract_outline() changes its output.
+    """
+    
+    VERSION = 3
+    
+    def get(self, digest: str, path: str, read) -> Tuple[int, str]:
+        """(line count, outline) of the content with this digest, calling read() for the text if needed"""
+        key = f"{outline_kind(path)}:{digest}"
+        entry = self.lookup(key)
+        if entry is None:
+            text = read() or ""
+            entry = [len(text.splitlines()), extract_outline(path, text)]
+            self.put(key, entry)
+        return entry[0], entry[1]
+
+class FileSummarizer:
+    """Writes short summaries of files in the background with a cheap model
+    
+    request() only queues a file and never waits. A daemon thread sends the
+    queue in batches of up to BATCH_FILES files per request, at most
+    requests_per_minute requests a minute, backing off after errors. Each
+    summary is stored in a DigestStore under the SHA-256 of the content it
+    was written from, so a file is summarized again only once it changes.
+    Files that fail are dropped from the queue and requested again the
+    next time the context needs them.
+    """
+    
+    BATCH_FILES = 8
+    GATHER_SECONDS = 2.0  # how long a batch waits for more files
+    FILE_CHARS = 16000  # longer files are summarized from their start
+    MAX_SUMMARY_CHARS = 600
+    MAX_QUEUE = 200
+    MAX_BACKOFF = 600
+    PROMPT = ("Summarize each file below for a developer who has not seen it, in one to three "
+              "sentences: what it is for and the main things it defines or configures. Answer "
+              "with a JSON object mapping each file's path, exactly as given after ===, to its summary.")
+    
+    def __init__(self, client, model: str, store: DigestStore, requests_per_minute: float):
+        self.client = client
+        self.model = model
+        self.store = store
+        self.interval = 60.0 / max(requests_per_minute, 0.1)
+        self.failures = 0
+        self.last_error = None
+        self._queue = deque()  # (digest, absolute path, path shown to the model)
+        self._queued = set()
+        self._in_flight = 0
+        self._next_request = 0.0
+        self._stopped = False
+        self._thread = None
+        self._condition = threading.Condition()
+    
+    @property
+    def pending(self) -> int:
+        """Files queued or being summarized"""
+        return len(self._queue) + self._in_flight
+    
+    def request(self, digest: str, path: str, name: str) -> None:
+        """Queue a file whose content has this digest, unless it is already queued"""
+        with self._condition:
+            if self._stopped or digest in self._queued or len(self._queue) >= self.MAX_QUEUE:
+                return
+            self._queue.append((digest, path, name))
+            self._queued.add(digest)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="file-summarizer", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+    
+    def stop(self) -> None:
+        """Drop the queue and let the thread end after its current request"""
+        with self._condition:
+            self._stopped = True
+            self._queue.clear()
+            self._condition.notify()
+    
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                # Wait for work, then a little longer for a fuller batch, then for the rate limit
+                while not self._queue and not self._stopped:
+                    self._condition.wait()
+                deadline = max(time.monotonic() + self.GATHER_SECONDS, self._next_request)
+                while not self._stopped and (len(self._queue) < self.BATCH_FILES or time.monotonic() < self._next_request):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                if self._stopped:
+                    return
+                batch = [self._queue.popleft() for _ in range(min(self.BATCH_FILES, len(self._queue)))]
+                self._in_flight = len(batch)
+            
+            try:
+                self._summarize(batch)
+                self.failures = 0
+                self._next_request = time.monotonic() + self.interval
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e)
+                self._next_request = time.monotonic() + min(self.interval * 2 ** self.failures, self.MAX_BACKOFF)
+            finally:
+                with self._condition:
+                    self._in_flight = 0
+                    self._queued.difference_update(digest for digest, _, _ in batch)
+    
+    def _summarize(self, batch: List[Tuple[str, str, str]]) -> None:
+        """Summarize a batch of files with one request and store the results"""
+        parts = [self.PROMPT]
+        digests = {}
+        for _, path, name in batch:
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except OSError:
+                continue
+            # The file may have changed since it was queued; store under what was read
+            digests[name] = hashlib.sha256(data).hexdigest()
+            text = data.decode('utf-8', 'replace')
+            if len(text) > self.FILE_CHARS:
+                text = text[:self.FILE_CHARS] + "\n[... rest of the file not shown]"
+            parts.append(f"=== {name} ===\n{text}")
+        if not digests:
+            return
+        
+        response = self.client.models.generate_content(
+            model=self.model,
+            contents="\n\n".join(parts),
+            config=types.GenerateContentConfig(temperature=0.2, response_mime_type="application/json"),
+        )
+        summaries = json.loads(response.text or "{}")
+        if not isinstance(summaries, dict):
+            raise ValueError("summaries are not a JSON object")
+        for name, digest in digests.items():
+            summary = summaries.get(name)
+            if isinstance(summary, str) and summary.strip():
+                self.store.put(digest, " ".join(summary.split())[:self.MAX_SUMMARY_CHARS])
+        self.store.save()
+
+# Language of a file by extension, for directory digests
+LANGUAGES = {
+    '.py': 'Python', '.pyi': 'Python', '.js': 'JavaScript', '.jsx': 'JavaScript', '.mjs': 'JavaScript',
+    '.cjs': 'JavaScript', '.ts': 'TypeScript', '.tsx': 'TypeScript', '.vue': 'Vue', '.svelte': 'Svelte',
+    '.go': 'Go', '.rs': 'Rust', '.java': 'Java', '.kt': 'Kotlin', '.rb': 'Ruby', '.php': 'PHP',
+    '.c': 'C', '.h': 'C', '.cpp': 'C++', '.hpp': 'C++', '.cs': 'C#', '.swift': 'Swift',
+    '.html': 'HTML', '.htm': 'HTML', '.css': 'CSS', '.scss': 'CSS', '.sass': 'CSS', '.less': 'CSS',
+    '.md': 'Markdown', '.rst': 'reStructuredText', '.json': 'JSON', '.yaml': 'YAML', '.yml': 'YAML',
+    '.toml': 'TOML', '.sql': 'SQL', '.sh': 'Shell',
+}
+# Name defined by a top-level outline line ("12: export class Foo ...")
+_OUTLINE_NAME_RE = re.compile(
+    r"^\d+: (?:export\s+)?(?:default\s+)?(?:async\s+)?(?:abstract\s+)?"
+    r"(?:def|class|function\*?|interface|type|enum|struct|fn|func|const|let|var)\s+([A-Za-z_$][\w$]*)"
+)
+_README_NAMES = ("README.md", "README.rst", "README.txt", "README")
+
+class DirectoryTree:
+    """Directory digests of a project, for projects too big to list file by file
+    
+    Every directory gets a Merkle hash over its files' names, sizes and
+    mtimes and its subdirectories' hashes, so an edit changes the hashes of
+    its directory and the ones above it only. The digest of a directory
+    (file count and languages of everything under it, the names its own
+    code files define, and the first line of its README) is stored under
+    that hash in a DigestStore. Digests are therefore only recomputed for
+    directories whose hash changed, across sessions too. Definitions and
+    README lines are only worked out for directories that get shown.
+    """
+    
+    MAX_DEPTH = 4
+    EXPORT_FILES = 3  # largest code files of a directory whose definitions are listed
+    MAX_EXPORTS = 8
+    ROOT_FILES = 20  # files directly in the project root that are named
+    
+    def __init__(self, agent, store: DigestStore):
+        self.agent = agent
+        self.store = store
+        self.hashes = {}  # directory ("" for the root) -> Merkle hash
+        self.subdirs = {}  # directory -> sorted subdirectories
+        self.files = {}  # directory -> sorted file names directly inside
+        self.records = {}  # directory -> digest record
+    
+    def build(self) -> None:
+        """Hash every directory bottom-up and load or compute its digest"""
+        manifest = self.agent.manifest
+        self.subdirs[""] = []
+        for path in manifest.list():
+            directory, name = os.path.split(path)
+            self.files.setdefault(directory, []).append(name)
+            # Link the directory and any new ancestors to their parents
+            while directory and directory not in self.subdirs:
+                self.subdirs[directory] = []
+                directory = os.path.dirname(directory)
+        for directory in self.subdirs:
+            if directory:
+                self.subdirs[os.path.dirname(directory)].append(directory)
+        
+        for directory in sorted(self.subdirs, key=lambda d: d.count(os.sep) + bool(d), reverse=True):
+            self.subdirs[directory].sort()
+            digest = hashlib.sha256()
+            languages = Counter()
+            count = 0
+            for name in self.files.get(directory, []):
+                entry = manifest.files.get(os.path.join(directory, name))
+                digest.update(f"F{name}\0{entry[0]}\0{entry[1]}\n".encode('utf-8', 'surrogateescape'))
+                language = LANGUAGES.get(os.path.splitext(name)[1].lower())
+                if language:
+                    languages[language] += 1
+                count += 1
+            for subdir in self.subdirs[directory]:
+                digest.update(f"D{os.path.basename(subdir)}\0{self.hashes[subdir]}\n".encode('utf-8', 'surrogateescape'))
+            key = self.hashes[directory] = digest.hexdigest()
+            
+            record = self.store.lookup(key)
+            if record is None:
+                for subdir in self.subdirs[directory]:
+                    languages.update(self.records[subdir]["languages"])
+                    count += self.records[subdir]["files"]
+                record = {"files": count, "languages": dict(languages.most_common(3)),
+                          "exports": None, "summary": None}
+                self.store.put(key, record)
+            self.records[directory] = record
+    
+    def _describe(self, directory: str) -> dict:
+        """The directory's record, with its definitions and README line filled in"""
+        record = self.records[directory]
+        if record["exports"] is None:
+            code = [name for name in self.files.get(directory, [])
+                    if os.path.splitext(name)[1].lower() in _SCRIPT_EXTENSIONS | {'.py', '.pyi'}]
+            code.sort(key=lambda name: -(self.agent.manifest.size(os.path.join(directory, name)) or 0))
+            exports = []
+            for name in code[:self.EXPORT_FILES]:
+                outline = self.agent.outline_file(os.path.join(directory, name))
+                for line in (outline[1] if outline else "").splitlines():
+                    match = _OUTLINE_NAME_RE.match(line)
+                    if match and not match.group(1).startswith('_') and match.group(1) not in exports:
+                        exports.append(match.group(1))
+            summary = ""
+            for name in _README_NAMES:
+                if name in self.files.get(directory, []):
+                    content = self.agent.read_file(os.path.join(directory, name)) or ""
+                    summary = next((line.strip() for line in content.splitlines()
+                                    if line.strip() and not line.lstrip().startswith(('#', '=', '-', '[!', '<'))), "")
+                    break
+            record = dict(record, exports=exports[:self.MAX_EXPORTS], summary=summary[:120])
+            self.records[directory] = record
+            self.store.put(self.hashes[directory], record)
+        return record
+    
+    def _line(self, directory: str) -> str:
+        record = self._describe(directory)
+        depth = directory.count(os.sep)
+        total = sum(record["languages"].values()) or 1
+        languages = ", ".join(f"{language} {count * 100 // total}%"
+                              for language, count in record["languages"].items())
+        line = f"{'  ' * depth}- {directory.replace(os.sep, '/')}/ ({record['files']:,} files"
+        line += f"; {languages})" if languages else ")"
+        if record["exports"]:
+            line += f" defines {', '.join(record['exports'])}"
+        if record["summary"]:
+            line += f" - {record['summary']}"
+        return line + "\n"
+    
+    def render(self, budget: int) -> str:
+        """The tree's top levels within budget tokens, biggest directories expanded first"""
+        self.build()
+        lines = {}  # directory -> rendered line
+        used = 0
+        root_files = self.files.get("", [])
+        header = (f"Project tree ({self.records[''].get('files', 0):,} files, too many to list; "
+                  f"each directory with its file count, languages, top-level definitions and README line):\n")
+        root_line = "Files in the root: " + ", ".join(root_files[:self.ROOT_FILES])
+        if len(root_files) > self.ROOT_FILES:
+            root_line += f" and {len(root_files) - self.ROOT_FILES} more"
+        count = self.agent.token_estimator.count
+        used += count(header) + count(root_line)
+        
+        # Expand the directory with the most files first, one level at a time
+        queue = [(0, "")]
+        while queue:
+            _, directory = heapq.heappop(queue)
+            children = self.subdirs.get(directory, [])
+            if not children or directory.count(os.sep) + bool(directory) >= self.MAX_DEPTH:
+                continue
+            rendered = {child: self._line(child) for child in children}
+            cost = sum(count(line) for line in rendered.values())
+            if used + cost > budget:
+                continue
+            used += cost
+            lines.update(rendered)
+            for child in children:
+                heapq.heappush(queue, (-self.records[child]["files"], child))
+        self.store.save()
+        
+        parts = [header]
+        if root_files:
+            parts.append(root_line + "\n")
+        for directory in sorted(lines, key=lambda d: d.split(os.sep)):
+            parts.append(lines[directory])
+        hidden = len(self.subdirs) - 1 - len(lines)
+        if hidden:
+            parts.append(f"... {hidden:,} deeper directories not shown\n")
+        return "".join(parts)
+
+class ContextMemo:
+    """Parts of the prompt context that are reused until their files change
+    
+    Everything derived from the whole file list (the listing, per-file
+    ranking features, whether the relevance index is current, the last
+    assembled context) belongs to one manifest generation and is thrown
+    away when the manifest moves on. Rendered sections of a single file are
+    dropped by forget() when that file changes.
+    """
+    
+    def __init__(self):
+        self.generation = None
+        self.listing = None
+        self.features = None  # (path, posix path, path words, key file) of each text file
+        self.recent = None
+        self.indexed = False
+        self.sections = {}  # path -> {form or (form, terms): (section, tokens)}
+        self.last = None  # (key, context, packer) of the last assembled context
+    
+    def sync(self, generation: int) -> None:
+        """Drop everything derived from an older file list"""
+        if generation != self.generation:
+            self.generation = generation
+            self.listing = self.features = self.recent = self.last = None
+            self.indexed = False
+    
+    def forget(self, path: str) -> None:
+        self.sections.pop(path, None)
+
+class ContextPacker:
+    """Chooses what of the project goes into the prompt within a token budget
+    
+    Every text file gets a score from the user's request: being named in
+    it, path components that match its words, how well its content matches
+    the request (relevance, from RelevanceIndex.search), being a key config
+    file and having been modified recently. Candidates are then taken best
+    first and each gets the richest form that still fits: the whole file,
+    numbered excerpts of the regions around the request's words and the
+    lines its stack traces point at (see ExcerptFinder), an outline of its
+    definitions, or a summary written in the background (see
+    FileSummarizer). report records every decision with its reason.
+    Rendered sections and ranking features are kept in a ContextMemo.
+    """
+    
+    TEXT_EXTENSIONS = frozenset({
+        '.py', '.pyi', '.js', '.jsx', '.ts', '.tsx', '.mjs', '.cjs', '.vue', '.svelte',
+        '.html', '.htm', '.css', '.scss', '.sass', '.less', '.json', '.yaml', '.yml',
+        '.toml', '.ini', '.cfg', '.md', '.rst', '.txt', '.sql', '.sh', '.go', '.rs',
+        '.java', '.kt', '.rb', '.php', '.c', '.h', '.cpp', '.hpp', '.cs', '.swift',
+    })
+    KEY_FILENAMES = frozenset({
+        'package.json', 'requirements.txt', 'pyproject.toml', 'setup.py', 'README.md',
+        '.gitignore', 'app.py', 'main.py', 'index.js', 'index.html', 'tsconfig.json',
+    })
+    RECENT_FILES = 10  # how many of the most recently modified files get a bonus
+    MAX_FILE_SHARE = 3  # a file not named in the request gets at most 1/3 of the budget
+    FORMS = ("whole", "excerpt", "outline", "summary")
+    SMALL_FILE = 10000  # unrelated files this small may fill leftover budget, larger ones as outlines...
+    FILLER_SHARE = 4  # ...up to 1/4 of the whole budget
+    MAX_READ_BYTES = 1024 * 1024  # larger files are only searched for excerpts
+    MIN_SECTION_TOKENS = 64  # less budget than this left counts as none
+    PREFETCH_SHARE = 2  # related files read ahead in parallel, in budgets' worth of tokens
+    
+    def __init__(self, agent, budget: int, relevance: Optional[Dict[str, float]] = None,
+                 memo: Optional[ContextMemo] = None):
+        self.agent = agent
+        self.budget = budget
+        self.relevance = relevance or {}
+        self.memo = memo or ContextMemo()
+        self.used = 0
+        self.report = []  # (path, form, tokens, reason)
+        self.referenced = {}  # path -> line numbers that the request's stack traces point at
+        self.excerpts = ExcerptFinder()
+        self.prefetched = {}  # path -> content read in parallel ahead of packing, None if unusable
+        self.stable_length = 0  # characters of the leading sections that do not depend on the request
+    
+    def pack(self, files: List[str], user_input: str) -> List[str]:
+        """Return the context sections for files within the budget, most stable first"""
+        terms = {term.lower() for term in _TERM_RE.findall(user_input)} - _STOPWORDS
+        named = {_relative_reference(token) for token in _PATHLIKE_RE.findall(user_input)}
+        references = [(_relative_reference(ref), number) for ref, number in find_line_references(user_input)]
+        
+        sections = []
+        filler = 0
+        small_fillers_done = False
+        ranked = self._rank(files, terms, named, references)
+        self.prefetched = self._prefetch(ranked)
+        for score, path, reason in ranked:
+            remaining = self.budget - self.used
+            forms = self.FORMS
+            if score <= 0:
+                # Unrelated files only fill some leftover budget: small ones
+                # whole, large ones (often the core modules) as outlines
+                remaining = min(remaining, self.budget // self.FILLER_SHARE - filler)
+                if remaining < self.MIN_SECTION_TOKENS:
+                    break
+                small = (self.agent.manifest.size(path) or 0) < self.SMALL_FILE
+                if small and small_fillers_done:
+                    continue
+                forms = ("whole",) if small else ("outline",)
+                if not small:
+                    reason = "large file, outlined to fill leftover budget"
+            elif remaining < self.MIN_SECTION_TOKENS:
+                self.report.append((path, "skipped", 0, f"{reason}; budget exhausted"))
+                continue
+            limit = remaining
+            if not reason.startswith(("named in request", "stack trace")):
+                limit = min(remaining, self.budget // self.MAX_FILE_SHARE)
+            
+            section, form, tokens = self._render(path, terms, limit, forms)
+            if section is None:
+                if score <= 0 and form.startswith("does not fit"):
+                    # Fillers come smallest first, so no later small one fits
+                    # either; outlines only fail to fit once the budget is low
+                    if forms == ("outline",):
+                        break
+                    small_fillers_done = True
+                if score <= 0:
+                    continue
+                self.report.append((path, "skipped", 0, f"{reason}; {form}"))
+                continue
+            self.used += tokens
+            if score <= 0:
+                filler += tokens
+            self.report.append((path, form, tokens, reason))
+            sections.append((path, form, section))
+        
+        # Most stable first, so that consecutive prompts share a long prefix
+        sections.sort(key=self._stability)
+        # Sections of old files in whole or outline form do not depend on the request
+        self.stable_length = sum(len(item[2]) for item in sections if self._stability(item)[:2] == (False, False))
+        return [section for _, _, section in sections]
+    
+    def _prefetch(self, ranked: List[Tuple[int, str, str]]) -> Dict[str, Optional[str]]:
+        """Read the files pack() will probably want whole, in parallel and in rank order"""
+        manifest = self.agent.manifest
+        # Sizes in tokens at four bytes each; some related files will still not
+        # fit, so read ahead a few budgets' worth
+        room = self.PREFETCH_SHARE * self.budget
+        filler_room = self.budget // self.FILLER_SHARE
+        wanted = []
+        for score, path, reason in ranked:
+            tokens = (manifest.size(path) or 0) // 4
+            whole_tokens = self.memo.sections.get(path, {}).get("whole")
+            limit = self.budget
+            if not reason.startswith(("named in request", "stack trace")):
+                limit //= self.MAX_FILE_SHARE
+            if tokens > limit or (whole_tokens is not None and whole_tokens > limit):
+                continue
+            if score > 0 and room > 0:
+                room -= tokens
+            elif score <= 0 and tokens < self.SMALL_FILE // 4 and filler_room > 0:
+                filler_room -= tokens
+            else:
+                continue
+            wanted.append(path)
+        return self.agent.read_files(wanted, self.MAX_READ_BYTES)
+    
+    def _stability(self, item: Tuple[str, str, str]) -> tuple:
+        """Sort key putting files unchanged the longest first, then request-specific
+        excerpts, then files edited during this session"""
+        path, form, _ = item
+        entry = self.agent.manifest.files.get(path)
+        mtime_ns = entry[1] if entry else 0
+        return (mtime_ns >= self.agent.session_started_ns, form == "excerpt", mtime_ns, path)
+    
+    def _rank(self, files: List[str], terms: set, named: set,
+              references: List[Tuple[str, int]]) -> List[Tuple[int, str, str]]:
+        """Score every text file, returning (score, path, main reason), best first"""
+        manifest = self.agent.manifest
+        memo = self.memo
+        if memo.features is None:
+            memo.features = []
+            for path in files:
+                if self.is_text(path):
+                    posix = path.replace(os.sep, '/')
+                    words = frozenset(word.lower() for word in re.split(r'[^A-Za-z0-9]+', posix) if word)
+                    memo.features.append((path, posix, words, os.path.basename(path) in self.KEY_FILENAMES))
+            by_mtime = sorted(memo.features, key=lambda f: manifest.files.get(f[0], (0, 0))[1], reverse=True)
+            memo.recent = {feature[0] for feature in by_mtime[:self.RECENT_FILES]}
+        
+        ranked = []
+        for path, posix, words, key_file in memo.features:
+            reasons = []
+            score = 0
+            if named and (posix in named or any(posix.endswith('/' + name) for name in named)):
+                score += 1000
+                reasons.append("named in request")
+            if references:
+                # Traceback paths are often absolute, or relative to another directory
+                lines = {number for ref, number in references
+                         if ref == posix or ref.endswith('/' + posix) or posix.endswith('/' + ref)}
+                if lines:
+                    self.referenced[path] = lines
+                    if score < 1000:
+                        score += 1000
+                    reasons.append("stack trace points at line " + ", ".join(map(str, sorted(lines))))
+            hits = sorted(terms & words)
+            if hits:
+                score += 30 * len(hits)
+                reasons.append("path matches " + ", ".join(hits))
+            relevance = self.relevance.get(path)
+            if relevance:
+                score += int(100 * relevance)
+                reasons.append(f"content matches request ({relevance:.2f})")
+            if key_file:
+                score += 50
+                reasons.append("key project file")
+            if path in memo.recent:
+                score += 20
+                reasons.append("recently modified")
+            if not reasons:
+                reasons.append("small file, filling leftover budget")
+            ranked.append((score, path, "; ".join(reasons)))
+        if named:
+            # A named file counts even without a known text extension (.env, .babelrc)
+            basenames = {name.rsplit('/', 1)[-1] for name in named}
+            for path in files:
+                if os.path.basename(path) in basenames and not self.is_text(path):
+                    posix = path.replace(os.sep, '/')
+                    if posix in named or any(posix.endswith('/' + name) for name in named):
+                        ranked.append((1000, path, "named in request"))
+        
+        # Best score first; among equals, smaller files first so more of them fit
+        ranked.sort(key=lambda item: (-item[0], manifest.size(item[1]) or 0, item[1]))
+        return ranked
+    
+    @classmethod
+    def is_text(cls, path: str) -> bool:
+        """Whether a file is worth considering for the context at all"""
+        return (os.path.splitext(path)[1].lower() in cls.TEXT_EXTENSIONS
+                or os.path.basename(path) in cls.KEY_FILENAMES)
+    
+    def _render(self, path: str, terms: set, limit: int,
+                forms: Tuple[str, ...] = FORMS) -> Tuple[Optional[str], str, int]:
+        """The richest of forms of a file that fits in limit tokens and its tokens, or None and why not"""
+        size = self.agent.manifest.size(path) or 0
+        if size > self.MAX_READ_BYTES:
+            if "excerpt" not in forms or size > ExcerptFinder.MAX_BYTES:
+                return None, "too large to read", 0
+            forms = ("excerpt",)
+        cached = self.memo.sections.setdefault(path, {})
+        count = self.agent.token_estimator.count
+        
+        # The whole file is not kept here, only its size; file_cache has the text
+        if "whole" in forms:
+            whole_tokens = cached.get("whole")
+            if whole_tokens is None or whole_tokens <= limit:
+                if path in self.prefetched:
+                    content = self.prefetched[path]
+                else:
+                    content = self.agent.read_file(path)
+                if not content:
+                    return None, "empty, binary or unreadable", 0
+                section = f"\nContent of {path}:\n```\n{content}\n```\n"
+                # The content's features are cached in the manifest, so only the wrapper is counted
+                whole_tokens = cached["whole"] = self.agent.count_file_tokens(
+                    path, content, f"\nContent of {path}:\n```\n\n```\n")
+                if whole_tokens <= limit:
+                    return section, "whole", whole_tokens
+            if forms == ("whole",):
+                return None, "does not fit", 0
+        
+        referenced = self.referenced.get(path, set())
+        terms_key = ("excerpt", frozenset(terms), frozenset(referenced))
+        if "excerpt" in forms and terms_key not in cached:
+            # Only the excerpt for the latest request is kept
+            for key in [key for key in cached if isinstance(key, tuple)]:
+                del cached[key]
+            try:
+                line_count, excerpt = self.excerpts.find(os.path.join(self.agent.manifest.root, path),
+                                                         terms, referenced)
+            except (OSError, ValueError):
+                line_count, excerpt = 0, ""
+            section = (f"\nExcerpt of {path} ({line_count} lines; numbered, \"...\" where lines are left out):"
+                       f"\n```\n{excerpt}\n```\n" if excerpt else None)
+            cached[terms_key] = (section, count(section or ""))
+        if "outline" in forms and "outline" not in cached:
+            # Imports, signatures and docstrings, computed once per file content
+            outline = self.agent.outline_file(path)
+            section = None
+            if outline and outline[1]:
+                section = (f"\nOutline of {path} ({outline[0]} lines; imports, signatures and docstrings "
+                           f"only):\n```\n{outline[1]}\n```\n")
+            cached["outline"] = (section, count(section or ""))
+        
+        for form, key in (("excerpt", terms_key), ("outline", "outline")):
+            if form not in forms:
+                continue
+            section, tokens = cached[key]
+            if section is not None and tokens <= limit:
+                return section, form, tokens
+        if forms == ("outline",) and cached["outline"][0] is None:
+            return None, "no outline", 0
+        if "summary" in forms:
+            # Written in the background, so the file is left out until one exists
+            summary = self.agent.file_summary(path)
+            if summary is None:
+                return None, "does not fit even as an outline; summary requested", 0
+            section = f"\nSummary of {path}: {summary}\n"
+            tokens = count(section)
+            if tokens <= limit:
+                return section, "summary", tokens
+        return None, "does not fit even as an outline", 0
+    
+    def summary(self) -> str:
+        """One line describing what was packed"""
+        forms = {}
+        for _, form, _, _ in self.report:
+            forms[form] = forms.get(form, 0) + 1
+        detail = ", ".join(f"{count} {form}" for form, count in forms.items())
+        return f"{self.used:,}/{self.budget:,} tokens ({detail or 'no files'})"
+
+class ProjectTools:
+    """Project lookups the model can call instead of getting files preloaded
+    
+    list_files, read_file, grep and outline are offered to Gemini as function
+    declarations and run against the manifest. Results are cached by what
+    they were computed from: a file's SHA-256 for read_file and outline,
+    the manifest generation for list_files, and for grep the matches of each
+    file content per pattern. A repeated call, in the same turn or a later
+    one, is a dict lookup until the files change. Every result is capped so
+    that one call cannot flood the prompt. report lists the calls of the
+    current turn in the same shape as ContextPacker.report.
+    """
+    
+    MAX_LIST = 500
+    MAX_READ_LINES = 400
+    MAX_GREP_MATCHES = 100
+    MAX_GREP_LINE = 200
+    MAX_RESULTS = 1000  # cached results kept before the cache starts over
+    GREP_PATTERNS = 32  # patterns whose per-file matches are kept
+    
+    def __init__(self, agent):
+        self.agent = agent
+        self.results = {}  # (tool, arguments, content key) -> result
+        self.grep_matches = {}  # (pattern, ignore_case) -> {digest: ((line number, line), ...)}
+        self.report = []  # (call, "tool call", tokens, "cached" or "computed") of this turn
+        self.used = 0
+    
+    def declarations(self) -> types.Tool:
+        """The tools as Gemini function declarations"""
+        def schema(properties: Dict[str, Tuple[types.Type, str]], required: List[str]) -> types.Schema:
+            return types.Schema(
+                type=types.Type.OBJECT,
+                properties={name: types.Schema(type=kind, description=description)
+                            for name, (kind, description) in properties.items()},
+                required=required,
+            )
+        
+        return types.Tool(function_declarations=[
+            types.FunctionDeclaration(
+                name="list_files",
+                description=f"List project file paths, at most {self.MAX_LIST}.",
+                parameters=schema({
+                    "path": (types.Type.STRING, "Only list files under this directory"),
+                    "pattern": (types.Type.STRING, "Glob such as *.py, matched against file names, "
+                                                   "or against whole paths if it contains /"),
+                }, []),
+            ),
+            types.FunctionDeclaration(
+                name="read_file",
+                description=f"Read a project file, at most {self.MAX_READ_LINES} lines per call.",
+                parameters=schema({
+                    "path": (types.Type.STRING, "File path relative to the project root"),
+                    "start_line": (types.Type.INTEGER, "First line to return, from 1"),
+                    "end_line": (types.Type.INTEGER, "Last line to return"),
+                }, ["path"]),
+            ),
+            types.FunctionDeclaration(
+                name="grep",
+                description=f"Search text files for a regular expression; returns path:line: text, "
+                            f"at most {self.MAX_GREP_MATCHES} matches.",
+                parameters=schema({
+                    "pattern": (types.Type.STRING, "Python regular expression"),
+                    "path": (types.Type.STRING, "Only search files under this directory"),
+                    "ignore_case": (types.Type.BOOLEAN, "Match case-insensitively"),
+                }, ["pattern"]),
+            ),
+            types.FunctionDeclaration(
+                name="outline",
+                description="Numbered definition lines (classes, functions, headings) of a file.",
+                parameters=schema({
+                    "path": (types.Type.STRING, "File path relative to the project root"),
+                }, ["path"]),
+            ),
+        ])
+    
+    def begin_turn(self) -> None:
+        self.report = []
+        self.used = 0
+    
+    def call(self, name: str, args: Optional[Dict]) -> Dict:
+        """Run one tool call, returning the response to send back"""
+        args = dict(args or {})
+        label = f"{name}({', '.join(f'{key}={value!r}' for key, value in sorted(args.items()))})"
+        handler = {
+            "list_files": self._list_files,
+            "read_file": self._read_file,
+            "grep": self._grep,
+            "outline": self._outline,
+        }.get(name)
+        try:
+            if handler is None:
+                raise ValueError(f"unknown tool {name}")
+            result, cached = handler(**args)
+        except (TypeError, ValueError) as e:
+            result, cached = {"error": str(e)}, False
+        tokens = self.agent.token_estimator.count(json.dumps(result))
+        self.used += tokens
+        self.report.append((label, "tool call", tokens, "cached" if cached else "computed"))
+        return result
+    
+    def _memo(self, key: tuple, compute) -> Tuple[Dict, bool]:
+        """Look up or compute and store a result"""
+        if key in self.results:
+            return self.results[key], True
+        if len(self.results) >= self.MAX_RESULTS:
+            self.results.clear()
+        result = self.results[key] = compute()
+        return result, False
+    
+    def _resolve(self, path: Optional[str]) -> str:
+        """Project-relative key of path, refusing anything outside the project"""
+        path = (path or "").strip().replace('/', os.sep).lstrip(os.sep)
+        key = os.path.normpath(path) if path else ""
+        if key == os.curdir:
+            return ""
+        if os.path.isabs(key) or key == os.pardir or key.startswith(os.pardir + os.sep):
+            raise ValueError(f"path outside the project: {path}")
+        return key
+    
+    def _file(self, path: Optional[str]) -> Tuple[str, str]:
+        """Key and content digest of an existing, readable project file"""
+        key = self._resolve(path)
+        digest = self.agent.manifest.digest(key) if key else None
+        if digest is None:
+            raise ValueError(f"no such file: {path}")
+        if (self.agent.manifest.size(key) or 0) > ContextPacker.MAX_READ_BYTES:
+            raise ValueError(f"file too large to read: {path}")
+        return key, digest
+    
+    def _list_files(self, path: str = "", pattern: str = "") -> Tuple[Dict, bool]:
+        prefix = self._resolve(path)
+        manifest = self.agent.manifest
+        
+        def compute() -> Dict:
+            files = [f.replace(os.sep, '/') for f in manifest.list(prefix or None)]
+            if pattern:
+                regex = re.compile(_glob_to_regex(pattern) + r'\Z')
+                if '/' in pattern:
+                    files = [f for f in files if regex.match(f)]
+                else:
+                    files = [f for f in files if regex.match(f.rsplit('/', 1)[-1])]
+            result = {"files": files[:self.MAX_LIST], "total": len(files)}
+            if len(files) > self.MAX_LIST:
+                result["note"] = "list truncated; narrow it with path or pattern"
+            return result
+        
+        manifest.refresh()
+        return self._memo(("list_files", prefix, pattern, manifest.generation), compute)
+    
+    def _read_file(self, path: str, start_line: int = 1, end_line: int = 0) -> Tuple[Dict, bool]:
+        key, digest = self._file(path)
+        start_line = max(int(start_line or 1), 1)
+        end_line = int(end_line or 0)
+        
+        def compute() -> Dict:
+            lines = (self.agent.read_file(key) or "").splitlines()
+            last = min(end_line or len(lines), len(lines), start_line + self.MAX_READ_LINES - 1)
+            result = {"path": key.replace(os.sep, '/'), "total_lines": len(lines),
+                      "start_line": start_line, "end_line": last,
+                      "content": "\n".join(lines[start_line - 1:last])}
+            if last < (end_line or len(lines)):
+                result["note"] = f"more lines follow; call again with start_line={last + 1}"
+            return result
+        
+        return self._memo(("read_file", key, start_line, end_line, digest), compute)
+    
+    def _outline(self, path: str) -> Tuple[Dict, bool]:
+        key, digest = self._file(path)
+        
+        def compute() -> Dict:
+            line_count, outline = self.agent.outline_file(key) or (0, "")
+            return {"path": key.replace(os.sep, '/'), "total_lines": line_count, "outline": outline}
+        
+        return self._memo(("outline", key, digest), compute)
+    
+    def _grep(self, pattern: str, path: str = "", ignore_case: bool = False) -> Tuple[Dict, bool]:
+        try:
+            regex = re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+        except re.error as e:
+            raise ValueError(f"invalid regular expression: {e}")
+        prefix = self._resolve(path)
+        manifest = self.agent.manifest
+        manifest.refresh()
+        
+        # Matches are kept per file content, so only changed files are searched again
+        pattern_key = (pattern, bool(ignore_case))
+        per_digest = self.grep_matches.pop(pattern_key, {})
+        self.grep_matches[pattern_key] = per_digest
+        while len(self.grep_matches) > self.GREP_PATTERNS:
+            del self.grep_matches[next(iter(self.grep_matches))]
+        
+        matches = []
+        searched = 0
+        for file in manifest.list(prefix or None):
+            if not ContextPacker.is_text(file) or (manifest.size(file) or 0) > ContextPacker.MAX_READ_BYTES:
+                continue
+            digest = manifest.digest(file)
+            if digest is None:
+                continue
+            found = per_digest.get(digest)
+            if found is None:
+                searched += 1
+                try:
+                    with open(os.path.join(manifest.root, file), 'r', encoding='utf-8', errors='ignore') as f:
+                        found = tuple((number, line.strip()[:self.MAX_GREP_LINE])
+                                      for number, line in enumerate(f, 1) if regex.search(line))
+                except OSError:
+                    continue
+                per_digest[digest] = found
+            posix = file.replace(os.sep, '/')
+            matches.extend(f"{posix}:{number}: {line}" for number, line in found)
+            if len(matches) >= self.MAX_GREP_MATCHES:
+                break
+        
+        result = {"matches": matches[:self.MAX_GREP_MATCHES]}
+        if len(matches) >= self.MAX_GREP_MATCHES:
+            result["note"] = "more matches not shown; narrow the pattern or path"
+        return result, searched == 0
+    
+    def summary(self) -> str:
+        """One line describing the tool calls of this turn"""
+        cached = sum(1 for *_, reason in self.report if reason == "cached")
+        return f"{len(self.report)} tool calls, {self.used:,} tokens ({cached} cached)"
+
+class PromptCache:
+    """Explicit Gemini context cache for the stable head of the prompt
+    
+    The system instruction and the stable part of the project context are
+    uploaded once with client.caches.create(), and later requests refer to
+    them by name. The handle is reused while the SHA-256 of that content
+    (and the model) stays the same. Its TTL is extended once less than
+    REFRESH_MARGIN seconds are left, and a replaced handle is deleted. A
+    cache the API no longer knows (NOT_FOUND: expired or deleted early) is
+    forgotten and created again. A server error (5xx) sends that request
+    whole but keeps the cache, which is still valid. Any other error deletes
+    the cache so it is not billed until its TTL runs out; quota and
+    permission errors also turn caching off for RETRY_AFTER seconds, while
+    the rest (no caching for the model, content under the minimum size)
+    only send that request whole.
+    """
+    
+    REFRESH_MARGIN = 300
+    RETRY_AFTER = 600
+    BACK_OFF_CODES = frozenset({403, 429})  # permission denied, quota exhausted
+    
+    def __init__(self, ttl_seconds: int, min_tokens: int, count=estimate_tokens):
+        self.ttl_seconds = ttl_seconds
+        self.min_tokens = min_tokens
+        self.count = count  # token count of a text
+        self.client = None
+        self.name = None
+        self.key = None
+        self.expires_at = 0.0
+        self.disabled_until = 0.0
+        self.last_error = None  # message of the last warning, so repeats stay quiet
+    
+    def prepare(self, client, model: str, system_prompt: str, stable_text: str) -> Optional[str]:
+        """Name of a cache holding system_prompt and stable_text, or None to send them inline"""
+        if time.time() < self.disabled_until:
+            return None
+        if self.count(system_prompt) + self.count(stable_text) < self.min_tokens:
+            return None
+        key = hashlib.sha256("\0".join([model, system_prompt, stable_text]).encode('utf-8')).hexdigest()
+        try:
+            if self.name and self.key == key and self.client is client:
+                if self.expires_at - time.time() >= self.REFRESH_MARGIN:
+                    return self.name
+                try:
+                    cached = client.caches.update(
+                        name=self.name,
+                        config=types.UpdateCachedContentConfig(ttl=f"{self.ttl_seconds}s"),
+                    )
+                except errors.APIError as e:
+                    if e.code != 404:
+                        raise
+                    self.name = self.key = None  # gone already; make a new one below
+                else:
+                    self._set_expiry(cached)
+                    return self.name
+            
+            self.release()
+            cached = client.caches.create(
+                model=model,
+                config=types.CreateCachedContentConfig(
+                    display_name="ai-coding-agent",
+                    system_instruction=system_prompt,
+                    contents=[types.Content(role="user", parts=[types.Part.from_text(text=stable_text)])],
+                    ttl=f"{self.ttl_seconds}s",
+                ),
+            )
+        except Exception as e:
+            self.disable(e)
+            return None
+        self.client, self.name, self.key = client, cached.name, key
+        self._set_expiry(cached)
+        return self.name
+    
+    def _set_expiry(self, cached) -> None:
+        expire_time = getattr(cached, "expire_time", None)
+        self.expires_at = expire_time.timestamp() if expire_time else time.time() + self.ttl_seconds
+    
+    def disable(self, error: Exception) -> None:
+        """Delete the current cache after an API error, and stop caching for a while on quota or permission errors"""
+        code = getattr(error, "code", None)
+        if isinstance(code, int) and code >= 500:
+            # A server hiccup says nothing about the cache; try it again next time
+            if str(error) != self.last_error:
+                print(f"⚠️ Context caching failed ({error}); sending the full prompt")
+            self.last_error = str(error)
+            return
+        self.release()
+        if code in self.BACK_OFF_CODES:
+            self.disabled_until = time.time() + self.RETRY_AFTER
+            print(f"⚠️ Context caching unavailable ({error}); sending full prompts "
+                  f"for the next {self.RETRY_AFTER // 60} minutes")
+        elif str(error) != self.last_error:
+            print(f"⚠️ Context caching failed ({error}); sending the full prompt")
+        self.last_error = str(error)
+    
+    def recover(self, error: Exception, client, model: str, system_prompt: str, stable_text: str) -> Optional[str]:
+        """After a request using the cache failed: a new cache name if it had vanished, else None"""
+        if isinstance(error, errors.APIError) and error.code == 404:
+            self.name = self.key = None
+            return self.prepare(client, model, system_prompt, stable_text)
+        self.disable(error)
+        return None
+    
+    def release(self) -> None:
+        """Delete the current cache, if any"""
+        if not self.name:
+            return
+        name, self.name, self.key = self.name, None, None
+        try:
+            self.client.caches.delete(name=name)
+        except Exception:
+            pass  # it expires on its own anyway
+
+class FakeGenAIClient:
+    """Offline stand-in for genai.Client, to try the agent without an API key
+    
+    models.generate_content_stream() streams a canned reply in small chunks
+    and reports token usage the way the API does, counting the tokens of a
+    cached_content handle as cached. Given tool_calls, a list of rounds of
+    (name, args) pairs, it first answers a request with tools by calling
+    those functions, one round per request, and rejects tools sent next to
+    cached_content as the API does. models.generate_content() returns the
+    reply, or placeholder summaries for a FileSummarizer batch. caches supports create, get, update
+    and delete with TTLs and rejects expired or unknown names like the API.
+    Tokens are counted with estimate_tokens().
+    """
+    
+    REPLY = ("This reply comes from the offline fake client; no model was called.\n"
+             "Run without --fake and with an API key to get real answers.\n")
+    
+    def __init__(self, reply: Optional[str] = None, tool_calls: Optional[List[List[Tuple[str, dict]]]] = None):
+        self.reply = reply or self.REPLY
+        self.tool_calls = list(tool_calls or [])
+        self.models = _FakeModels(self)
+        self.caches = _FakeCaches()
+
+class _FakeCaches:
+    def __init__(self):
+        self.entries = {}  # name -> (CachedContent, token count)
+        self.created = 0
+    
+    def _lookup(self, name: str) -> Tuple[types.CachedContent, int]:
+        entry = self.entries.get(name)
+        if entry is None or entry[0].expire_time.timestamp() <= time.time():
+            self.entries.pop(name, None)
+            raise errors.ClientError(404, {"error": {
+                "code": 404, "status": "NOT_FOUND",
+                "message": f"cached content {name} does not exist or has expired",
+            }})
+        return entry
+    
+    def create(self, *, model: str, config: types.CreateCachedContentConfig) -> types.CachedContent:
+        self.created += 1
+        texts = [config.system_instruction or ""]
+        for content in config.contents or []:
+            texts.extend(part.text or "" for part in content.parts)
+        tokens = sum(estimate_tokens(text) for text in texts)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        cached = types.CachedContent(
+            name=f"cachedContents/fake-{self.created}", model=model, display_name=config.display_name,
+            create_time=now, update_time=now,
+            expire_time=now + datetime.timedelta(seconds=float(config.ttl.rstrip('s'))),
+            usage_metadata=types.CachedContentUsageMetadata(total_token_count=tokens),
+        )
+        self.entries[cached.name] = (cached, tokens)
+        return cached
+    
+    def get(self, *, name: str) -> types.CachedContent:
+        return self._lookup(name)[0]
+    
+    def update(self, *, name: str, config: types.UpdateCachedContentConfig) -> types.CachedContent:
+        cached, tokens = self._lookup(name)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        cached = cached.model_copy(update={
+            "update_time": now, "expire_time": now + datetime.timedelta(seconds=float(config.ttl.rstrip('s'))),
+        })
+        self.entries[name] = (cached, tokens)
+        return cached
+    
+    def delete(self, *, name: str) -> None:
+        self._lookup(name)
+        del self.entries[name]
+
+class _FakeModels:
+    def __init__(self, client: FakeGenAIClient):
+        self.client = client
+    
+    def generate_content_stream(self, *, model: str, contents: list,
+                                config: Optional[types.GenerateContentConfig] = None) -> Iterator[types.GenerateContentResponse]:
+        cached_tokens = 0
+        if config is not None and config.cached_content:
+            if config.tools or config.tool_config:
+                raise errors.ClientError(400, {"error": {
+                    "code": 400, "status": "INVALID_ARGUMENT",
+                    "message": "CachedContent can not be used with GenerateContent request setting tools or tool_config",
+                }})
+            cached_tokens = self.client.caches._lookup(config.cached_content)[1]
+        texts = [config.system_instruction if config is not None and isinstance(config.system_instruction, str) else ""]
+        for content in contents:
+            texts.extend(part.text or "" for part in content.parts)
+        prompt_tokens = cached_tokens + sum(estimate_tokens(text) for text in texts)
+        
+        calling = config is not None and config.tools and not (
+            config.tool_config and config.tool_config.function_calling_config
+            and config.tool_config.function_calling_config.mode == types.FunctionCallingConfigMode.NONE)
+        if calling and self.client.tool_calls:
+            calls = [types.Part(function_call=types.FunctionCall(name=name, args=args, id=f"call-{index}"))
+                     for index, (name, args) in enumerate(self.client.tool_calls.pop(0))]
+            yield types.GenerateContentResponse(
+                candidates=[types.Candidate(content=types.Content(role="model", parts=calls))],
+                usage_metadata=types.GenerateContentResponseUsageMetadata(
+                    prompt_token_count=prompt_tokens, candidates_token_count=len(calls),
+                    total_token_count=prompt_tokens + len(calls),
+                ),
+            )
+            return
+        
+        reply = self.client.reply
+        pieces = [reply[i:i + 64] for i in range(0, len(reply), 64)]
+        for index, piece in enumerate(pieces):
+            usage = None
+            if index == len(pieces) - 1:
+                usage = types.GenerateContentResponseUsageMetadata(
+                    prompt_token_count=prompt_tokens,
+                    cached_content_token_count=cached_tokens or None,
+                    candidates_token_count=estimate_tokens(reply),
+                    total_token_count=prompt_tokens + estimate_tokens(reply),
+                )
+            yield types.GenerateContentResponse(
+                candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part.from_text(text=piece)]))],
+                usage_metadata=usage,
+            )
+    
+    def generate_content(self, *, model: str, contents,
+                         config: Optional[types.GenerateContentConfig] = None) -> types.GenerateContentResponse:
+        text = self.client.reply
+        if config is not None and config.response_mime_type == "application/json" and isinstance(contents, str):
+            # Answers FileSummarizer batches with a placeholder per file
+            names = re.findall(r"^=== (.+) ===$", contents, re.MULTILINE)
+            text = json.dumps({name: f"Placeholder summary of {name} from the offline fake client." for name in names})
+        return types.GenerateContentResponse(
+            candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part.from_text(text=text)]))],
+        )
+    
+    def count_tokens(self, *, model: str, contents) -> types.CountTokensResponse:
+        if isinstance(contents, str):
+            contents = [types.Content(role="user", parts=[types.Part.from_text(text=contents)])]
+        total = sum(estimate_tokens(part.text or "") for content in contents for part in content.parts)
+        return types.CountTokensResponse(total_tokens=total)
 
 class AICodingAgent:
-    def __init__(self, api_key=None):
+    def __init__(self, api_key=None, client=None):
         # Configuration
         self.config_dir = os.path.expanduser("~/.ai_coding_agent")
         self.config_file = os.path.join(self.config_dir, "config.json")
@@ -37,7 +4165,7 @@ class AICodingAgent:
             os.environ["GEMINI_API_KEY"] = self.config["api_key"]
         
         # Initialize the Gemini client
-        self.client = genai.Client(
+        self.client = client or genai.Client(
             api_key=os.environ.get("GEMINI_API_KEY"),
         )
         
@@ -45,7 +4173,29 @@ class AICodingAgent:
         self.current_project = None
         self.project_path = None
         self.file_cache = {}  # Cache file contents
+        self.manifest = None  # ProjectManifest of the current project
+        self.relevance_index = None  # RelevanceIndex of the current project
+        self.context_memo = ContextMemo()
+        self.context_split = 0  # length of the request-independent head of the last context
+        self.tools = ProjectTools(self)  # tool-calling mode lookups, cached across turns
+        self.outlines = OutlineCache(os.path.join(self.config_dir, "outlines.json"))
+        self.summaries = DigestStore(os.path.join(self.config_dir, "summaries.json"))
+        self.directory_digests = DigestStore(os.path.join(self.config_dir, "directories.json"))
+        self.summarizer = None  # FileSummarizer, started on first use
+        self.token_estimator = TokenEstimator(os.path.join(self.config_dir, "tokens.json"))
+        self.prompt_cache = PromptCache(self.config["context_cache_ttl"], self.config["context_cache_min_tokens"],
+                                        self.token_estimator.count)
+        self.session_started_ns = time.time_ns()  # files changed after this count as recent edits
+        self.last_prompt = None  # bytes of the previous prompt, to measure the shared prefix
+        self.skipped_writes = 0  # Writes avoided because content was unchanged
         self.conversation_history = []
+        self.last_response = None  # ResponseBuffer of the most recent AI answer
+        self.context_report = None  # ContextPacker of the most recent prompt
+        self.write_pool = None  # WriteBehindPool, started on first use
+        self.read_pool = None  # ThreadPoolExecutor for context reads, started on first use
+        self.renderer = TerminalRenderer(
+            fps=self.config["render_fps"], flush_bytes=self.config["render_flush_bytes"]
+        )
         
         # System prompt to guide the AI
         self.system_prompt = """
@@ -59,10 +4209,27 @@ class AICodingAgent:
         
         When writing code or creating files, use these exact formats:
         - FILE: <filepath> - Followed by complete file content
+        - PATCH: <filepath> - Followed by one or more search/replace blocks
         - DIR: <dirpath> - Create a directory
         - CMD: <command> - Execute a shell command
         
-        Always provide complete file contents, not just snippets or changes.
+        To change a file that already exists, prefer PATCH and send only the
+        changed parts. Each block copies the current lines exactly, then
+        gives their replacement:
+        <<<<<<< SEARCH
+        lines currently in the file
+        =======
+        the new lines
+        >>>>>>> REPLACE
+        
+        Use FILE with the complete file contents for new files, or when most
+        of a file changes. Never send partial snippets in a FILE block.
+        Excerpts in the project context start each line with its number and
+        ": "; leave those numbers out of SEARCH blocks.
+        
+        CMD lines that work in different directories may run in parallel.
+        Start such commands with "cd <dir> &&", and write "CMD: [after=N] ..."
+        when a command must wait for the N-th CMD of your answer.
         Explain your reasoning and approach clearly.
         """
     
@@ -72,7 +4239,24 @@ class AICodingAgent:
             "api_key": "",
             "model": "gemini-2.5-pro-preview-03-25",
             "temperature": 0.7,
-            "workspace_path": os.path.expanduser("~/ai_coding_agent_workspace")
+            "workspace_path": os.path.expanduser("~/ai_coding_agent_workspace"),
+            "response_buffer_bytes": 1024 * 1024,
+            "write_workers": 8,
+            "durability": "batch",  # none, batch or per-file
+            "command_concurrency": 4,
+            "render_fps": 30,
+            "render_flush_bytes": 4096,
+            "context_token_budget": 32000,
+            "relevance_vector_weight": 0.0,  # 0-1, needs NumPy
+            "context_cache": True,
+            "context_cache_ttl": 3600,
+            "context_cache_min_tokens": 4096,
+            "tool_calling": False,  # let the model fetch files instead of preloading them
+            "tool_rounds": 10,
+            "file_summaries": True,  # summarize files that do not fit, in the background
+            "summary_model": "gemini-2.0-flash-lite",
+            "summary_requests_per_minute": 10,
+            "read_workers": 8  # files read at once while assembling the context
         }
         
         # Create config directory if it doesn't exist
@@ -116,6 +4300,25 @@ class AICodingAgent:
         
         # Reset file cache
         self.file_cache = {}
+        self.context_memo = ContextMemo()
+        self.tools = ProjectTools(self)
+        
+        # Load the saved file index for this project
+        if self.manifest:
+            self.manifest.save()
+        manifest_name = hashlib.sha256(os.path.abspath(self.project_path).encode('utf-8')).hexdigest()[:16]
+        self.manifest = ProjectManifest(
+            os.path.abspath(self.project_path),
+            os.path.join(self.config_dir, "manifests", f"{manifest_name}.json"),
+            on_change=self._forget_cached,
+        )
+        if self.relevance_index:
+            self.relevance_index.save()
+        self.relevance_index = RelevanceIndex(
+            os.path.abspath(self.project_path),
+            os.path.join(self.config_dir, "indexes", manifest_name),
+            self.config["relevance_vector_weight"],
+        )
         
         print(f"Project set: {project_name}")
         print(f"Path: {self.project_path}")
@@ -136,16 +4339,8 @@ class AICodingAgent:
             print(f"Directory not found: {path}")
             return []
         
-        result = []
-        for root, dirs, files in os.walk(dir_path):
-            rel_path = os.path.relpath(root, self.project_path)
-            for file in files:
-                if rel_path == '.':
-                    result.append(file)
-                else:
-                    result.append(os.path.join(rel_path, file))
-        
-        return sorted(result)
+        self.manifest.refresh()
+        return self.manifest.list(path)
     
     def read_file(self, file_path: str) -> Optional[str]:
         """Read a file's content, with caching"""
@@ -153,17 +4348,27 @@ class AICodingAgent:
             print("No project selected. Use !project <n> first.")
             return None
         
-        full_path = os.path.join(self.project_path, file_path)
+        key = os.path.normpath(file_path)
+        full_path = os.path.join(self.project_path, key)
+        if (os.path.isabs(key) or key == os.pardir or key.startswith(os.pardir + os.sep)
+                or not self.manifest.contains(os.path.realpath(full_path))):
+            print(f"Path is outside the project: {file_path}")
+            return None
+        if os.path.isdir(full_path):
+            print(f"Not a file: {file_path}")
+            return None
         
-        # Return from cache if available
-        if file_path in self.file_cache:
-            return self.file_cache[file_path]
+        # Return from cache if available and the file is unchanged on disk
+        # (a changed stat evicts the cached copy through the manifest)
+        self.manifest.check(key)
+        if key in self.file_cache:
+            return self.file_cache[key]
         
         # Read the file
         try:
             with open(full_path, 'r', encoding='utf-8', errors='ignore') as f:
                 content = f.read()
-                self.file_cache[file_path] = content
+                self.file_cache[key] = content
                 return content
         except FileNotFoundError:
             print(f"File not found: {file_path}")
@@ -172,43 +4377,84 @@ class AICodingAgent:
             print(f"Error reading file: {e}")
             return None
     
-    def write_file(self, file_path: str, content: str) -> bool:
-        """Write content to a file, creating directories as needed"""
-        if not self.current_project:
-            print("No project selected. Use !project <n> first.")
-            return False
-        
-        full_path = os.path.join(self.project_path, file_path)
+    def read_files(self, file_paths: List[str], max_bytes: int) -> Dict[str, Optional[str]]:
+        """Read several files in parallel, with caching; returns contents in the order given
         
-        try:
-            # Create directories if they don't exist
-            os.makedirs(os.path.dirname(full_path), exist_ok=True)
-            
-            # Write the file
-            with open(full_path, 'w', encoding='utf-8') as f:
-                f.write(content)
-            
-            # Update cache
-            self.file_cache[file_path] = content
-            return True
-        except Exception as e:
-            print(f"Error writing file: {e}")
-            return False
+        Files over max_bytes and binary files come back as None and are not
+        cached. Cached files are checked with a stat here, as read_file does;
+        the rest are read on the read pool and their stats go to the manifest
+        from this thread, in the order given.
+        """
+        keys = list(dict.fromkeys(os.path.normpath(file_path) for file_path in file_paths))
+        for key in keys:
+            if key in self.file_cache:
+                self.manifest.check(key)
+        missing = [key for key in keys if key not in self.file_cache]
+        if missing:
+            if self.read_pool is None:
+                self.read_pool = ThreadPoolExecutor(
+                    max_workers=max(1, self.config["read_workers"]), thread_name_prefix="context-read"
+                )
+            full_paths = [os.path.join(self.project_path, key) for key in missing]
+            for key, (content, st) in zip(missing, self.read_pool.map(_read_text, full_paths,
+                                                                     [max_bytes] * len(missing))):
+                if st is None:
+                    self.manifest.check(key)
+                    continue
+                self.manifest.observe(key, st)
+                if content is not None:
+                    self.file_cache[key] = content
+        return {key: self.file_cache.get(key) if (self.manifest.size(key) or 0) <= max_bytes else None
+                for key in keys}
     
-    def create_directory(self, dir_path: str) -> bool:
-        """Create a directory in the project"""
-        if not self.current_project:
-            print("No project selected. Use !project <n> first.")
-            return False
-        
-        full_path = os.path.join(self.project_path, dir_path)
-        
-        try:
-            os.makedirs(full_path, exist_ok=True)
-            return True
-        except Exception as e:
-            print(f"Error creating directory: {e}")
-            return False
+    def outline_file(self, file_path: str) -> Optional[Tuple[int, str]]:
+        """Line count and outline of a project file, computed once per content"""
+        key = os.path.normpath(file_path)
+        digest = self.manifest.digest(key)
+        if digest is None:
+            return None
+        return self.outlines.get(digest, key, lambda: self.read_file(key))
+    
+    def file_summary(self, file_path: str) -> Optional[str]:
+        """Stored summary of a file's current content; a missing one is queued for writing"""
+        if not self.config["file_summaries"]:
+            return None
+        key = os.path.normpath(file_path)
+        digest = self.manifest.digest(key)
+        if digest is None:
+            return None
+        summary = self.summaries.lookup(digest)
+        if summary is None:
+            if self.summarizer is None:
+                self.summarizer = FileSummarizer(self.client, self.config["summary_model"], self.summaries,
+                                                 self.config["summary_requests_per_minute"])
+            self.summarizer.request(digest, os.path.join(self.manifest.root, key), key.replace(os.sep, '/'))
+        return summary
+    
+    def count_file_tokens(self, file_path: str, content: str, wrapper: str = "") -> int:
+        """Estimated tokens of a file's content plus the text around it, with the content's features kept in the manifest"""
+        features = self.manifest.token_features(os.path.normpath(file_path), content)
+        return self.token_estimator.count_features(
+            TokenEstimator.combine(features, TokenEstimator.features(wrapper)))
+    
+    def get_write_pool(self) -> WriteBehindPool:
+        """Return the shared write-behind pool, starting it on first use"""
+        if self.write_pool is None:
+            self.write_pool = WriteBehindPool(self.config["write_workers"])
+        return self.write_pool
+    
+    def begin_apply(self) -> ApplyTransaction:
+        """Start a transaction for the FILE/DIR actions of a response"""
+        return ApplyTransaction(self.project_path, self.config["durability"], self.manifest)
+    
+    def invalidate_cache(self, file_paths: List[str]) -> None:
+        """Drop cached contents of files that were rewritten on disk"""
+        for file_path in file_paths:
+            self._forget_cached(file_path)
+    
+    def _forget_cached(self, file_path: str) -> None:
+        self.file_cache.pop(os.path.normpath(file_path), None)
+        self.context_memo.forget(os.path.normpath(file_path))
     
     def execute_command(self, command: str) -> Tuple[str, str, int]:
         """Execute a shell command in the project directory"""
@@ -233,186 +4479,263 @@ class AICodingAgent:
         except Exception as e:
             return "", str(e), 1
     
-    def gather_project_context(self) -> str:
-        """Gather current project context for the AI"""
+    def gather_project_context(self, user_input: str = "") -> str:
+        """Gather current project context for the AI, within the token budget"""
         if not self.current_project:
             return "No active project."
         
+        budget = self.config["context_token_budget"]
+        files = self.list_files()
+        memo = self.context_memo
+        memo.sync(self.manifest.generation)
+        
+        # Reuse the last context as is if neither the project nor the request changed
+        key = (user_input, budget)
+        if memo.last and memo.last[0] == key:
+            # Edits in place do not touch directory mtimes, so check the files used
+            for path, form, _, _ in memo.last[2].report:
+                if form != "skipped":
+                    self.manifest.check(path)
+            memo.sync(self.manifest.generation)
+            if memo.last:
+                _, context, self.context_report, self.context_split = memo.last
+                return context
+        
         context = f"Current project: {self.current_project}\n\n"
         
-        # Get file list
-        files = self.list_files()
-        if files:
-            context += "Project files:\n"
-            for file in files:
-                context += f"- {file}\n"
-        else:
-            context += "Project is empty.\n"
-        
-        # Include content of key configuration files and small code files
-        key_extensions = ['.json', '.py', '.js', '.html', '.css', '.md', '.txt', '.yaml', '.yml']
-        key_filenames = ['package.json', 'requirements.txt', 'setup.py', 'README.md', 
-                        '.gitignore', 'app.py', 'main.py', 'index.js', 'index.html']
-        
-        included_files = []
-        
-        # First include explicitly key files
-        for filename in key_filenames:
-            for file in files:
-                if os.path.basename(file) == filename and file not in included_files:
-                    included_files.append(file)
-        
-        # Then include small files with key extensions
-        for file in files:
-            if file not in included_files:
-                ext = os.path.splitext(file)[1].lower()
-                if ext in key_extensions:
-                    file_path = os.path.join(self.project_path, file)
-                    if os.path.getsize(file_path) < 10000:  # Only include files smaller than 10KB
-                        included_files.append(file)
-        
-        # Limit to 10 files to avoid exceeding context window
-        for file in included_files[:10]:
-            content = self.read_file(file)
-            if content:
-                context += f"\nContent of {file}:\n```\n{content}\n```\n"
+        # Get file list, or directory digests if the list alone would take over the budget
+        if memo.listing is None:
+            if files:
+                listing = ["Project files:\n"]
+                listing_budget = budget // 4
+                used = 0
+                for file in files:
+                    line = f"- {file}\n"
+                    used += self.token_estimator.count(line)
+                    if used > listing_budget:
+                        listing = [DirectoryTree(self, self.directory_digests).render(listing_budget)]
+                        break
+                    listing.append(line)
+                memo.listing = "".join(listing)
+            else:
+                memo.listing = "Project is empty.\n"
+        context += memo.listing
         
+        # Fill the rest of the budget with the files most relevant to the request
+        relevance = {}
+        if user_input.strip():
+            if not memo.indexed:
+                self.relevance_index.update([f for f in files if ContextPacker.is_text(f)], self.manifest)
+                self.relevance_index.save()
+                memo.indexed = True
+            relevance = dict(self.relevance_index.search(user_input))
+        packer = ContextPacker(self, budget - self.token_estimator.count(context), relevance, memo)
+        sections = packer.pack(files, user_input)
+        self.context_split = len(context) + packer.stable_length
+        context += "".join(sections)
+        self.context_report = packer
+        memo.last = (key, context, packer, self.context_split)
         return context
     
-    def process_ai_response(self, response: str) -> None:
+    def process_ai_response(self, response: Union[str, ResponseBuffer]) -> None:
         """Process AI response and execute actions"""
         if not self.current_project:
             print("No project selected. Use !project <n> first.")
             return
         
-        lines = response.split('\n')
-        current_mode = None
-        current_path = None
-        current_content = []
-        
-        for line in lines:
-            # Check for FILE marker
-            if line.startswith("FILE: "):
-                # Save previous file if there was one
-                if current_mode == "FILE" and current_path and current_content:
-                    content = '\n'.join(current_content)
-                    if self.write_file(current_path, content):
-                        print(f"✅ Created/Updated file: {current_path}")
-                
-                # Start new file
-                current_mode = "FILE"
-                current_path = line[6:].strip()
-                current_content = []
-            
-            # Check for DIR marker
-            elif line.startswith("DIR: "):
-                # Save previous file if there was one
-                if current_mode == "FILE" and current_path and current_content:
-                    content = '\n'.join(current_content)
-                    if self.write_file(current_path, content):
-                        print(f"✅ Created/Updated file: {current_path}")
-                
-                # Create directory
-                current_mode = None
-                dir_path = line[5:].strip()
-                if self.create_directory(dir_path):
-                    print(f"✅ Created directory: {dir_path}")
-                current_path = None
-                current_content = []
-            
-            # Check for CMD marker
-            elif line.startswith("CMD: "):
-                # Save previous file if there was one
-                if current_mode == "FILE" and current_path and current_content:
-                    content = '\n'.join(current_content)
-                    if self.write_file(current_path, content):
-                        print(f"✅ Created/Updated file: {current_path}")
-                
-                # Execute command
-                current_mode = None
-                command = line[5:].strip()
-                stdout, stderr, return_code = self.execute_command(command)
-                
-                if return_code == 0:
-                    print(f"✅ Executed command: {command}")
-                    if stdout:
-                        print(f"Output: {stdout[:200]}{'...' if len(stdout) > 200 else ''}")
-                else:
-                    print(f"❌ Command failed: {command}")
-                    if stderr:
-                        print(f"Error: {stderr[:200]}{'...' if len(stderr) > 200 else ''}")
-                
-                current_path = None
-                current_content = []
-            
-            # If in FILE mode, collect content
-            elif current_mode == "FILE":
-                current_content.append(line)
-            
-            # Just print other lines as the AI's explanation
-            else:
-                print(line)
-        
-        # Save the last file if there is one
-        if current_mode == "FILE" and current_path and current_content:
-            content = '\n'.join(current_content)
-            if self.write_file(current_path, content):
-                print(f"✅ Created/Updated file: {current_path}")
+        engine = StreamingActionEngine(self)
+        if isinstance(response, ResponseBuffer):
+            for block in response.chunks():
+                engine.feed(block)
+        else:
+            engine.feed(response)
+        engine.close()
+        self.manifest.save()
     
-    def query_model(self, user_input: str) -> None:
+    def query_model(self, user_input: str, allow_patch_fallback: bool = True) -> None:
         """Query Gemini with the user's input and project context"""
         if not self.current_project:
             print("No project selected. Use !project <n> first.")
             return
         
-        # Gather context about the project
-        context = self.gather_project_context()
+        if self.config["tool_calling"]:
+            # The model looks files up itself, so only the project header goes up front
+            self.manifest.refresh()
+            self.tools.begin_turn()
+            self.context_report = self.tools
+            context = (f"Current project: {self.current_project}\n"
+                       f"{len(self.manifest.files):,} files, none preloaded. Use the tools to list, "
+                       f"search and read the ones you need.\n")
+            self.context_split = len(context)
+            tools = self.tools.declarations()
+        else:
+            # Gather context about the project
+            context = self.gather_project_context(user_input)
+            print(f"📎 Context: {self.context_report.summary()}")
+            if self.summarizer and self.summarizer.pending:
+                print(f"📝 Summarizing {self.summarizer.pending} file(s) that did not fit, in the background")
+            tools = None
         
-        # Construct the full prompt with system prompt, context, and user input
-        full_prompt = f"{self.system_prompt}\n\nUser request: {user_input}\n\nProject Context:\n{context}"
+        # Construct the prompt from the most to the least stable part: system
+        # prompt, project context (itself ordered by stability), request
+        stable_text = f"Project Context:\n{context[:self.context_split]}"
+        request_text = f"{context[self.context_split:]}\nUser request: {user_input}"
+        prompt_bytes = f"{self.system_prompt}\n\n{stable_text}{request_text}".encode('utf-8')
+        if self.last_prompt is not None:
+            matched = _common_prefix_length(self.last_prompt, prompt_bytes)
+            print(f"🔁 Prompt prefix: {matched:,} of {len(prompt_bytes):,} bytes "
+                  f"({matched * 100 // max(len(prompt_bytes), 1)}%) same as the previous turn")
+        self.last_prompt = prompt_bytes
+        # Everything sent, for the estimate and to calibrate it against the actual count
+        prompt_features = TokenEstimator.combine(TokenEstimator.features(self.system_prompt),
+                                                 TokenEstimator.features(stable_text + request_text))
+        estimated = self.token_estimator.count_features(prompt_features)
+        print(f"🧮 Prompt: about {estimated:,} tokens")
         
         print("Thinking...")
         
         try:
             # Set up Gemini request
             model = self.config["model"]
-            contents = [
-                types.Content(
-                    role="user",
-                    parts=[
-                        types.Part.from_text(text=full_prompt),
-                    ],
-                ),
-            ]
+            cache_name = None
+            # The API takes no tools or tool_config next to cached_content, and
+            # the last tool round needs a tool_config of its own
+            if self.config["context_cache"] and tools is None:
+                cache_name = self.prompt_cache.prepare(self.client, model, self.system_prompt, stable_text)
+            contents = [types.Content(role="user", parts=[
+                types.Part.from_text(text=request_text if cache_name else stable_text + request_text),
+            ])]
             
-            generate_content_config = types.GenerateContentConfig(
-                temperature=self.config["temperature"],
-                response_mime_type="text/plain",
-            )
-            
-            # Collect chunks to create the full response
-            response_text = ""
+            # Apply actions as the stream arrives rather than after it ends
+            engine = StreamingActionEngine(self)
+            if self.last_response:
+                self.last_response.close()
+            self.last_response = ResponseBuffer(self.config["response_buffer_bytes"])
             print("\nAI Assistant Response:")
             
-            # Use streaming to get the response
-            for chunk in self.client.models.generate_content_stream(
-                model=model,
-                contents=contents,
-                config=generate_content_config,
-            ):
-                if chunk.text:
-                    response_text += chunk.text
-                    # Print the chunk to show progress
-                    print(chunk.text, end="")
-                    sys.stdout.flush()
-            
-            print("\n")  # Add a newline after the streaming output
+            # Use streaming to get the response; with tools, every round of
+            # function calls is answered and the conversation streamed again
+            totals = [0, 0, 0]  # prompt, cached and response tokens over all rounds
+            rounds = 0
+            cache_retried = False
+            try:
+                while True:
+                    allow_calls = tools is not None and rounds < self.config["tool_rounds"]
+                    try:
+                        parts, calls, usage = self._stream_round(model, contents, cache_name, tools, allow_calls, engine)
+                    except Exception as e:
+                        # A cache that vanished or expired early is created again
+                        # once; otherwise the whole prompt goes out. Not if some
+                        # of the response was already used.
+                        if cache_name is None or rounds or self.last_response.size:
+                            raise
+                        if cache_retried:
+                            self.prompt_cache.disable(e)
+                            cache_name = None
+                        else:
+                            cache_retried = True
+                            cache_name = self.prompt_cache.recover(e, self.client, model, self.system_prompt, stable_text)
+                        contents[0] = types.Content(role="user", parts=[
+                            types.Part.from_text(text=request_text if cache_name else stable_text + request_text),
+                        ])
+                        continue
+                    if usage is not None:
+                        totals[0] += usage.prompt_token_count or 0
+                        totals[1] += usage.cached_content_token_count or 0
+                        totals[2] += usage.candidates_token_count or 0
+                        if tools is None and not rounds:
+                            self.token_estimator.record(prompt_features, usage.prompt_token_count or 0)
+                    if not calls:
+                        break
+                    
+                    rounds += 1
+                    contents.append(types.Content(role="model", parts=parts))
+                    responses = []
+                    for call in calls:
+                        result = self.tools.call(call.name, call.args)
+                        label, _, tokens, reason = self.tools.report[-1]
+                        self.renderer.line(f"🔧 {label}: {tokens:,} tokens{' (cached)' if reason == 'cached' else ''}")
+                        response = types.Part.from_function_response(name=call.name, response=result)
+                        response.function_response.id = call.id
+                        responses.append(response)
+                    contents.append(types.Content(role="user", parts=responses))
+            except BaseException:
+                # Never write a FILE block that was cut off mid-stream
+                engine.abort()
+                raise
             
-            # Process and execute actions in the response
-            self.process_ai_response(response_text)
+            engine.close()
+            self.manifest.save()
+            self.outlines.save()
+            self.token_estimator.save()
+            print()  # Add a newline after the streaming output
+            if tools is not None:
+                print(f"📎 Context: {self.tools.summary()} over {rounds + 1} rounds")
+            if totals[0]:
+                estimate = f", {estimated:,} estimated" if tools is None else ""
+                print(f"🧮 Tokens: {totals[0]:,} prompt ({totals[1]:,} cached, "
+                      f"{totals[0] - totals[1]:,} uncached{estimate}), {totals[2]:,} response")
             
         except Exception as e:
             print(f"Error querying AI model: {e}")
+            return
+        
+        # Ask once for whole files where a PATCH did not apply
+        if engine.failed_patches and allow_patch_fallback:
+            paths = ", ".join(dict.fromkeys(engine.failed_patches))
+            print(f"Requesting complete contents for: {paths}")
+            self.query_model(
+                f"Your PATCH edits for these files could not be applied: {paths}. "
+                f"Send the complete updated content of each of them using FILE: markers. "
+                f"The original request was: {user_input}",
+                allow_patch_fallback=False,
+            )
+    
+    def _stream_round(self, model: str, contents: List[types.Content], cache_name: Optional[str],
+                      tools: Optional[types.Tool], allow_calls: bool,
+                      engine: "StreamingActionEngine") -> Tuple[list, list, Optional[types.GenerateContentResponseUsageMetadata]]:
+        """Stream one model response into engine, returning its parts, function calls and usage"""
+        config = {"temperature": self.config["temperature"], "response_mime_type": "text/plain"}
+        if cache_name:
+            # The system instruction is part of the cached content
+            config["cached_content"] = cache_name
+        else:
+            config["system_instruction"] = self.system_prompt
+        if tools is not None:
+            config["tools"] = [tools]
+            config["automatic_function_calling"] = types.AutomaticFunctionCallingConfig(disable=True)
+            if not allow_calls:
+                # Out of tool rounds: the model has to answer with what it has
+                config["tool_config"] = types.ToolConfig(
+                    function_calling_config=types.FunctionCallingConfig(mode=types.FunctionCallingConfigMode.NONE)
+                )
+        
+        parts = []
+        calls = []
+        usage = None
+        ends_line = True
+        for chunk in self.client.models.generate_content_stream(
+            model=model,
+            contents=contents,
+            config=types.GenerateContentConfig(**config),
+        ):
+            usage = chunk.usage_metadata or usage
+            candidate = chunk.candidates[0] if chunk.candidates else None
+            if candidate is None or candidate.content is None:
+                continue
+            for part in candidate.content.parts or []:
+                parts.append(part)
+                if part.function_call is not None:
+                    calls.append(part.function_call)
+                elif part.text and not part.thought:
+                    self.last_response.append(part.text)
+                    engine.feed(part.text)
+                    ends_line = part.text.endswith("\n")
+        if calls and not ends_line:
+            # Tool output starts on a line of its own
+            self.last_response.append("\n")
+            engine.feed("\n")
+        return parts, calls, usage
     
     def run(self) -> None:
         """Main loop to interact with the user"""
@@ -457,6 +4780,31 @@ class AICodingAgent:
                                 print(f"Content of {command_parts[1]}:")
                                 print(content)
                     
+                    elif command == "last":
+                        if self.last_response and self.last_response.size:
+                            for block in self.last_response.chunks():
+                                sys.stdout.write(block)
+                            print()
+                        else:
+                            print("No AI response yet.")
+                    
+                    elif command == "context":
+                        if self.context_report:
+                            print(f"Context of the last request: {self.context_report.summary()}")
+                            for path, form, tokens, reason in self.context_report.report:
+                                print(f"- {path} [{form}, {tokens:,} tokens] {reason}")
+                        else:
+                            print("No context sent yet.")
+                    
+                    elif command == "tools":
+                        if len(command_parts) == 2 and command_parts[1].lower() in ("on", "off"):
+                            self.config["tool_calling"] = command_parts[1].lower() == "on"
+                        elif len(command_parts) == 2:
+                            print("Usage: !tools [on|off]")
+                        state = "on: the AI fetches files itself" if self.config["tool_calling"] else \
+                            "off: relevant files are sent with each request"
+                        print(f"Tool calling is {state}")
+                    
                     elif command == "exec":
                         if len(command_parts) < 2:
                             print("Usage: !exec <shell_command>")
@@ -478,6 +4826,9 @@ Available commands:
 !list            - List files in the current project
 !cat <file>      - Show the content of a file
 !exec <command>  - Execute a shell command
+!last            - Show the raw text of the last AI response
+!context         - Show which files were sent with the last request, and why
+!tools [on|off]  - Let the AI fetch files with tool calls instead of preloading them
 !help            - Show this help message
 
 For any other input, the AI will process it as a coding task.
@@ -495,13 +4846,40 @@ For any other input, the AI will process it as a coding task.
                 break
             except Exception as e:
                 print(f"Error: {e}")
+        
+        # Caches are billed while they exist, so do not leave one behind
+        self.prompt_cache.release()
+        if self.summarizer:
+            self.summarizer.stop()
+        if self.read_pool:
+            self.read_pool.shutdown()
+
+def calibrate_tokens(store_path: str) -> None:
+    """Refit the token estimator to the prompts recorded so far, without calling the API"""
+    estimator = TokenEstimator(store_path)
+    result = estimator.fit()
+    if result is None:
+        print(f"Not enough recorded prompts to calibrate: {len(estimator.samples)} "
+              f"of {TokenEstimator.MIN_SAMPLES}. Send a few requests first.")
+        return
+    estimator.save()
+    before, after = result
+    print("🧮 Tokens per " + ", ".join(f"{name}: {coefficient:.4f}" for name, coefficient
+                                       in zip(TokenEstimator.FEATURES, estimator.coefficients)))
+    print(f"Mean error over {len(estimator.samples)} prompts: {before:.1%} before, {after:.1%} after")
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description="AI Coding Agent - Terminal-based coding assistant")
     parser.add_argument("--api-key", help="API key for the Gemini API")
+    parser.add_argument("--fake", action="store_true", help="Use an offline fake client instead of the Gemini API")
+    parser.add_argument("--calibrate", action="store_true",
+                        help="Refit the local token estimator to the token counts of past requests, then exit")
     return parser.parse_args()
 
 if __name__ == "__main__":
     args = parse_arguments()
-    agent = AICodingAgent(api_key=args.api_key)
+    if args.calibrate:
+        calibrate_tokens(os.path.join(os.path.expanduser("~/.ai_coding_agent"), "tokens.json"))
+        sys.exit()
+    agent = AICodingAgent(api_key=args.api_key, client=FakeGenAIClient() if args.fake else None)
     agent.run()
\ No newline at end of file
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the ignore-file matcher
+
+Generates synthetic project paths (1M by default) and a .gitignore in the
+style of the common Python and Node templates, then compares three ways of
+excluding paths:
+
+- naive: every path tested against every pattern's regex in turn (the
+  matcher the walker started with)
+- compiled: IgnoreRules, with patterns compiled into dict lookups, a
+  path trie and combined regexes
+- pruned walk: the compiled matcher used while walking the synthetic
+  tree, so ignored directories are never entered
+
+The first two are checked against each other on every path.
+
+Usage:
+    python benchmarks/bench_ignore.py
+    python benchmarks/bench_ignore.py --paths 100000 --rules 200
+"""
+
+import os
+import re
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from ai_coding_agent import IgnoreRules, parse_ignore_patterns, _glob_to_regex
+
+GITIGNORE = """
+# Byte-compiled / optimized files
+__pycache__/
+*.py[cod]
+*$py.class
+*.so
+.Python
+develop-eggs/
+downloads/
+eggs/
+.eggs/
+lib64/
+parts/
+sdist/
+var/
+wheels/
+*.egg-info/
+.installed.cfg
+*.egg
+MANIFEST
+*.manifest
+*.spec
+pip-log.txt
+pip-delete-this-directory.txt
+htmlcov/
+.tox/
+.coverage
+.coverage.*
+.cache
+nosetests.xml
+coverage.xml
+*.cover
+.hypothesis/
+*.mo
+*.pot
+*.log
+local_settings.py
+db.sqlite3
+instance/
+.webassets-cache
+.scrapy
+docs/_build/
+target/
+.ipynb_checkpoints
+.python-version
+celerybeat-schedule
+*.sage.py
+.env
+.spyderproject
+.ropeproject
+/site
+.mypy_cache/
+logs
+*.pid
+*.seed
+*.pid.lock
+lib-cov
+.nyc_output
+.grunt
+bower_components
+.lock-wscript
+build/Release
+jspm_packages/
+typings/
+.npm
+.eslintcache
+*.tgz
+.yarn-integrity
+.next
+out/
+.nuxt
+.vuepress/dist
+.serverless/
+.fusebox/
+.dynamodb/
+**/generated/**
+!important.log
+"""
+
+DIRS = ["src", "lib", "app", "tests", "docs", "api", "components", "utils", "models", "views",
+        "logs", "out", "generated", "static", "assets", "core", "services", "handlers"]
+NAMES = ["index", "main", "util", "helpers", "config", "types", "server", "client", "model", "view"]
+EXTS = [".py", ".js", ".ts", ".tsx", ".css", ".html", ".json", ".md", ".pyc", ".log", ".so", ".tgz"]
+
+def make_paths(count, seed=0):
+    """Random project paths between one and six components deep"""
+    rng = random.Random(seed)
+    paths = []
+    for _ in range(count):
+        depth = rng.randint(0, 5)
+        parts = [rng.choice(DIRS) for _ in range(depth)]
+        parts.append(rng.choice(NAMES) + str(rng.randint(0, 50)) + rng.choice(EXTS))
+        paths.append("/".join(parts))
+    return paths
+
+def make_rules(extra):
+    """The template rules plus extra generated ones, as .gitignore text"""
+    rng = random.Random(1)
+    lines = [GITIGNORE]
+    for i in range(extra):
+        kind = i % 3
+        if kind == 0:
+            lines.append(f"generated_{i}.{rng.choice(['txt', 'bin', 'dat'])}")
+        elif kind == 1:
+            lines.append(f"/{rng.choice(DIRS)}/cache_{i}/")
+        else:
+            lines.append(f"*.tmp{i}")
+    return "\n".join(lines)
+
+class NaiveRules:
+    """Tests each pattern's regex in turn, last match wins"""
+
+    def __init__(self, text):
+        self.rules = []
+        for glob, anchored, negated, dir_only in parse_ignore_patterns(text):
+            regex = _glob_to_regex(glob)
+            if not anchored:
+                regex = '(?:.*/)?' + regex
+            self.rules.append((re.compile(regex + r'\Z'), negated, dir_only))
+
+    def ignored(self, path, is_dir):
+        for regex, negated, dir_only in reversed(self.rules):
+            if (is_dir or not dir_only) and regex.match(path):
+                return not negated
+        return False
+
+def build_tree(paths):
+    """Nested dicts of directories; files are keys mapping to None"""
+    tree = {}
+    for path in paths:
+        node = tree
+        parts = path.split("/")
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+            if node is None:
+                break
+        else:
+            node.setdefault(parts[-1], None)
+    return tree
+
+def walk_pruned(tree, rules):
+    """Walk the tree, never entering ignored directories; returns (kept files, checks)"""
+    kept = checks = 0
+    stack = [("", tree)]
+    while stack:
+        prefix, node = stack.pop()
+        for name, child in node.items():
+            path = prefix + name
+            checks += 1
+            if child is None:
+                if not rules.ignored(path, False):
+                    kept += 1
+            elif not rules.ignored(path, True):
+                stack.append((path + "/", child))
+    return kept, checks
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ignore-file matcher")
+    parser.add_argument("--paths", type=int, default=1000000, help="Number of synthetic paths")
+    parser.add_argument("--rules", type=int, default=0, help="Extra generated rules on top of the template")
+    args = parser.parse_args()
+
+    text = make_rules(args.rules)
+    paths = make_paths(args.paths)
+    naive = NaiveRules(text)
+    compiled = IgnoreRules(rules=parse_ignore_patterns(text), key="bench")
+    print(f"{len(paths)} paths, {len(naive.rules)} rules")
+
+    naive_seconds, naive_result = timed(lambda: [naive.ignored(p, False) for p in paths])
+    compiled_seconds, compiled_result = timed(lambda: [compiled.ignored(p, False) for p in paths])
+    mismatches = sum(a != b for a, b in zip(naive_result, compiled_result))
+    ignored = sum(compiled_result)
+
+    # Directory checks, since directory-only rules take a different path
+    dirs = sorted({p.rsplit("/", 1)[0] for p in paths if "/" in p})
+    mismatches += sum(naive.ignored(d, True) != compiled.ignored(d, True) for d in dirs)
+
+    print(f"{'matcher':<12} {'seconds':>8} {'paths/s':>12}")
+    print(f"{'naive':<12} {naive_seconds:8.2f} {len(paths) / naive_seconds:12,.0f}")
+    print(f"{'compiled':<12} {compiled_seconds:8.2f} {len(paths) / compiled_seconds:12,.0f}")
+
+    tree = build_tree(paths)
+    walk_seconds, (kept, checks) = timed(walk_pruned, tree, compiled)
+    print(f"{'pruned walk':<12} {walk_seconds:8.2f} {checks:>12,} checks, {kept:,} files kept")
+    print(f"{ignored:,} of {len(paths):,} paths ignored, {mismatches} mismatches")
+    if mismatches:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
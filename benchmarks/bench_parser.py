@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the streaming response parser
+
+Builds synthetic AI responses from 1 KB to 100 MB in four shapes, "many
+small" files (about 2 KB each), "few large" files (four per response),
+"long lines" (four files that are each a single line, like minified
+JavaScript) and "no newline" (the whole response one unterminated line),
+feeds them to ResponseParser in stream-sized chunks and reports throughput
+in MB/s plus the peak memory allocated while parsing (via tracemalloc).
+The original split-and-startswith parser is measured alongside for
+comparison.
+
+Usage:
+    python benchmarks/bench_parser.py
+    python benchmarks/bench_parser.py --sizes 1K 1M --chunk-size 512
+"""
+
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from ai_coding_agent import ResponseParser
+
+SIZE_UNITS = {"K": 1024, "M": 1024 * 1024}
+
+class NullHandler:
+    """Parser handler that only counts what it sees"""
+
+    def __init__(self):
+        self.files = 0
+        self.data_chars = 0
+        self.lines = 0
+
+    def on_text(self, line):
+        self.lines += 1
+
+    def on_file_start(self, path):
+        self.files += 1
+
+    def on_file_data(self, text):
+        self.data_chars += len(text)
+
+    def on_file_end(self):
+        pass
+
+    def on_patch(self, path, body):
+        pass
+
+    def on_dir(self, path):
+        pass
+
+    def on_cmd(self, command):
+        pass
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text[-1] in SIZE_UNITS:
+        return int(float(text[:-1]) * SIZE_UNITS[text[-1]])
+    return int(text)
+
+def make_response(total_size, file_size, fenced, single_line=False):
+    """Build a response of roughly total_size characters"""
+    if total_size and file_size is None:
+        # One line without any newline, e.g. a reply cut off mid-line
+        return ("x = [" + "1, " * (total_size // 3))[:total_size]
+    line = "    result = compute_something(value, other_value)  # synthetic\n"
+    lines_per_file = max(1, file_size // len(line))
+    body = line * lines_per_file
+    if single_line:
+        body = body.replace("\n", " ") + "\n"
+    if fenced:
+        body = "```python\n" + body + "```\n"
+
+    parts = ["Here is the implementation you asked for.\n"]
+    size = len(parts[0])
+    index = 0
+    while size < total_size:
+        block = f"FILE: src/module_{index}.py\n{body}Explanation of module {index}.\n"
+        parts.append(block)
+        size += len(block)
+        index += 1
+    parts.append("CMD: pip install -r requirements.txt\n")
+    return "".join(parts)
+
+def legacy_parse(response):
+    """The original post-hoc parser, without the side effects"""
+    current_mode = None
+    current_content = []
+    files = 0
+    for line in response.split('\n'):
+        if line.startswith("FILE: "):
+            if current_mode == "FILE" and current_content:
+                '\n'.join(current_content)
+                files += 1
+            current_mode = "FILE"
+            current_content = []
+        elif line.startswith("DIR: ") or line.startswith("CMD: "):
+            if current_mode == "FILE" and current_content:
+                '\n'.join(current_content)
+                files += 1
+            current_mode = None
+            current_content = []
+        elif current_mode == "FILE":
+            current_content.append(line)
+    return files
+
+def run_streaming(response, chunk_size):
+    parser = ResponseParser(NullHandler())
+    for start in range(0, len(response), chunk_size):
+        parser.feed(response[start:start + chunk_size])
+    parser.close()
+
+def measure(fn, *args, repeat=3):
+    """Return (best seconds, peak bytes allocated) for fn(*args)"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the AI response parser")
+    parser.add_argument("--sizes", nargs="+", default=["1K", "100K", "1M", "10M", "100M"],
+                        help="Response sizes to test (suffix K or M)")
+    parser.add_argument("--chunk-size", type=int, default=4096,
+                        help="Characters per streamed chunk")
+    parser.add_argument("--repeat", type=int, default=3, help="Timing runs per case (best is kept)")
+    args = parser.parse_args()
+
+    print(f"{'size':>6} {'shape':<11} {'fenced':<6} {'parser':<9} {'MB/s':>9} {'peak alloc':>12}")
+    for size_text in args.sizes:
+        total = parse_size(size_text)
+        repeat = args.repeat if total < 50 * SIZE_UNITS["M"] else 1
+        shapes = (("many-small", 2 * 1024, False), ("few-large", max(total // 4, 1), False),
+                  ("long-lines", max(total // 4, 1), True), ("no-newline", None, False))
+        for shape, file_size, single_line in shapes:
+            for fenced in (False, True) if file_size else (False,):
+                response = make_response(total, file_size, fenced, single_line)
+                megabytes = len(response) / SIZE_UNITS["M"]
+                cases = [("stream", run_streaming, (response, args.chunk_size))]
+                if not fenced:
+                    cases.append(("legacy", legacy_parse, (response,)))
+                for name, fn, fn_args in cases:
+                    seconds, peak = measure(fn, *fn_args, repeat=repeat)
+                    print(f"{size_text:>6} {shape:<11} {str(fenced):<6} {name:<9} "
+                          f"{megabytes / seconds:9.1f} {peak / 1024:10.1f}KB")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ai_coding_agent import AICodingAgent, FakeGenAIClient
+
+
+@pytest.fixture
+def make_agent(tmp_path, monkeypatch):
+    """Build an agent on a fresh home directory, answering with a canned reply"""
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+    agents = []
+
+    def make(reply=None, project="proj", tool_calls=None):
+        agent = AICodingAgent(api_key="test-key", client=FakeGenAIClient(reply, tool_calls))
+        agent.set_project(project)
+        agents.append(agent)
+        return agent
+
+    yield make
+    for agent in agents:
+        if agent.write_pool is not None:
+            agent.write_pool.shutdown()
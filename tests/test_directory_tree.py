@@ -0,0 +1,74 @@
+import os
+
+import pytest
+
+from ai_coding_agent import DirectoryTree
+
+FILES = {
+    "setup.py": "x = 1\n",
+    "api/server.py": "def serve():\n    pass\nclass Handler:\n    pass\ndef _private():\n    pass\n",
+    "api/README.md": "# API\n\nHTTP endpoints for orders.\n",
+    "api/routes/orders.py": "def list_orders():\n    pass\n",
+    "web/src/app.ts": "export function render() {}\n",
+    "web/src/style.css": "body {}\n",
+}
+
+
+def write(agent, path, text):
+    full = os.path.join(agent.project_path, path)
+    os.makedirs(os.path.dirname(full), exist_ok=True)
+    with open(full, "w") as f:
+        f.write(text)
+
+
+@pytest.fixture
+def agent(make_agent):
+    agent = make_agent()
+    for path, text in FILES.items():
+        write(agent, path, text)
+    agent.manifest.refresh()
+    return agent
+
+
+def render(agent, budget=10000):
+    return DirectoryTree(agent, agent.directory_digests).render(budget)
+
+
+def test_render_describes_each_directory(agent):
+    lines = render(agent).splitlines()
+    assert lines[0].startswith("Project tree (6 files, too many to list;")
+    assert lines[1:] == [
+        "Files in the root: setup.py",
+        "- api/ (3 files; Python 66%, Markdown 33%) defines serve, Handler - HTTP endpoints for orders.",
+        "  - api/routes/ (1 files; Python 100%) defines list_orders",
+        "- web/ (2 files; TypeScript 50%, CSS 50%)",
+        "  - web/src/ (2 files; TypeScript 50%, CSS 50%) defines render",
+    ]
+
+
+def test_budget_keeps_the_top_levels(agent):
+    full = render(agent).splitlines(keepends=True)
+    count = agent.token_estimator.count
+    top = [line for line in full if not line.startswith("  ")]
+    text = render(agent, sum(count(line) for line in top)).splitlines(keepends=True)
+    assert text == top + ["... 2 deeper directories not shown\n"]
+
+
+def test_edit_changes_only_the_hashes_above_it(agent):
+    before = DirectoryTree(agent, agent.directory_digests)
+    before.build()
+    write(agent, "api/routes/orders.py", "def list_orders():\n    return []\n")
+    agent.manifest.refresh()
+    after = DirectoryTree(agent, agent.directory_digests)
+    after.build()
+    changed = {directory for directory in before.hashes if before.hashes[directory] != after.hashes[directory]}
+    assert changed == {"", "api", os.path.join("api", "routes")}
+
+
+def test_digests_are_reused_from_the_store(agent, monkeypatch):
+    render(agent)
+    outlined = []
+    monkeypatch.setattr(agent, "outline_file", lambda path: outlined.append(path))
+    monkeypatch.setattr(agent, "read_file", lambda path: outlined.append(path))
+    assert "defines list_orders" in render(agent)
+    assert outlined == []
@@ -0,0 +1,36 @@
+import os
+
+from ai_coding_agent import StreamingActionEngine
+
+
+def feed_in_chunks(engine, text, size=7):
+    for i in range(0, len(text), size):
+        engine.feed(text[i:i + size])
+    engine.close()
+
+
+def read(agent, path):
+    with open(os.path.join(agent.project_path, path)) as f:
+        return f.read()
+
+
+def test_streamed_blocks_are_applied(make_agent):
+    agent = make_agent()
+    engine = StreamingActionEngine(agent)
+    feed_in_chunks(engine, "Setting up.\nDIR: static\nFILE: app.py\nprint('hi')\nFILE: README\nhello\n")
+    assert os.path.isdir(os.path.join(agent.project_path, "static"))
+    assert read(agent, "app.py") == "print('hi')"
+    assert read(agent, "README") == "hello\n"
+
+
+def test_files_are_written_before_a_later_command_runs(make_agent):
+    agent = make_agent()
+    engine = StreamingActionEngine(agent)
+    feed_in_chunks(engine, "FILE: a.txt\nsource\nCMD: cp a.txt b.txt\n")
+    assert read(agent, "b.txt") == "source"
+
+
+def test_query_applies_file_blocks(make_agent):
+    agent = make_agent(reply="Creating it.\nFILE: hello.py\n```python\nprint('hello')\n```\n")
+    agent.query_model("write hello.py")
+    assert read(agent, "hello.py") == "print('hello')\n"
@@ -0,0 +1,62 @@
+import pytest
+
+from ai_coding_agent import ExcerptFinder, find_line_references
+
+
+def functions(count, start=0):
+    return "".join(f"def func_{i}(x):\n    y = x + {i}\n    return y\n\n" for i in range(start, start + count))
+
+
+@pytest.fixture
+def big_file(tmp_path):
+    path = tmp_path / "big.py"
+    path.write_text(functions(50)
+                    + "def parse_invoice(data):\n    total = 0\n    for row in data:\n        total += row\n    return total\n\n"
+                    + "def long_function():\n" + "".join(f"    step_{i}()\n" for i in range(10))
+                    + "    target_call()\n" + "".join(f"    step_{i}()\n" for i in range(10, 100)) + "\n"
+                    + functions(150, 50))
+    return str(path)
+
+
+def test_short_block_of_a_hit_is_shown_whole(big_file):
+    line_count, excerpt = ExcerptFinder().find(big_file, {"parse_invoice"}, set())
+    assert line_count == 909
+    assert excerpt.splitlines() == [
+        "...",
+        "201: def parse_invoice(data):",
+        "202:     total = 0",
+        "203:     for row in data:",
+        "204:         total += row",
+        "205:     return total",
+        "...",
+    ]
+
+
+def test_long_block_shows_context_and_definition_line(big_file):
+    excerpt = ExcerptFinder().find(big_file, {"target_call"}, set())[1].splitlines()
+    assert excerpt == ["...", "207: def long_function():", "..."] + [
+        f"{208 + i}:     step_{i}()" for i in range(7, 10)] + ["218:     target_call()"] + [
+        f"{209 + i}:     step_{i}()" for i in range(10, 13)] + ["..."]
+
+
+def test_referenced_line_widens_to_its_function(big_file):
+    excerpt = ExcerptFinder().find(big_file, set(), {30})[1]
+    assert excerpt == "...\n29: def func_7(x):\n30:     y = x + 7\n31:     return y\n..."
+
+
+def test_no_hits_gives_an_empty_excerpt(big_file):
+    assert ExcerptFinder().find(big_file, {"nowhere"}, set()) == (909, "")
+
+
+def test_memory_mapped_read_gives_the_same_excerpt(big_file):
+    finder = ExcerptFinder()
+    finder.MMAP_BYTES = 1
+    assert finder.find(big_file, {"parse_invoice"}, {30}) == ExcerptFinder().find(big_file, {"parse_invoice"}, {30})
+
+
+def test_find_line_references():
+    text = ('Traceback (most recent call last):\n'
+            '  File "src\\app.py", line 12, in main\n'
+            'src/view.ts:40:3 - error TS2345\n'
+            './main.go:7: undefined: x\n')
+    assert find_line_references(text) == [("src/app.py", 12), ("src/view.ts", 40), ("./main.go", 7)]
@@ -0,0 +1,55 @@
+import os
+
+from ai_coding_agent import IgnoreRules, parse_ignore_patterns
+
+
+def rules_for(text, parent=None, base=os.curdir):
+    return IgnoreRules(parent, base, parse_ignore_patterns(text))
+
+
+def test_last_matching_rule_wins():
+    rules = rules_for("*.log\n!keep.log\n")
+    assert rules.ignored("debug.log", False)
+    assert not rules.ignored("keep.log", False)
+    assert not rules.ignored("app.py", False)
+
+
+def test_directory_only_pattern():
+    rules = rules_for("out/\n")
+    assert rules.ignored("out", True)
+    assert not rules.ignored("out", False)
+
+
+def test_anchored_pattern_only_matches_at_its_base():
+    rules = rules_for("/todo.txt\nsrc/*.tmp\n")
+    assert rules.ignored("todo.txt", False)
+    assert not rules.ignored("docs/todo.txt", False)
+    assert rules.ignored("src/a.tmp", False)
+    assert not rules.ignored("lib/src/a.tmp", False)
+
+
+def test_nested_rules_override_parents():
+    parent = rules_for("*.gen\n")
+    child = rules_for("!keep.gen\n", parent, "pkg")
+    assert child.ignored("pkg/other.gen", False)
+    assert not child.ignored("pkg/keep.gen", False)
+
+
+def test_double_star_and_character_classes():
+    rules = rules_for("docs/**/*.md\n*.py[co]\n**/tmp\n")
+    assert rules.ignored("docs/a/b/c.md", False)
+    assert rules.ignored("docs/c.md", False)
+    assert not rules.ignored("src/c.md", False)
+    assert rules.ignored("pkg/mod.pyc", False)
+    assert not rules.ignored("pkg/mod.py", False)
+    assert rules.ignored("a/b/tmp", True)
+
+
+def test_many_rules_keep_last_match_semantics():
+    text = "".join(f"gen{i}/\n!gen{i}/keep\n" for i in range(300)) + "*.bak\n!important.bak\n"
+    rules = rules_for(text)
+    assert rules.ignored("gen42", True)
+    assert not rules.ignored("gen42/keep", False)
+    assert not rules.ignored("gen300", True)
+    assert rules.ignored("x/old.bak", False)
+    assert not rules.ignored("important.bak", False)
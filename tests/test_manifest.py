@@ -0,0 +1,71 @@
+import os
+import time
+
+from ai_coding_agent import ProjectManifest
+
+
+def write(root, rel_path, text="x"):
+    path = os.path.join(root, rel_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def test_saved_manifest_warm_starts_without_listing(tmp_path, monkeypatch):
+    root = str(tmp_path / "proj")
+    store = str(tmp_path / "manifest.json")
+    write(root, "a.py")
+    write(root, "pkg/b.py")
+    # Old directory mtimes, so the first scan is not treated as racy
+    for directory in (root, os.path.join(root, "pkg")):
+        os.utime(directory, (time.time() - 60, time.time() - 60))
+    ProjectManifest(root, store).refresh()
+
+    listed = []
+    real_scandir = os.scandir
+    monkeypatch.setattr(os, "scandir", lambda path: listed.append(path) or real_scandir(path))
+    second = ProjectManifest(root, store)
+    second.refresh()
+    assert sorted(second.files) == ["a.py", os.path.join("pkg", "b.py")]
+    assert listed == []
+
+
+def test_new_and_deleted_files_are_picked_up(tmp_path):
+    root = str(tmp_path)
+    write(root, "a.py")
+    manifest = ProjectManifest(root)
+    manifest.refresh()
+    write(root, "b.py")
+    os.unlink(os.path.join(root, "a.py"))
+    manifest.refresh()
+    assert sorted(manifest.files) == ["b.py"]
+
+
+def test_check_drops_vanished_and_non_regular_entries(tmp_path):
+    root = str(tmp_path)
+    write(root, "a.py")
+    manifest = ProjectManifest(root)
+    manifest.refresh()
+    os.unlink(os.path.join(root, "a.py"))
+    os.mkdir(os.path.join(root, "a.py"))
+    assert manifest.check("a.py") is None
+    assert "a.py" not in manifest.files
+
+
+def test_symlink_to_outside_file_is_not_recorded(tmp_path):
+    root = tmp_path / "proj"
+    root.mkdir()
+    (tmp_path / "secret.txt").write_text("secret")
+    os.symlink(tmp_path / "secret.txt", root / "link.txt")
+    manifest = ProjectManifest(str(root))
+    manifest.refresh()
+    assert "link.txt" not in manifest.files
+
+
+def test_read_file_rejects_paths_outside_the_project(make_agent, tmp_path):
+    agent = make_agent()
+    (tmp_path / "outside.txt").write_text("secret")
+    assert agent.read_file(os.path.relpath(tmp_path / "outside.txt", agent.project_path)) is None
+    assert agent.read_file(str(tmp_path / "outside.txt")) is None
+    write(agent.project_path, "inside.txt", "ok")
+    assert agent.read_file("./inside.txt") == "ok"
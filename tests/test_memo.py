@@ -0,0 +1,46 @@
+import os
+
+from ai_coding_agent import ContextMemo
+
+
+def write(agent, rel_path, text):
+    with open(os.path.join(agent.project_path, rel_path), "w") as f:
+        f.write(text)
+
+
+def test_same_request_reuses_the_assembled_context(make_agent, monkeypatch):
+    agent = make_agent()
+    write(agent, "app.py", "def main():\n    pass\n")
+    first = agent.gather_project_context("explain main in app.py")
+    reads = []
+    monkeypatch.setattr(agent, "read_files", lambda paths, max_bytes: reads.append(paths) or {})
+    monkeypatch.setattr(agent, "read_file", lambda path: reads.append(path))
+    assert agent.gather_project_context("explain main in app.py") == first
+    assert reads == []
+
+
+def test_edit_in_place_invalidates_the_context(make_agent):
+    agent = make_agent()
+    path = os.path.join(agent.project_path, "app.py")
+    write(agent, "app.py", "def main():\n    pass\n")
+    first = agent.gather_project_context("explain main in app.py")
+    write(agent, "app.py", "def main():\n    return 42\n")
+    os.utime(path, ns=(1, 1))
+    second = agent.gather_project_context("explain main in app.py")
+    assert second != first
+    assert "return 42" in second
+
+
+def test_sync_drops_whole_list_state_only_on_a_new_generation():
+    memo = ContextMemo()
+    memo.sync(1)
+    memo.listing = "files"
+    memo.indexed = True
+    memo.sections["a.py"] = {"whole": 10}
+    memo.sync(1)
+    assert memo.listing == "files" and memo.indexed
+    memo.sync(2)
+    assert memo.listing is None and not memo.indexed
+    assert memo.sections == {"a.py": {"whole": 10}}
+    memo.forget("a.py")
+    assert memo.sections == {}
@@ -0,0 +1,105 @@
+import hashlib
+
+from ai_coding_agent import OutlineCache, extract_outline, outline_kind
+
+PYTHON = '''"""Order handling.
+
+Details nobody needs in an outline."""
+import os
+from shop.models import (Order,
+                         Customer)
+MAX_ITEMS = 50
+counter = 0
+
+
+@cached
+def total(order,
+          tax):
+    """Sum of the order lines plus tax."""
+    return sum(order.lines) * tax
+
+
+class Cart(Base):
+    """A customer's cart."""
+    def add(self, item): self.items.append(item)
+    size = 0
+
+    async def checkout(self):
+        pass
+
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+'''
+
+
+def test_python_outline_keeps_signatures_and_docstrings():
+    assert extract_outline("shop/orders.py", PYTHON).splitlines() == [
+        '1: """Order handling."""',
+        "4: import os",
+        "5: from shop.models import (Order, Customer)",
+        "7: MAX_ITEMS = 50",
+        "11: @cached",
+        "12: def total(order, tax):",
+        '14:     """Sum of the order lines plus tax."""',
+        "18: class Cart(Base):",
+        '19:     """A customer\'s cart."""',
+        "20:     def add(self, item): self.items.append(item)",
+        "23:     async def checkout(self):",
+        "28: import ujson as json",
+        "30: import json",
+    ]
+
+
+def test_invalid_python_falls_back_to_definition_lines():
+    assert extract_outline("broken.py", "def broken(:\n    pass\nclass Kept:\n") == "1: def broken(:\n3: class Kept:"
+
+
+def test_script_outline_skips_strings_and_bodies():
+    source = ('import x from "y";\n'
+              "/** Makes a thing. */\n"
+              "export function make(a, b) {\n"
+              '  const s = "function fake() {}";\n'
+              "  return a;\n"
+              "}\n"
+              "export const handler = async (req) => {\n"
+              "};\n")
+    assert extract_outline("src/app.js", source).splitlines() == [
+        '1: import x from "y";',
+        "2: /** Makes a thing. */",
+        "3: export function make(a, b)",
+        "7: export const handler = async (req) =>",
+    ]
+
+
+def test_other_files_outline_headings_and_definitions():
+    assert extract_outline("README.md", "# Title\ntext\n## Usage\n") == "1: # Title\n3: ## Usage"
+
+
+def test_outline_kind():
+    assert outline_kind("stubs/a.PYI") == "python"
+    assert outline_kind("web/App.tsx") == "script"
+    assert outline_kind("Makefile") == "lines"
+
+
+def test_outline_cache_keys_by_kind_and_content(tmp_path):
+    text = "def f():\n    return 1\n"
+    digest = hashlib.sha256(text.encode()).hexdigest()
+    reads = []
+
+    def read():
+        reads.append(1)
+        return text
+
+    store_path = str(tmp_path / "outlines.json")
+    cache = OutlineCache(store_path)
+    assert cache.get(digest, "a.py", read) == (2, "1: def f():")
+    assert cache.get(digest, "copy/b.py", read) == (2, "1: def f():")
+    assert len(reads) == 1
+    cache.get(digest, "a.txt", read)
+    assert len(reads) == 2
+    cache.save()
+    assert OutlineCache(store_path).get(digest, "a.py", read) == (2, "1: def f():")
+    assert len(reads) == 2
@@ -0,0 +1,59 @@
+import os
+
+
+def write(agent, rel_path, text):
+    path = os.path.join(agent.project_path, rel_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def decisions(agent):
+    return {path: (form, reason) for path, form, _, reason in agent.context_report.report}
+
+
+def filler(agent, count=30):
+    for i in range(count):
+        write(agent, f"pkg/mod{i}.py", f"def helper{i}():\n    return {i}\n" * 40)
+
+
+def test_named_dotfiles_are_included(make_agent):
+    agent = make_agent()
+    filler(agent)
+    write(agent, ".eslintrc.json", '{"rules": {}}\n')
+    write(agent, ".env", "DEBUG=1\n")
+    write(agent, ".github/workflows/ci.yml", "on: push\n")
+    agent.gather_project_context("please fix .eslintrc.json, .env and ./.github/workflows/ci.yml")
+    packed = decisions(agent)
+    for path in (".eslintrc.json", ".env", os.path.join(".github", "workflows", "ci.yml")):
+        form, reason = packed[path]
+        assert form == "whole"
+        assert reason.startswith("named in request")
+
+
+def test_dot_slash_prefix_and_backslashes_are_normalized(make_agent):
+    agent = make_agent()
+    filler(agent)
+    write(agent, "src/app.py", "print('app')\n")
+    agent.gather_project_context("look at .\\src\\app.py")
+    assert decisions(agent)[os.path.join("src", "app.py")][1].startswith("named in request")
+
+
+def test_stack_trace_references_to_dotfiles(make_agent):
+    agent = make_agent()
+    filler(agent)
+    write(agent, ".eslintrc.js", "module.exports = {};\n" * 20)
+    write(agent, "server.js", "const a = 1;\n" * 20)
+    agent.gather_project_context("SyntaxError at ./.eslintrc.js:12:5 via ./server.js:3")
+    assert "stack trace points at line 12" in decisions(agent)[".eslintrc.js"][1]
+    assert "stack trace points at line 3" in decisions(agent)["server.js"][1]
+
+
+def test_context_stays_within_budget(make_agent):
+    agent = make_agent()
+    agent.config["context_token_budget"] = 3000
+    filler(agent, 60)
+    write(agent, "big.py", "".join(f"def function_{i}(value):\n    return value * {i}\n\n" for i in range(600)))
+    agent.gather_project_context("why does function_150 in big.py return the wrong value")
+    assert agent.context_report.used <= agent.context_report.budget
+    assert decisions(agent)["big.py"][0] in ("excerpt", "outline")
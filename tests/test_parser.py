@@ -0,0 +1,127 @@
+import random
+
+import pytest
+
+from ai_coding_agent import ResponseParser
+
+
+class Recorder:
+    """Handler that records parser events, merging consecutive file data"""
+
+    def __init__(self):
+        self.events = []
+
+    def on_text(self, line):
+        self.events.append(("text", line))
+
+    def on_file_start(self, path):
+        self.events.append(("file", path))
+
+    def on_file_data(self, text):
+        if self.events and self.events[-1][0] == "data":
+            self.events[-1] = ("data", self.events[-1][1] + text)
+        else:
+            self.events.append(("data", text))
+
+    def on_file_end(self):
+        self.events.append(("end",))
+
+    def on_patch(self, path, body):
+        self.events.append(("patch", path, body))
+
+    def on_dir(self, path):
+        self.events.append(("dir", path))
+
+    def on_cmd(self, command):
+        self.events.append(("cmd", command))
+
+
+def parse(text, max_chunk=None, seed=0):
+    recorder = Recorder()
+    parser = ResponseParser(recorder)
+    if max_chunk is None:
+        parser.feed(text)
+    else:
+        rng = random.Random(seed)
+        i = 0
+        while i < len(text):
+            n = rng.randint(1, max_chunk)
+            parser.feed(text[i:i + n])
+            i += n
+    parser.close()
+    return recorder.events
+
+
+SAMPLES = [
+    "intro\nFILE: a.py\n```python\nx = 1\n  ```\n```\nafter\n",
+    "FILE: b.txt\n" + "y" * 5000 + "\nFILE: c\nz\nCMD: ls\n",
+    "FILE: b.txt\n\n\n" + "y" * 5000 + "\n\nFILE: c\n\n  \n" + "z" * 300,
+    "FILE: d\n```\nabc" + "q" * 3000 + "\n   ``\n``` \ntail\n",
+    "FILE: e\nFILE: f\n   \n\nFI\nFILE:x\nPATCH: g\n<<<<<<< SEARCH\n" + "w" * 2000
+    + "\n=======\nv\n>>>>>>> REPLACE\nDIR: h\n",
+    "FILE: i\n~~~\n" + " " * 100 + "~~~\n~~~\n",
+    "FILE: j\n" + "k" * 999,
+    "FILE: j\n```\n" + "k" * 999 + "\n```",
+    "FILE: j\n  ``" + "k" * 999 + "\n```",
+    "FILE: j\n" + " " * 200 + "```js\nx\n```\n",
+    "FILE: m\n" + "\t" * 70 + "x\n" + "CM",
+]
+
+
+@pytest.mark.parametrize("text", SAMPLES)
+@pytest.mark.parametrize("max_chunk", [1, 2, 3, 7, 50, 333])
+def test_chunk_boundaries_do_not_change_events(text, max_chunk):
+    assert parse(text, max_chunk) == parse(text)
+
+
+def test_fenced_file_block_drops_fences():
+    events = parse("Here it is\nFILE: app.py\n```python\nprint(1)\n```\nDone")
+    assert events == [
+        ("text", "Here it is"),
+        ("file", "app.py"),
+        ("data", "print(1)\n"),
+        ("end",),
+        ("text", "Done"),
+    ]
+
+
+def test_unfenced_block_runs_to_next_marker():
+    events = parse("FILE: a.txt\none\ntwo\nDIR: src\nCMD: make")
+    assert events == [
+        ("file", "a.txt"),
+        ("data", "one\ntwo"),
+        ("end",),
+        ("dir", "src"),
+        ("cmd", "make"),
+    ]
+
+
+def test_marker_split_across_chunks():
+    recorder = Recorder()
+    parser = ResponseParser(recorder)
+    for piece in ["FILE: a\nx\nFI", "LE: b\ny\nCM", "D: ls"]:
+        parser.feed(piece)
+    parser.close()
+    assert recorder.events == [
+        ("file", "a"), ("data", "x"), ("end",),
+        ("file", "b"), ("data", "y"), ("end",),
+        ("cmd", "ls"),
+    ]
+
+
+def test_long_line_streams_before_newline():
+    recorder = Recorder()
+    parser = ResponseParser(recorder)
+    parser.feed("FILE: data.json\n")
+    parser.feed("{" + "x" * 10000)
+    assert recorder.events[-1][0] == "data"
+    assert len(recorder.events[-1][1]) > 9000
+    parser.feed("}\nFILE: b")
+    parser.close()
+    assert recorder.events[1:3] == [("data", "{" + "x" * 10000 + "}"), ("end",)]
+
+
+def test_patch_block_is_reported_whole():
+    body = "<<<<<<< SEARCH\nold\n=======\nnew\n>>>>>>> REPLACE"
+    events = parse("PATCH: a.py\n" + body, max_chunk=3)
+    assert events == [("patch", "a.py", body)]
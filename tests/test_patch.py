@@ -0,0 +1,70 @@
+import os
+
+import pytest
+
+from ai_coding_agent import PatchError, apply_patch, parse_patch
+
+
+def test_search_replace_block():
+    content = "def f():\n    return 1\n"
+    hunks = parse_patch("<<<<<<< SEARCH\n    return 1\n=======\n    return 2\n>>>>>>> REPLACE")
+    assert apply_patch(content, hunks) == ("def f():\n    return 2\n", 0)
+
+
+def test_unified_diff_hunk():
+    content = "a\nb\nc\n"
+    hunks = parse_patch("@@ -1,3 +1,3 @@\n a\n-b\n+B\n c")
+    assert apply_patch(content, hunks) == ("a\nB\nc\n", 0)
+
+
+def test_line_hint_picks_the_closest_duplicate():
+    content = "x = 1\ny\nx = 1\nz\n"
+    hunks = parse_patch("@@ -3,1 +3,1 @@\n-x = 1\n+x = 2")
+    assert apply_patch(content, hunks)[0] == "x = 1\ny\nx = 2\nz\n"
+
+
+def test_indentation_only_match_is_reindented():
+    content = "class A:\n    def f(self):\n        return 1\n"
+    hunks = parse_patch("<<<<<<< SEARCH\ndef f(self):\n    return 1\n=======\n"
+                        "def f(self):\n    x = 1\n    return x\n>>>>>>> REPLACE")
+    new, fuzzy = apply_patch(content, hunks)
+    assert fuzzy == 1
+    assert new == "class A:\n    def f(self):\n        x = 1\n        return x\n"
+
+
+def test_inconsistent_indentation_is_refused():
+    content = "if a:\n    x = 1\ny = 2\n"
+    hunks = parse_patch("<<<<<<< SEARCH\n  x = 1\n  y = 2\n=======\n  x = 3\n  y = 4\n>>>>>>> REPLACE")
+    with pytest.raises(PatchError, match="indented inconsistently"):
+        apply_patch(content, hunks)
+
+
+def test_missing_context_raises():
+    hunks = parse_patch("<<<<<<< SEARCH\nnot there\n=======\nnew\n>>>>>>> REPLACE")
+    with pytest.raises(PatchError, match="context not found"):
+        apply_patch("something else entirely\n", hunks)
+
+
+def test_unterminated_block_raises():
+    with pytest.raises(PatchError):
+        parse_patch("<<<<<<< SEARCH\nold\n=======\nnew\n")
+
+
+def test_body_without_hunks_raises():
+    with pytest.raises(PatchError):
+        parse_patch("just some text")
+
+
+def test_crlf_content_keeps_its_line_endings():
+    hunks = parse_patch("<<<<<<< SEARCH\nb\n=======\nB\n>>>>>>> REPLACE")
+    assert apply_patch("a\r\nb\r\nc\r\n", hunks) == ("a\r\nB\r\nc\r\n", 0)
+
+
+def test_patch_block_rewrites_only_the_patched_lines(make_agent):
+    agent = make_agent()
+    path = os.path.join(agent.project_path, "win.txt")
+    with open(path, "wb") as f:
+        f.write(b"a\r\nb\r\nc\r\n")
+    agent.process_ai_response("PATCH: win.txt\n<<<<<<< SEARCH\nb\n=======\nB\n>>>>>>> REPLACE\n")
+    with open(path, "rb") as f:
+        assert f.read() == b"a\r\nB\r\nc\r\n"
@@ -0,0 +1,89 @@
+import os
+import time
+
+from google.genai import errors
+
+
+def write_modules(agent, count=5):
+    for i in range(count):
+        with open(os.path.join(agent.project_path, f"mod{i}.py"), "w") as f:
+            f.write(f"def f{i}():\n    return {i}\n" * 50)
+
+
+def caching_agent(make_agent):
+    agent = make_agent()
+    agent.prompt_cache.min_tokens = 10
+    write_modules(agent)
+    return agent
+
+
+def fail_cached_requests(agent, code, status):
+    """Make every streamed request that names a cache fail with an API error"""
+    stream = agent.client.models.generate_content_stream
+    sent = []
+
+    def failing(**kwargs):
+        sent.append(kwargs["config"].cached_content)
+        if kwargs["config"].cached_content:
+            raise errors.APIError(code, {"error": {"code": code, "status": status, "message": status}})
+        return stream(**kwargs)
+
+    agent.client.models.generate_content_stream = failing
+    return sent
+
+
+def test_context_cache_is_reused(make_agent):
+    agent = caching_agent(make_agent)
+    agent.query_model("explain mod1")
+    name = agent.prompt_cache.name
+    assert name
+    agent.query_model("explain mod2")
+    assert agent.prompt_cache.name == name
+    assert agent.client.caches.created == 1
+
+
+def test_vanished_cache_is_recreated(make_agent, capsys):
+    agent = caching_agent(make_agent)
+    agent.query_model("explain mod1")
+    name = agent.prompt_cache.name
+    agent.client.caches.delete(name=name)
+    agent.query_model("explain mod3")
+    assert agent.prompt_cache.name not in (None, name)
+    assert agent.prompt_cache.disabled_until == 0
+    assert "Error" not in capsys.readouterr().out
+
+
+def test_server_error_keeps_the_cache(make_agent):
+    agent = caching_agent(make_agent)
+    agent.query_model("explain mod1")
+    name = agent.prompt_cache.name
+    sent = fail_cached_requests(agent, 500, "INTERNAL")
+    agent.query_model("explain mod2")
+    assert sent == [name, None]
+    assert agent.prompt_cache.name == name
+    assert list(agent.client.caches.entries) == [name]
+    assert agent.prompt_cache.disabled_until == 0
+
+
+def test_rejected_cache_is_deleted(make_agent):
+    agent = caching_agent(make_agent)
+    agent.query_model("explain mod1")
+    name = agent.prompt_cache.name
+    sent = fail_cached_requests(agent, 400, "INVALID_ARGUMENT")
+    agent.query_model("explain mod2")
+    assert sent == [name, None]
+    assert agent.prompt_cache.name is None
+    assert agent.client.caches.entries == {}
+
+
+def test_quota_error_backs_off(make_agent):
+    agent = caching_agent(make_agent)
+
+    def exhausted(**kwargs):
+        raise errors.ClientError(429, {"error": {"code": 429, "status": "RESOURCE_EXHAUSTED",
+                                                 "message": "quota"}})
+
+    agent.client.caches.create = exhausted
+    agent.query_model("explain mod2")
+    assert agent.prompt_cache.name is None
+    assert agent.prompt_cache.disabled_until > time.time()
@@ -0,0 +1,42 @@
+import os
+import time
+
+from ai_coding_agent import _common_prefix_length
+
+
+def write(agent, rel_path, text, mtime_ns=None):
+    path = os.path.join(agent.project_path, rel_path)
+    with open(path, "w") as f:
+        f.write(text)
+    if mtime_ns is not None:
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_common_prefix_length():
+    assert _common_prefix_length(b"", b"abc") == 0
+    assert _common_prefix_length(b"abcdef", b"abcxyz") == 3
+    assert _common_prefix_length(b"abc", b"abcdef") == 3
+    assert _common_prefix_length(b"x" * 100000 + b"a", b"x" * 100000 + b"b") == 100000
+
+
+def test_files_edited_this_session_come_last(make_agent):
+    agent = make_agent()
+    old = time.time_ns() - 3600 * 10 ** 9
+    write(agent, "older.py", "def older_helper():\n    pass\n", old)
+    write(agent, "old.py", "def old_helper():\n    pass\n", old + 10 ** 9)
+    write(agent, "edited.py", "def edited_helper():\n    pass\n")
+    context = agent.gather_project_context("older_helper old_helper edited_helper in older.py old.py edited.py")
+    positions = [context.index(f"Content of {name}") for name in ("older.py", "old.py", "edited.py")]
+    assert positions == sorted(positions)
+
+
+def test_stable_head_does_not_depend_on_the_request(make_agent):
+    agent = make_agent()
+    old = time.time_ns() - 3600 * 10 ** 9
+    write(agent, "a.py", "def alpha():\n    pass\n", old)
+    write(agent, "b.py", "def beta():\n    pass\n", old)
+    first = agent.gather_project_context("change alpha in a.py and beta in b.py")
+    first_head = first[:agent.context_split]
+    second = agent.gather_project_context("now rename beta in b.py and alpha in a.py")
+    assert agent.context_split > 0
+    assert second[:agent.context_split] == first_head
@@ -0,0 +1,53 @@
+import os
+import threading
+
+import pytest
+
+import ai_coding_agent
+
+
+@pytest.fixture
+def agent(make_agent):
+    agent = make_agent()
+    for name, data in {"a.txt": b"alpha\r\n", "b.txt": b"beta", "big.txt": b"x" * 100,
+                       "image.png": b"\x89PNG\0\0data"}.items():
+        with open(os.path.join(agent.project_path, name), "wb") as f:
+            f.write(data)
+    agent.manifest.refresh()
+    return agent
+
+
+def test_contents_come_back_in_the_order_given(agent):
+    contents = agent.read_files(["b.txt", "./a.txt", "b.txt", "gone.txt"], max_bytes=50)
+    assert list(contents.items()) == [("b.txt", "beta"), ("a.txt", "alpha\n"), ("gone.txt", None)]
+
+
+def test_large_and_binary_files_are_none_and_not_cached(agent):
+    assert agent.read_files(["big.txt", "image.png"], max_bytes=50) == {"big.txt": None, "image.png": None}
+    assert "big.txt" not in agent.file_cache
+    assert "image.png" not in agent.file_cache
+    assert agent.read_files(["big.txt"], max_bytes=200) == {"big.txt": "x" * 100}
+
+
+def test_changed_file_is_read_again(agent):
+    agent.read_files(["b.txt"], max_bytes=50)
+    path = os.path.join(agent.project_path, "b.txt")
+    with open(path, "w") as f:
+        f.write("changed")
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert agent.read_files(["b.txt"], max_bytes=50) == {"b.txt": "changed"}
+
+
+def test_files_are_read_in_parallel(agent, monkeypatch):
+    agent.config["read_workers"] = 3
+    barrier = threading.Barrier(3, timeout=5)
+    read_text = ai_coding_agent._read_text
+
+    def together(path, max_bytes):
+        barrier.wait()
+        return read_text(path, max_bytes)
+
+    monkeypatch.setattr(ai_coding_agent, "_read_text", together)
+    contents = agent.read_files(["a.txt", "b.txt", "big.txt"], max_bytes=200)
+    assert contents == {"a.txt": "alpha\n", "b.txt": "beta", "big.txt": "x" * 100}
@@ -0,0 +1,98 @@
+import os
+
+import pytest
+
+from ai_coding_agent import ProjectManifest, RelevanceIndex
+
+
+@pytest.fixture
+def project(tmp_path):
+    root = tmp_path / "proj"
+    root.mkdir()
+    (root / "auth.py").write_text("def login(user, password):\n    return check_password(user, password)\n")
+    (root / "models.py").write_text("class UserModel:\n    table = 'users'\n    def save(self): pass\n")
+    (root / "views.py").write_text("def render_home(request):\n    return template('home')\n")
+    manifest = ProjectManifest(str(root))
+    manifest.refresh()
+    return str(root), manifest, str(tmp_path / "index" / "proj")
+
+
+def open_index(project, vector_weight=0.0):
+    root, manifest, store = project
+    index = RelevanceIndex(root, store, vector_weight)
+    read = index.update(sorted(manifest.files), manifest)
+    return index, read
+
+
+def log_lines(store):
+    if not os.path.exists(store + ".log"):
+        return 0
+    with open(store + ".log") as f:
+        return len(f.readlines())
+
+
+def test_search_ranks_matching_content_first(project):
+    index, _ = open_index(project)
+    results = index.search("login password check")
+    assert results[0][0] == "auth.py"
+    assert results[0][1] == 1.0
+
+
+def test_saved_index_is_reused(project):
+    index, read = open_index(project)
+    assert read == 3
+    index.save()
+    again, read = open_index(project)
+    assert read == 0
+    assert again.search("UserModel table") == index.search("UserModel table")
+
+
+def test_changed_file_is_indexed_again(project):
+    root, manifest, _ = project
+    index, _ = open_index(project)
+    index.save()
+    with open(os.path.join(root, "views.py"), "w") as f:
+        f.write("def login_page(request):\n    return template('login')\n")
+    os.utime(os.path.join(root, "views.py"), ns=(1, 1))
+    manifest.check("views.py")
+    again, read = open_index(project)
+    assert read == 1
+    assert {path for path, _ in again.search("login_page template")} >= {"views.py"}
+
+
+def test_rejected_index_is_rewritten_not_logged(project):
+    pytest.importorskip("numpy")
+    _, _, store = project
+    index, _ = open_index(project, 0.0)
+    index.save()
+    # Turning vectors on makes the saved index unusable once...
+    index, read = open_index(project, 0.5)
+    assert read == 3
+    index.save()
+    assert log_lines(store) == 0
+    # ...after which it is used again
+    index, read = open_index(project, 0.5)
+    assert read == 0
+    index.save()
+    assert log_lines(store) == 0
+
+
+def test_torn_log_is_folded_into_a_new_base(project):
+    root, manifest, store = project
+    index, _ = open_index(project)
+    index.save()
+    with open(os.path.join(root, "extra.py"), "w") as f:
+        f.write("def extra_feature(): pass\n")
+    manifest.refresh()
+    index, read = open_index(project)
+    assert read == 1
+    index.save()
+    assert log_lines(store) == 1
+    with open(store + ".log", "a") as f:
+        f.write('{"path": "torn')
+    index, read = open_index(project)
+    index.save()
+    assert log_lines(store) == 0
+    index, read = open_index(project)
+    assert read == 0
+    assert index.search("extra_feature")[0][0] == "extra.py"
@@ -0,0 +1,60 @@
+import io
+import time
+
+from ai_coding_agent import TerminalRenderer
+
+
+class FakeTerminal(io.StringIO):
+    """StringIO that claims to be a TTY and counts its writes"""
+
+    def __init__(self):
+        super().__init__()
+        self.writes = 0
+
+    def isatty(self):
+        return True
+
+    def write(self, text):
+        self.writes += 1
+        return super().write(text)
+
+
+def test_piped_output_is_held_until_flush():
+    stream = io.StringIO()
+    renderer = TerminalRenderer(stream, fps=30, flush_bytes=4, buffered_bytes=1000)
+    assert not renderer.interactive
+    for _ in range(50):
+        renderer.write("token ")
+    assert stream.getvalue() == ""
+    renderer.flush()
+    assert stream.getvalue() == "token " * 50
+
+
+def test_piped_output_is_written_in_large_blocks():
+    stream = io.StringIO()
+    renderer = TerminalRenderer(stream, buffered_bytes=100)
+    renderer.write("x" * 60)
+    assert stream.getvalue() == ""
+    renderer.write("y" * 60)
+    assert stream.getvalue() == "x" * 60 + "y" * 60
+
+
+def test_terminal_output_is_coalesced_into_frames():
+    stream = FakeTerminal()
+    renderer = TerminalRenderer(stream, fps=10, flush_bytes=10000)
+    assert renderer.interactive
+    for _ in range(100):
+        renderer.write("a")
+    assert stream.writes == 0
+    time.sleep(0.3)  # the frame timer writes what is waiting
+    assert stream.getvalue() == "a" * 100
+    assert stream.writes == 1
+
+
+def test_terminal_flushes_early_past_flush_bytes():
+    stream = FakeTerminal()
+    renderer = TerminalRenderer(stream, fps=1, flush_bytes=8)
+    renderer.write("a")
+    renderer.write("bbbbbbbbb")
+    assert stream.getvalue() == "abbbbbbbbb"
+    renderer.flush()
@@ -0,0 +1,40 @@
+from ai_coding_agent import ResponseBuffer
+
+
+def fill(buffer, pieces):
+    for piece in pieces:
+        buffer.append(piece)
+    return buffer
+
+
+def test_small_response_stays_in_memory():
+    buffer = fill(ResponseBuffer(1024), ["hello\n", "world"])
+    assert not buffer.spilled
+    assert buffer.getvalue() == "hello\nworld"
+    assert list(buffer.lines()) == ["hello", "world"]
+
+
+def test_large_response_spills_and_reads_back():
+    pieces = [f"line {i}\n" for i in range(5000)]
+    buffer = fill(ResponseBuffer(1024), pieces)
+    assert buffer.spilled
+    assert buffer.size == sum(len(piece) for piece in pieces)
+    assert buffer.getvalue() == "".join(pieces)
+    buffer.append("tail")
+    assert list(buffer.lines()) == "".join(pieces + ["tail"]).split("\n")
+    buffer.close()
+
+
+def test_lines_match_str_split_across_block_boundaries():
+    text = ("a" * 70000 + "\n") * 3 + "\n\nend"
+    buffer = fill(ResponseBuffer(10), [text[i:i + 999] for i in range(0, len(text), 999)])
+    assert list(buffer.lines()) == text.split("\n")
+
+
+def test_cap_counts_encoded_bytes():
+    buffer = ResponseBuffer(100)
+    buffer.append("é" * 40)  # 80 bytes in UTF-8
+    assert not buffer.spilled
+    buffer.append("😀" * 10)  # 40 more bytes
+    assert buffer.spilled
+    assert buffer.getvalue() == "é" * 40 + "😀" * 10
@@ -0,0 +1,107 @@
+import threading
+import time
+
+from ai_coding_agent import CommandScheduler, parse_command
+
+
+class Recorder:
+    """Command runner that logs start and end order and the peak concurrency"""
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.log = []
+        self.running = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, command, cwd):
+        with self._lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+            self.log.append(("start", command))
+        time.sleep(self.delay)
+        with self._lock:
+            self.running -= 1
+            self.log.append(("end", command))
+
+
+def test_commands_in_separate_directories_run_together():
+    run = Recorder()
+    scheduler = CommandScheduler(run, max_concurrency=4)
+    scheduler.submit("a", "frontend")
+    scheduler.submit("b", "backend")
+    scheduler.wait_all()
+    assert run.peak == 2
+
+
+def test_overlapping_directories_run_in_order():
+    run = Recorder(delay=0.02)
+    scheduler = CommandScheduler(run, max_concurrency=4)
+    scheduler.submit("install", "frontend")
+    scheduler.submit("test", "frontend/src")
+    scheduler.submit("root", ".")
+    scheduler.wait_all()
+    assert run.log == [("start", "install"), ("end", "install"),
+                       ("start", "test"), ("end", "test"),
+                       ("start", "root"), ("end", "root")]
+
+
+def test_after_hint_adds_a_dependency():
+    run = Recorder(delay=0.02)
+    scheduler = CommandScheduler(run, max_concurrency=4)
+    scheduler.submit("build", "backend")
+    scheduler.submit("serve", "frontend", after=[1])
+    scheduler.wait_all()
+    assert run.log.index(("end", "build")) < run.log.index(("start", "serve"))
+
+
+def test_concurrency_limit():
+    run = Recorder(delay=0.02)
+    scheduler = CommandScheduler(run, max_concurrency=2)
+    for name in "abcde":
+        scheduler.submit(name, name)
+    scheduler.wait_all()
+    assert run.peak == 2
+    assert len(run.log) == 10
+
+
+def test_cancel_pending_drops_waiting_commands():
+    release = threading.Event()
+    ran = []
+
+    def run(command, cwd):
+        ran.append(command)
+        release.wait(5)
+
+    scheduler = CommandScheduler(run, max_concurrency=1)
+    scheduler.submit("first", "a")
+    scheduler.submit("second", "b")
+    scheduler.cancel_pending()
+    release.set()
+    scheduler.wait_all()
+    assert ran == ["first"]
+
+
+def test_wait_for_paths_only_waits_for_overlapping_commands():
+    release = threading.Event()
+    finished = []
+
+    def run(command, cwd):
+        if command == "slow":
+            release.wait(5)
+        finished.append(command)
+
+    scheduler = CommandScheduler(run, max_concurrency=4)
+    scheduler.submit("slow", "frontend")
+    scheduler.submit("fast", "backend")
+    scheduler.wait_for_paths(["backend/app.py"])
+    assert finished == ["fast"]
+    release.set()
+    scheduler.wait_all()
+    assert finished == ["fast", "slow"]
+
+
+def test_parse_command_hints():
+    assert parse_command("cd web && npm test") == ("cd web && npm test", "web", [])
+    assert parse_command("[cwd=api; after=1,2] make") == ("cd api && make", "api", [1, 2])
+    assert parse_command("cd /tmp && ls") == ("cd /tmp && ls", ".", [])
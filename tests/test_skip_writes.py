@@ -0,0 +1,38 @@
+import os
+
+from ai_coding_agent import ApplyTransaction
+
+
+def test_unchanged_file_keeps_its_mtime(tmp_path):
+    project = str(tmp_path)
+    path = os.path.join(project, "keep.txt")
+    with open(path, "w") as f:
+        f.write("OLD")
+    os.utime(path, ns=(0, 0))
+    transaction = ApplyTransaction(project, durability="none")
+    staged = transaction.open_staged(transaction.stage_file("keep.txt"))
+    staged.write("OLD")
+    staged.close()
+    transaction.record_digest("keep.txt", staged.hexdigest())
+    written, unchanged, _ = transaction.commit()
+    assert written == [] and unchanged == ["keep.txt"]
+    assert os.stat(path).st_mtime_ns == 0
+
+
+def test_repeated_response_skips_unchanged_files(make_agent):
+    agent = make_agent()
+    agent.process_ai_response("FILE: a.txt\nhello\nFILE: b.txt\nB\n")
+    path = os.path.join(agent.project_path, "a.txt")
+    os.utime(path, ns=(0, 0))
+    agent.process_ai_response("FILE: a.txt\nhello\nFILE: b.txt\nC\n")
+    assert os.stat(path).st_mtime_ns == 0
+    assert agent.skipped_writes == 1
+    with open(os.path.join(agent.project_path, "b.txt")) as f:
+        assert f.read() == "C\n"
+
+
+def test_only_the_last_block_for_a_path_is_written(make_agent):
+    agent = make_agent()
+    agent.process_ai_response("FILE: app.py\nprint('hi')\nFILE: app.py\nprint('bye')\n")
+    with open(os.path.join(agent.project_path, "app.py")) as f:
+        assert f.read() == "print('bye')\n"
@@ -0,0 +1,91 @@
+import hashlib
+import time
+
+from ai_coding_agent import DigestStore, FakeGenAIClient, FileSummarizer
+
+
+def sha(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def summarizer(tmp_path, client=None):
+    store = DigestStore(str(tmp_path / "summaries.json"))
+    summarizer = FileSummarizer(client or FakeGenAIClient(), "test-model", store, requests_per_minute=600)
+    summarizer.GATHER_SECONDS = 0.05
+    return summarizer
+
+
+def write(tmp_path, name, text):
+    path = tmp_path / name
+    path.write_text(text)
+    return str(path)
+
+
+def wait_idle(summarizer, timeout=5):
+    deadline = time.monotonic() + timeout
+    while summarizer.pending and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert summarizer.pending == 0
+
+
+def test_files_are_summarized_in_one_batch_by_digest(tmp_path):
+    client = FakeGenAIClient()
+    batches = []
+    generate = client.models.generate_content
+
+    def counting(**kwargs):
+        batches.append(kwargs["contents"])
+        return generate(**kwargs)
+
+    client.models.generate_content = counting
+    worker = summarizer(tmp_path, client)
+    for name in ("a.py", "b.py"):
+        worker.request(sha(name), write(tmp_path, name, name), f"src/{name}")
+    wait_idle(worker)
+    assert len(batches) == 1
+    assert "=== src/a.py ===\na.py" in batches[0]
+    reloaded = DigestStore(worker.store.store_path)
+    assert reloaded.lookup(sha("a.py")) == "Placeholder summary of src/a.py from the offline fake client."
+    assert reloaded.lookup(sha("b.py")).startswith("Placeholder summary of src/b.py")
+
+
+def test_summary_is_stored_under_the_content_that_was_read(tmp_path):
+    worker = summarizer(tmp_path)
+    path = write(tmp_path, "a.py", "old")
+    worker.request(sha("old"), path, "a.py")
+    write(tmp_path, "a.py", "new")
+    wait_idle(worker)
+    assert worker.store.lookup(sha("old")) is None
+    assert worker.store.lookup(sha("new"))
+
+
+def test_queued_file_is_not_queued_twice(tmp_path):
+    worker = summarizer(tmp_path)
+    worker.GATHER_SECONDS = 1
+    path = write(tmp_path, "a.py", "a")
+    worker.request(sha("a"), path, "a.py")
+    worker.request(sha("a"), path, "a.py")
+    assert worker.pending == 1
+    worker.stop()
+    assert worker.pending == 0
+    worker.request(sha("a"), path, "a.py")
+    assert worker.pending == 0
+
+
+def test_failed_batch_backs_off_and_can_be_requested_again(tmp_path):
+    client = FakeGenAIClient()
+
+    def unavailable(**kwargs):
+        raise RuntimeError("503 unavailable")
+
+    client.models.generate_content = unavailable
+    worker = summarizer(tmp_path, client)
+    path = write(tmp_path, "a.py", "a")
+    worker.request(sha("a"), path, "a.py")
+    wait_idle(worker)
+    assert worker.failures == 1
+    assert worker.last_error == "503 unavailable"
+    assert worker.store.lookup(sha("a")) is None
+    worker.request(sha("a"), path, "a.py")
+    assert worker.pending == 1
+    worker.stop()
@@ -0,0 +1,95 @@
+import os
+import random
+
+import pytest
+
+from ai_coding_agent import TokenEstimator, _solve_linear, calibrate_tokens
+
+
+def test_features_add_up_over_concatenation():
+    a, b = "def f(x):\n    return x + 1\n", "# naïve café 42\n"
+    assert TokenEstimator.features(a + b) == TokenEstimator.combine(TokenEstimator.features(a),
+                                                                   TokenEstimator.features(b))
+    assert TokenEstimator.features(b)[5] == 2
+
+
+def test_default_is_four_characters_per_token():
+    assert TokenEstimator().count("x" * 400) == 100
+
+
+def test_record_keeps_the_latest_samples():
+    estimator = TokenEstimator()
+    estimator.MAX_SAMPLES = 3
+    estimator.record([1] * 6, 0)
+    for tokens in range(1, 6):
+        estimator.record([tokens] * 6, tokens)
+    assert [sample[-1] for sample in estimator.samples] == [3, 4, 5]
+
+
+def synthetic_samples(estimator, count=40, seed=1):
+    """Prompts whose true count is 0.3 per character plus 0.7 per non-ASCII character"""
+    rng = random.Random(seed)
+    for _ in range(count):
+        features = [0] * len(TokenEstimator.FEATURES)
+        features[0] = rng.randint(1000, 50000)
+        features[5] = rng.randint(0, features[0] // 4)
+        estimator.record(features, round(0.3 * features[0] + 0.7 * features[5]))
+
+
+def test_fit_recovers_the_coefficients():
+    estimator = TokenEstimator()
+    assert estimator.fit() is None
+    synthetic_samples(estimator)
+    before, after = estimator.fit()
+    assert after < before
+    assert after < 0.02
+    assert estimator.coefficients[0] == pytest.approx(0.3, abs=0.02)
+    assert estimator.coefficients[5] == pytest.approx(0.7, abs=0.1)
+    assert estimator.coefficients[1:5] == [0.0, 0.0, 0.0, 0.0]
+
+
+def test_save_and_load_round_trip(tmp_path):
+    path = str(tmp_path / "tokens.json")
+    estimator = TokenEstimator(path)
+    synthetic_samples(estimator)
+    estimator.fit()
+    estimator.save()
+    loaded = TokenEstimator(path)
+    assert loaded.coefficients == estimator.coefficients
+    assert loaded.samples == estimator.samples
+    with open(path, "w") as f:
+        f.write("{damaged")
+    assert TokenEstimator(path).coefficients == list(TokenEstimator.DEFAULT)
+
+
+def test_calibrate_refits_the_stored_samples(tmp_path, capsys):
+    path = str(tmp_path / "tokens.json")
+    calibrate_tokens(path)
+    assert "Not enough recorded prompts" in capsys.readouterr().out
+    estimator = TokenEstimator(path)
+    synthetic_samples(estimator)
+    estimator.save()
+    calibrate_tokens(path)
+    assert "Mean error over 40 prompts" in capsys.readouterr().out
+    assert TokenEstimator(path).coefficients[0] == pytest.approx(0.3, abs=0.02)
+
+
+def test_solve_linear():
+    assert _solve_linear([[0.0, 2.0], [4.0, 1.0]], [2.0, 9.0]) == pytest.approx([2.0, 1.0])
+    assert _solve_linear([[1.0, 2.0], [2.0, 4.0]], [1.0, 2.0]) is None
+
+
+def test_manifest_keeps_features_per_content(make_agent):
+    agent = make_agent()
+    with open(os.path.join(agent.project_path, "a.py"), "w") as f:
+        f.write("x = 1\n")
+    agent.manifest.refresh()
+    assert agent.manifest.token_features("a.py", "x = 1\n") == TokenEstimator.features("x = 1\n")
+    assert agent.manifest.token_features("a.py", "ignored") == TokenEstimator.features("x = 1\n")
+    path = os.path.join(agent.project_path, "a.py")
+    with open(path, "w") as f:
+        f.write("y = 22\n")
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    agent.manifest.check("a.py")
+    assert agent.manifest.token_features("a.py", "y = 22\n") == TokenEstimator.features("y = 22\n")
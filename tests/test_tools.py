@@ -0,0 +1,68 @@
+import os
+
+
+def tool_agent(make_agent, tool_calls, rounds=10):
+    agent = make_agent(reply="Done.\nFILE: out.txt\nok\n", tool_calls=tool_calls)
+    agent.config["tool_calling"] = True
+    agent.config["tool_rounds"] = rounds
+    agent.prompt_cache.min_tokens = 1
+    with open(os.path.join(agent.project_path, "mod.py"), "w") as f:
+        f.write("def answer():\n    return 42\n" * 20)
+    return agent
+
+
+def record_requests(agent):
+    """Keep the config and a copy of the contents of every streamed request"""
+    stream = agent.client.models.generate_content_stream
+    requests = []
+
+    def recording(**kwargs):
+        requests.append((kwargs["config"], list(kwargs["contents"])))
+        return stream(**kwargs)
+
+    agent.client.models.generate_content_stream = recording
+    return requests
+
+
+def function_responses(contents):
+    return [part.function_response for content in contents for part in content.parts
+            if part.function_response is not None]
+
+
+def test_tool_results_are_fed_back_each_round(make_agent):
+    agent = tool_agent(make_agent, [
+        [("read_file", {"path": "mod.py", "end_line": 2})],
+        [("grep", {"pattern": "return"}), ("list_files", {})],
+    ])
+    requests = record_requests(agent)
+    agent.query_model("what does answer return?")
+    assert len(requests) == 3
+    first, second, third = (function_responses(contents) for _, contents in requests)
+    assert first == []
+    assert [response.name for response in second] == ["read_file"]
+    assert second[0].id == "call-0"
+    assert second[0].response["content"] == "def answer():\n    return 42"
+    assert [response.name for response in third] == ["read_file", "grep", "list_files"]
+    assert third[2].response["files"] == ["mod.py"]
+    with open(os.path.join(agent.project_path, "out.txt")) as f:
+        assert f.read() == "ok\n"
+
+
+def test_no_context_cache_next_to_tools(make_agent, capsys):
+    agent = tool_agent(make_agent, [[("list_files", {})]])
+    requests = record_requests(agent)
+    agent.query_model("list the files")
+    assert [config.cached_content for config, _ in requests] == [None, None]
+    assert all(config.tools for config, _ in requests)
+    assert agent.client.caches.created == 0
+    assert "Error" not in capsys.readouterr().out
+
+
+def test_last_round_forbids_more_calls(make_agent):
+    agent = tool_agent(make_agent, [[("list_files", {})], [("list_files", {})]], rounds=1)
+    requests = record_requests(agent)
+    agent.query_model("list the files")
+    assert len(requests) == 2
+    assert requests[0][0].tool_config is None
+    assert requests[1][0].tool_config.function_calling_config.mode == "NONE"
+    assert len(agent.client.tool_calls) == 1
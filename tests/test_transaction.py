@@ -0,0 +1,101 @@
+import os
+
+import pytest
+
+from ai_coding_agent import ApplyTransaction, CommitError
+
+
+@pytest.fixture
+def project(tmp_path):
+    root = tmp_path / "proj"
+    root.mkdir()
+    (root / "keep.txt").write_text("OLD")
+    return str(root)
+
+
+def stage(transaction, path, text):
+    staged = transaction.open_staged(transaction.stage_file(path))
+    staged.write(text)
+    staged.close()
+    transaction.record_digest(path, staged.hexdigest())
+
+
+def read(project, path):
+    with open(os.path.join(project, path)) as f:
+        return f.read()
+
+
+def leftovers(project):
+    parent = os.path.dirname(project)
+    return [name for name in os.listdir(parent) if "staging" in name]
+
+
+def test_commit_writes_files_and_directories(project):
+    transaction = ApplyTransaction(project)
+    stage(transaction, "keep.txt", "NEW")
+    stage(transaction, "src/app.py", "print(1)\n")
+    transaction.stage_directory("empty")
+    written, unchanged, dirs = transaction.commit()
+    assert sorted(written) == ["keep.txt", "src/app.py"]
+    assert unchanged == []
+    assert dirs == ["empty"]
+    assert read(project, "keep.txt") == "NEW"
+    assert read(project, "src/app.py") == "print(1)\n"
+    assert os.path.isdir(os.path.join(project, "empty"))
+    assert leftovers(project) == []
+
+
+def test_rollback_leaves_project_untouched(project):
+    transaction = ApplyTransaction(project)
+    stage(transaction, "keep.txt", "NEW")
+    stage(transaction, "new.txt", "N")
+    assert transaction.rollback() == 2
+    assert read(project, "keep.txt") == "OLD"
+    assert not os.path.exists(os.path.join(project, "new.txt"))
+    assert leftovers(project) == []
+
+
+def test_path_outside_project_is_rejected(project):
+    transaction = ApplyTransaction(project)
+    with pytest.raises(ValueError):
+        transaction.stage_file("../escape.txt")
+
+
+@pytest.mark.parametrize("second", ["plain.txt/child", "d"])
+def test_file_directory_conflict_changes_nothing(project, second):
+    os.mkdir(os.path.join(project, "d"))
+    with open(os.path.join(project, "plain.txt"), "w") as f:
+        f.write("P")
+    transaction = ApplyTransaction(project)
+    stage(transaction, "keep.txt", "NEW")
+    stage(transaction, "fresh/dir/n.txt", "N")
+    stage(transaction, second, "X")
+    with pytest.raises(CommitError):
+        transaction.commit()
+    transaction.rollback()
+    assert read(project, "keep.txt") == "OLD"
+    assert not os.path.exists(os.path.join(project, "fresh"))
+    assert leftovers(project) == []
+
+
+def test_failed_replace_restores_earlier_files(project, monkeypatch):
+    real_replace = os.replace
+
+    def flaky_replace(src, dst):
+        if dst.endswith("b.txt") and ".backup" not in src:
+            raise PermissionError(13, "denied", dst)
+        return real_replace(src, dst)
+
+    transaction = ApplyTransaction(project)
+    stage(transaction, "keep.txt", "NEW")
+    stage(transaction, "m/b.txt", "B")
+    monkeypatch.setattr(os, "replace", flaky_replace)
+    with pytest.raises(CommitError) as info:
+        transaction.commit()
+    monkeypatch.setattr(os, "replace", real_replace)
+    transaction.rollback()
+    assert info.value.path == "m/b.txt"
+    assert read(project, "keep.txt") == "OLD"
+    assert not os.path.exists(os.path.join(project, "m"))
+    assert leftovers(project) == []
+
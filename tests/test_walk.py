@@ -0,0 +1,44 @@
+import os
+
+from ai_coding_agent import ProjectManifest
+
+
+def write(root, rel_path, text="x"):
+    path = os.path.join(root, rel_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def test_manifest_skips_ignored_and_pruned_paths(tmp_path):
+    root = str(tmp_path)
+    write(root, ".gitignore", "*.log\n")
+    write(root, "main.py")
+    write(root, "debug.log")
+    write(root, "node_modules/lib.js")
+    write(root, "build/out.py")
+    manifest = ProjectManifest(root)
+    manifest.refresh()
+    assert sorted(manifest.files) == [".gitignore", "main.py"]
+    assert manifest.is_ignored("debug.log")
+    assert manifest.is_ignored(os.path.join("node_modules", "lib.js"))
+    assert manifest.is_ignored(os.path.join("build", "out.py"))
+
+
+def test_default_ignores_can_be_negated(tmp_path):
+    root = str(tmp_path)
+    write(root, ".agentignore", "!build/\n")
+    write(root, "build/setup.py")
+    write(root, "dist/pkg.whl")
+    manifest = ProjectManifest(root)
+    manifest.refresh()
+    assert os.path.join("build", "setup.py") in manifest.files
+    assert manifest.is_ignored(os.path.join("dist", "pkg.whl"))
+
+
+def test_paths_outside_the_project_are_ignored(tmp_path):
+    manifest = ProjectManifest(str(tmp_path))
+    manifest.refresh()
+    assert manifest.is_ignored("/etc/passwd")
+    assert manifest.is_ignored("../secret.txt")
+    assert manifest.is_ignored("..")
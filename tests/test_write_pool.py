@@ -0,0 +1,39 @@
+import threading
+import time
+
+from ai_coding_agent import WriteBehindPool
+
+
+def test_tasks_for_one_key_run_in_order():
+    pool = WriteBehindPool(max_workers=4)
+    order = []
+    for i in range(50):
+        pool.submit("a.txt", lambda i=i: (time.sleep(0.001 * (i % 3)), order.append(i)))
+    assert pool.drain() == []
+    pool.shutdown()
+    assert order == list(range(50))
+
+
+def test_different_keys_run_in_parallel():
+    pool = WriteBehindPool(max_workers=2)
+    both_started = threading.Barrier(2, timeout=5)
+    pool.submit("a", both_started.wait)
+    pool.submit("b", both_started.wait)
+    assert pool.drain() == []
+    pool.shutdown()
+
+
+def test_failures_are_reported_once_and_later_tasks_still_run():
+    pool = WriteBehindPool(max_workers=2)
+    ran = []
+
+    def fail():
+        raise OSError("disk full")
+
+    pool.submit("a", fail)
+    pool.submit("a", ran.append, "after")
+    failures = pool.drain()
+    assert [(key, str(error)) for key, error in failures] == [("a", "disk full")]
+    assert ran == ["after"]
+    assert pool.drain() == []
+    pool.shutdown()